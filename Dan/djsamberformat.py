@@ -3,9 +3,22 @@
 Program reads an amber input file in proper format and
 stores all data in a dictionary which can be looked up
 by the FLAG string
+
+Binary topology snapshots (.snap.npz files written next to prmtops by
+UCSB_Python_Mods/coords.py when PRMTOP_SNAPSHOTS=1 is set or
+coords.UsePrmtopSnapshots is True) can be read with readsnapshot and
+turned back into the original prmtop with writesnapshot
+
+Modified copies of an amber file (e.g. with new charges for each state)
+can be written with writeamberfile or writeamberfiles
 '''
 import sys
+import os
 import re
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 def formatvalues(valuelist,format):
     '''
@@ -30,17 +43,132 @@ Prepends %FORMAT(....) line
     elif valuetype == "I" :
         valuetype="d"
     myformatstring+=valuetype
-    remainingonrow=valsperrow
-    for value in valuelist:
-        remainingonrow-=1
-        if remainingonrow<0 :
-            formattedstring += "\n"
-            remainingonrow=valsperrow-1
-        formattedstring+=myformatstring % value
+    rows=[]
+    for i in range(0,len(valuelist),valsperrow):
+        row=tuple(valuelist[i:i+valsperrow])
+        rows.append((myformatstring*len(row)) % row)
+    formattedstring+="\n".join(rows)
 
     return(formattedstring)
 
+# rows formatted at a time when writing a section
+ROWS_PER_WRITE = 1000
+
+def amberrowformat(format):
+    '''
+Returns the printf style format for one value and the number of
+values per row for an amber format (e.g. '10I8' gives ('%8d', 10)).
+Character data is left justified as in prmtop files
+    '''
+    match = re.match(r'(\d*)([aAiIeEfF])(\d+)(\.\d+)?', format)
+    if match is None:
+        raise ValueError("Unrecognized amber format %s" % format)
+    valsperrow = int(match.group(1) or 1)
+    valuetype = match.group(2)
+    width = match.group(3)
+    if valuetype in 'aA':
+        return('%-' + width + 's', valsperrow)
+    elif valuetype in 'iI':
+        return('%' + width + 'd', valsperrow)
+    return('%' + width + (match.group(4) or '') + valuetype, valsperrow)
+
+def writesection(f, values, format):
+    '''
+Writes the data lines of one %FLAG section to the open file f,
+formatting ROWS_PER_WRITE whole rows at a time.  values may be a
+list or a numpy array
+    '''
+    valueformat, valsperrow = amberrowformat(format)
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        values = values.tolist()
+    nvalues = len(values)
+    if nvalues == 0:
+        f.write("\n") # empty sections still have a blank line
+        return
+    chunk = valsperrow * ROWS_PER_WRITE
+    chunkformat = (valueformat * valsperrow + "\n") * ROWS_PER_WRITE
+    nfull = nvalues - nvalues % chunk
+    for i in range(0, nfull, chunk):
+        f.write(chunkformat % tuple(values[i:i+chunk]))
+    # the last, partial block of rows
+    remaining = nvalues - nfull
+    if remaining > 0:
+        lastformat = (valueformat * valsperrow + "\n") * (remaining // valsperrow)
+        if remaining % valsperrow:
+            lastformat += valueformat * (remaining % valsperrow) + "\n"
+        f.write(lastformat % tuple(values[nfull:]))
+
+def readamberlayout(filename):
+    '''
+Reads the layout of an amber file for writing modified copies of it.
+Returns the text before the first %FLAG line and a list of
+(flag, flagline, formatline, format, datatext) for each section, where
+the lines and data text are kept exactly as in the file
+    '''
+    f = open(filename,"r")
+    lines = f.readlines()
+    f.close()
+    header = []
+    sections = []
+    i = 0
+    while i < len(lines) and not lines[i].startswith('%FLAG'):
+        header.append(lines[i])
+        i += 1
+    while i < len(lines):
+        flagline = lines[i]
+        formatline = ''
+        i += 1
+        if i < len(lines) and lines[i].startswith('%FORMAT'):
+            formatline = lines[i]
+            i += 1
+        start = i
+        while i < len(lines) and not lines[i].startswith('%FLAG'):
+            i += 1
+        format = formatline.strip()[len('%FORMAT('):-1]
+        sections.append((flagline.split()[1], flagline, formatline, format,
+                         ''.join(lines[start:i])))
+    return(''.join(header), sections)
+
+def writeamberfile(outfilename, layout, changes={}):
+    '''
+Writes an amber file with the layout returned by readamberlayout,
+replacing the values of the flags in the dictionary 'changes'
+(e.g. {'CHARGE' : newcharges}).  Unchanged sections are copied as is
+and changed ones are streamed to the file row by row
+    '''
+    header, sections = layout
+    f = open(outfilename, "w")
+    f.write(header)
+    for flag, flagline, formatline, format, datatext in sections:
+        f.write(flagline)
+        f.write(formatline)
+        if flag in changes:
+            writesection(f, changes[flag], format)
+        else:
+            f.write(datatext)
+    f.close()
+
+def writeamberfiles(filename, variants):
+    '''
+Writes many modified copies of the amber file 'filename', reading it
+only once.  variants is a dictionary of output file name to the
+dictionary of changed flags for that file
+    '''
+    layout = readamberlayout(filename)
+    for outfilename in sorted(variants):
+        writeamberfile(outfilename, layout, variants[outfilename])
+
 def readamberfile(filename):
+    f = open(filename,"r")
+    amberdic=readamberlines(f)
+    f.close()
+    return(amberdic)
+
+def readamberlines(lines):
+    '''
+Reads the lines of an amber file (any iterable of lines) into
+a dictionary as readamberfile does
+    '''
     def convvalfmt(invalues,valuetype):
         #converts string values to appropriate value type
         if valuetype=="e": #exponential
@@ -51,11 +179,10 @@ def readamberfile(filename):
             outvalues = invalues # no conversion necessary
         return(outvalues)
     amberdic={}
-    f = open(filename,"r")
     nextlineisformat=0
     flag = "first"
     values=[]
-    for line in f:
+    for line in lines:
         if "FLAG" in line:
             if flag != "first" : # if not the first flag found
                 amberdic[flag]=convvalfmt(values,valuetype) # assign previously read value set
@@ -74,9 +201,39 @@ def readamberfile(filename):
                 values.append(line[i*charspervalue:(i+1)*charspervalue]) # add one value
 
     amberdic[flag]=convvalfmt(values,valuetype) # one last time for last value et
-    f.close()
     return(amberdic)
 
+def snapshotprmtop(filename):
+    '''
+Returns a coords.Prmtop object (from UCSB_Python_Mods) loaded from a
+topology snapshot; coords.py holds the one implementation of the format
+    '''
+    try:
+        import coords
+    except ImportError:
+        sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                     os.pardir, 'UCSB_Python_Mods'))
+        import coords
+    snap = coords.load(filename)
+    source = str(snap['source'].item())
+    snap.close()
+    return(coords.Prmtop(source, SnapshotFile=filename))
+
+def readsnapshot(filename):
+    '''
+Reads a topology snapshot and returns the same dictionary as
+readamberfile would for the original prmtop
+    '''
+    prmtop = snapshotprmtop(filename)
+    return(readamberlines(prmtop.Text().splitlines(True)))
+
+def writesnapshot(filename, outfilename):
+    '''
+Writes the prmtop saved in a topology snapshot to outfilename.
+The file is identical to the one the snapshot was made from
+    '''
+    snapshotprmtop(filename).Write(outfilename)
+
 def main():
 
     minargs=1
@@ -84,7 +241,14 @@ def main():
     if(numargs<minargs) :
     	print "Insufficient arguments, need ",minargs," : ",numargs
         print "format djsamberformat.py <amberfilename>" 
-    readamberfile(sys.argv[1])
+        print "       djsamberformat.py <snapshot.npz> <outprmtop>"
+    if sys.argv[1].endswith('.npz'):
+        if numargs > 2:
+            writesnapshot(sys.argv[1], sys.argv[2])
+        else:
+            readsnapshot(sys.argv[1])
+    else:
+        readamberfile(sys.argv[1])
 
 if __name__ == '__main__' :
     main()
@@ -1,14 +1,20 @@
 #!/usr/bin/env python
 """ 
 This script will take 2 prmtop files that have different charge sets and create
-a set of interpolated prmtops that vary in the charges.  It does not yet
-interpolate VDW radii, so be careful.
+a set of interpolated prmtops that vary in the charges.  Other floating point
+sections (e.g. the Lennard-Jones tables) can be interpolated as well with
+-interpolate, but note that interpolating the LJ A and B coefficients is not
+the same as interpolating the VDW radii, so be careful.
+
+All of the windows are computed at once for the elements that differ between
+the two topologies, and the files are written in parallel with -nproc.
 
 By Jason Swails, Updated 04/18/2011
 """
 
 from chemistry.amber.readparm import amberParm
 from MMPBSA_mods.commandline_parser import OptionParser
+import numpy as np
 import sys
 import os
 
@@ -23,6 +29,42 @@ def excepthook(extype, exval, tb):
 
 sys.excepthook = excepthook
 
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+def interpolate_windows(parm1, parm2, flags, lambdas):
+   """
+   Computes every window at once for each section in flags. Only the elements
+   that differ between the two topologies are kept: returns a dict mapping
+   each flag to (indices, values) where values is nwindow x len(indices)
+   """
+   windows = {}
+   for flag in flags:
+      vals1 = np.array(parm1.parm_data[flag], dtype=float)
+      vals2 = np.array(parm2.parm_data[flag], dtype=float)
+      if vals1.shape != vals2.shape:
+         print >> sys.stderr, 'Error: %%FLAG %s has different sizes in each ' \
+                              'prmtop!' % flag
+         sys.exit(1)
+      idx = np.nonzero(vals1 != vals2)[0]
+      lmda = lambdas[:,np.newaxis]
+      windows[flag] = (idx, vals2[idx]*lmda + (1-lmda)*vals1[idx])
+   return windows
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+def write_window(i):
+   """
+   Writes the prmtop for window i from the global parm1, lambdas, and windows.
+   Runs in a forked worker process, so changing parm1 here is safe
+   """
+   for flag, (idx, values) in windows.iteritems():
+      data = parm1.parm_data[flag]
+      for j, val in zip(idx.tolist(), values[i].tolist()):
+         data[j] = val
+   fname = opt.prefix + '.%.2f' % lambdas[i]
+   parm1.writeParm(fname)
+   return fname
+
 # Set up the option parser
 parser = OptionParser()
 
@@ -34,6 +76,11 @@ parser.addOption('-n', 'number', help='Number of TOTAL prmtops you want, ' +
 parser.addOption('-groupfile', 'groupfile', help='Optionally print out a ' +
                  'skeleton groupfile for running H-REMD simulations with ' +
                  'sander.MPI or pmemd.MPI')
+parser.addOption('-interpolate', 'interpolate', help='Comma-separated list ' +
+                 'of floating point %FLAG sections to interpolate, or "all" ' +
+                 'for every one that differs', default='CHARGE')
+parser.addOption('-nproc', 'nproc', help='Number of processes to write ' +
+                 'the topology files with', default=1)
 parser.addOption('-debug', 'debug', help='0: Suppress tracebacks, ' + 
                  '1: print tracebacks', default=0)
 
@@ -41,6 +88,7 @@ opt = parser.Parse()
 
 debug_printlevel = opt.debug
 opt.number = int(opt.number)
+opt.nproc = int(opt.nproc)
 
 if not opt.prmtop1 or not opt.prmtop2:
    parser.print_help()
@@ -63,35 +111,54 @@ if parm1.parm_data['ATOM_NAME'] != parm2.parm_data['ATOM_NAME']:
    print >> sys.stderr, 'Error: Atom sequences must be the same in each prmtop!'
    sys.exit(1)
 
-# Make copies so we don't change either set when we change our parm1 charges
-
-print >> sys.stdout, 'Copying charges...'
-charges_1 = parm1.parm_data['CHARGE'][:]
-charges_2 = parm2.parm_data['CHARGE'][:]
+# Find the sections to interpolate
+if opt.interpolate.lower() == 'all':
+   flags = [flag for flag in parm1.flag_list
+            if parm1.parm_data[flag] and
+            isinstance(parm1.parm_data[flag][0], float) and
+            parm1.parm_data[flag] != parm2.parm_data[flag]]
+else:
+   flags = [flag.strip().upper() for flag in opt.interpolate.split(',')]
+   for flag in flags:
+      if not flag in parm1.parm_data or not flag in parm2.parm_data:
+         print >> sys.stderr, 'Error: %%FLAG %s is not in both prmtops!' % flag
+         sys.exit(1)
+
+print >> sys.stdout, 'Interpolating %s' % ', '.join(flags)
+lambdas = np.arange(opt.number) * (1.0 / (opt.number - 1))
+windows = interpolate_windows(parm1, parm2, flags, lambdas)
 
 print >> sys.stdout, '\nCreating %d new topology files\n' % opt.number
-for i in range(opt.number):
-   lmda = 1.0 / (opt.number - 1) * i
-   for j in range(parm1.ptr('natom')):
-      parm1.parm_data['CHARGE'][j] = charges_2[j]*lmda + (1-lmda)*charges_1[j]
-   
-   print >> sys.stdout, '\tWriting %s' % (opt.prefix + '.%.2f' % lmda)
-   parm1.writeParm(opt.prefix + '.%.2f' % lmda)
+grpfl = None
+if opt.groupfile:
+   grpfl = open(opt.groupfile, 'w')
 
-print >> sys.stdout, '\nDone writing topology files!'
+# Write the topologies, filling in the groupfile as each one is done
+pool = None
+if opt.nproc > 1:
+   from multiprocessing import Pool
+   pool = Pool(opt.nproc)
+try:
+   if pool is None:
+      done = (write_window(i) for i in range(opt.number))
+   else:
+      done = pool.imap(write_window, range(opt.number))
+   for i, fname in enumerate(done):
+      print >> sys.stdout, '\tWriting %s' % fname
+      if grpfl is not None:
+         grpfl.write('# Replica at lambda = %6.4f\n' % lambdas[i])
+         grpfl.write(('-O -i <MDIN> -o <MDOUT> -p %s -c <INPCRD> -r <RESTRT> '
+                     + '-x <MDCRD>\n\n') % fname)
+finally:
+   if pool is not None:
+      pool.close()
+      pool.join()
 
-if opt.groupfile:
-   print >> sys.stdout, '\nWriting groupfile %s for amber simulations' % \
-            opt.groupfile
+print >> sys.stdout, '\nDone writing topology files!'
 
-   grpfl = open(opt.groupfile, 'w')
-   for i in range(opt.number):
-      lmda = 1.0 / (opt.number - 1) * i
-      grpfl.write('# Replica at lambda = %6.4f\n' % lmda)
-      grpfl.write(('-O -i <MDIN> -o <MDOUT> -p %s.%.2f -c <INPCRD> -r <RESTRT> '
-                  + '-x <MDCRD>\n\n') % (opt.prefix, lmda))
+if grpfl is not None:
    grpfl.close()
-
-   print >> sys.stdout, 'Done writing %s' % opt.groupfile
+   print >> sys.stdout, 'Done writing groupfile %s for amber simulations' % \
+            opt.groupfile
 
 print >> sys.stdout, '%s execution complete!' % (os.path.split(sys.argv[0])[1])
@@ -112,5 +112,17 @@ printf "   Checking pH-REM log analysis: "
 diff -Nru ph_remlog.stats.check tmp > ph_remlog.stats.diff
 test_cleanup $? ph_remlog.stats.diff
 echo "============================================================"
+echo "Testing UCSB_Python_Mods"
+printf "   Checking QCP against SVD alignment:   "
+PYTHONPATH=../UCSB_Python_Mods python -c "import geometry; geometry.TestQCP()" \
+                   > geometry_qcp.diff 2>&1
+test_cleanup $? geometry_qcp.diff
+
+printf "   Checking pruned, parallel clustering: "
+PYTHONPATH=../UCSB_Python_Mods python -c "import coords, rmsd; \
+   rmsd.TestClusterMSS(coords.OpenTrj('trpcage.solv5.1_remd12.nc', 'trpcage.nowat.parm7'))" \
+                   > rmsd_cluster.diff 2>&1
+test_cleanup $? rmsd_cluster.diff
+echo "============================================================"
 
-/bin/rm -f tmp
+/bin/rm -f tmp *.snap.npz
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+#LAST MODIFIED: 10-18-26
+
+#DESCRIPTION: Compiles Amber atom mask strings into index arrays.
+#Supported syntax:
+#  :1-20,25        residue numbers and ranges (starting at 1)
+#  :WAT,Na+        residue names
+#  @CA,C,N         atom names
+#  @1-100          atom numbers and ranges (starting at 1)
+#  @%CT            atom types
+#  :1-20@CA,C,N    residues and atoms together (both must match)
+#  * = ?           wildcards; * and = match any characters, ? one
+#  ! & | ( )       not, and, or, and grouping, in decreasing precedence
+#A mask is compiled once against a topology; masks compiled against a
+#prmtop file are cached, so selection costs nothing per frame.
+
+
+from numpy import *
+import os, re, fnmatch
+import coords
+
+
+#cache of compiled masks, by (prmtop path, size, mtime, mask)
+MaskCache = {}
+
+#characters that end a selection
+Operators = "()!&|"
+NumRangeRe = re.compile(r"(\d+)(?:-(\d+))?$")
+
+
+class MaskTopology:
+  "Holds the atom and residue data that masks are compiled against."
+
+  def __init__(self, AtomNames, ResNames, AtomRes, AtomTypes = None):
+    """Initializes the topology.
+* AtomNames: list of atom names
+* ResNames: list of residue names
+* AtomRes: residue number (starting at 0) of each atom
+* AtomTypes: list of atom types, needed for @% selections"""
+    self.NAtom = len(AtomNames)
+    self.NRes = len(ResNames)
+    self.AtomRes = array(AtomRes, int)
+    #names are matched once per unique name
+    self.AtomNames = unique(array([a.strip() for a in AtomNames], str),
+                            return_inverse = True)
+    self.ResNames = unique(array([r.strip() for r in ResNames], str),
+                           return_inverse = True)
+    if AtomTypes is None:
+      self.AtomTypes = None
+    else:
+      self.AtomTypes = unique(array([t.strip() for t in AtomTypes], str),
+                              return_inverse = True)
+
+
+def PrmtopTopology(PrmtopFile):
+  "Returns a MaskTopology for a prmtop file."
+  Prm = coords.GetPrmtop(PrmtopFile)
+  if "AMBER_ATOM_TYPE" in Prm.Flags:
+    AtomTypes = Prm.GetArray("AMBER_ATOM_TYPE").tolist()
+  else:
+    AtomTypes = None
+  return MaskTopology(Prm.GetArray("ATOM_NAME").tolist(),
+                      Prm.GetArray("RESIDUE_LABEL").tolist(),
+                      coords.GetPrmtopAtomRes(PrmtopFile), AtomTypes)
+
+
+def MatchNames(Names, Items):
+  """Returns a boolean array of the entries in a (unique names, inverse)
+pair matching any of a list of name patterns."""
+  UNames, Inv = Names
+  Match = zeros(len(UNames), bool)
+  for Item in Items:
+    Pat = Item.replace("=", "*")
+    if "*" in Pat or "?" in Pat:
+      Match |= array([fnmatch.fnmatchcase(n, Pat) for n in UNames], bool)
+    else:
+      Match |= (UNames == Pat)
+  return Match[Inv]
+
+
+def MatchNums(N, Items, Kind):
+  """Returns a boolean array of length N selecting numbers and ranges
+that start at 1."""
+  Sel = zeros(N, bool)
+  for Item in Items:
+    m = NumRangeRe.match(Item)
+    a = int(m.group(1))
+    b = a
+    if not m.group(2) is None: b = int(m.group(2))
+    if a < 1 or b < a:
+      raise ValueError, "Bad %s range %s in mask." % (Kind, Item)
+    Sel[a-1:b] = True
+  return Sel
+
+
+def MatchList(N, Names, s, Kind):
+  """Returns a boolean array for a comma-separated list of numbers,
+ranges and names."""
+  Items = [x.strip() for x in s.split(",") if len(x.strip()) > 0]
+  if len(Items) == 0:
+    raise ValueError, "Empty %s list in mask." % Kind
+  NumItems = [x for x in Items if NumRangeRe.match(x)]
+  NameItems = [x for x in Items if not NumRangeRe.match(x)]
+  Sel = zeros(N, bool)
+  if len(NumItems) > 0: Sel |= MatchNums(N, NumItems, Kind)
+  if len(NameItems) > 0: Sel |= MatchNames(Names, NameItems)
+  return Sel
+
+
+def SelectTerm(Top, s):
+  """Returns a boolean atom array for a single selection like
+':1-20@CA,C,N'."""
+  if s == "*":
+    return ones(Top.NAtom, bool)
+  if s[0] in "<>":
+    raise ValueError, "Distance selections are not supported: %s" % s
+  m = re.match(r"(?::([^@]*))?(?:@(.*))?$", s)
+  if m is None or not s[0] in ":@":
+    raise ValueError, "Could not parse mask selection %s." % s
+  Sel = ones(Top.NAtom, bool)
+  if not m.group(1) is None:
+    ResSel = MatchList(Top.NRes, Top.ResNames, m.group(1), "residue")
+    Sel &= ResSel[Top.AtomRes]
+  if not m.group(2) is None:
+    a = m.group(2)
+    if a.startswith("%"):
+      if Top.AtomTypes is None:
+        raise ValueError, "Atom types are not available for %s." % s
+      Sel &= MatchNames(Top.AtomTypes, a[1:].split(","))
+    elif a.startswith("/"):
+      raise ValueError, "Element selections are not supported: %s" % s
+    else:
+      Sel &= MatchList(Top.NAtom, Top.AtomNames, a, "atom")
+  return Sel
+
+
+def Tokenize(Mask):
+  "Splits a mask string into operators and selections."
+  Tokens = []
+  i = 0
+  while i < len(Mask):
+    c = Mask[i]
+    if c.isspace():
+      i += 1
+    elif c in Operators:
+      Tokens.append(c)
+      i += 1
+    else:
+      j = i
+      while j < len(Mask) and not Mask[j] in Operators and not Mask[j].isspace():
+        j += 1
+      Tokens.append(Mask[i:j])
+      i = j
+  return Tokens
+
+
+def CompileMask(Mask, Top):
+  """Compiles an Amber mask string against a MaskTopology.
+Returns a sorted index array of the selected atoms."""
+  Tokens = Tokenize(Mask)
+  Pos = [0]
+  def Peek():
+    if Pos[0] < len(Tokens): return Tokens[Pos[0]]
+    return None
+  def Next():
+    t = Peek()
+    Pos[0] += 1
+    return t
+  def Or():
+    Sel = And()
+    while Peek() == "|":
+      Next()
+      Sel = Sel | And()
+    return Sel
+  def And():
+    Sel = Not()
+    while Peek() == "&":
+      Next()
+      Sel = Sel & Not()
+    return Sel
+  def Not():
+    t = Next()
+    if t is None:
+      raise ValueError, "Unexpected end of mask %s." % Mask
+    elif t == "!":
+      return ~Not()
+    elif t == "(":
+      Sel = Or()
+      if not Next() == ")":
+        raise ValueError, "Unbalanced parentheses in mask %s." % Mask
+      return Sel
+    elif t in Operators:
+      raise ValueError, "Unexpected %s in mask %s." % (t, Mask)
+    else:
+      return SelectTerm(Top, t)
+  Sel = Or()
+  if not Peek() is None:
+    raise ValueError, "Unexpected %s in mask %s." % (Peek(), Mask)
+  return nonzero(Sel)[0]
+
+
+def GetMaskInd(PrmtopFile, Mask):
+  """Returns a read-only index array of the atoms in a prmtop file
+selected by an Amber mask string; compiled masks are cached."""
+  st = os.stat(PrmtopFile)
+  Key = (os.path.abspath(PrmtopFile), st.st_size, st.st_mtime, Mask)
+  if not Key in MaskCache:
+    Ind = CompileMask(Mask, PrmtopTopology(PrmtopFile))
+    Ind.flags.writeable = False
+    MaskCache[Key] = Ind
+  return MaskCache[Key]
+
+
+def IsAmberMask(Mask):
+  "Returns True if Mask is an Amber mask string."
+  return isinstance(Mask, str)
+
+
+def CoordsObjMaskInd(CoordsObj, Mask):
+  """Returns an index array into the positions returned by a coords
+object (after its own Mask is applied) for an Amber mask string.
+Index arrays and None are returned unchanged."""
+  if not IsAmberMask(Mask): return Mask
+  PrmtopFile = getattr(CoordsObj, "PrmtopFile", None)
+  if PrmtopFile is None:
+    Top = MaskTopology(CoordsObj.AtomNames, CoordsObj.Seq, CoordsObj.AtomRes)
+    Ind = CompileMask(Mask, Top)
+  else:
+    Ind = GetMaskInd(PrmtopFile, Mask)
+  AtomInd = coords.MaskInd(CoordsObj.AtomNames,
+                          getattr(CoordsObj, "Mask", coords.NoMask))
+  if AtomInd is None: return Ind
+  #positions of the selected atoms within the object's own selection
+  return nonzero(in1d(AtomInd, Ind))[0]
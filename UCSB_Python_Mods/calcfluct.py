@@ -1,13 +1,13 @@
 #!/usr/bin/env python
 
-#LAST MODIFIED: 06-20-06
+#LAST MODIFIED: 10-18-26
 
 Usage = """Calculates residue-specific fluctuations between a trajectory
 and a reference pdb file.  Produces a new pdb file with "-fluct" appended.
 
 Usage     : calcfluct.py TRJFILE PRMTOPFILE REFPDB [NSKIP NREAD NSTRIDE]
 
-trjfile   : trajectory CRD file (can be gzipped)
+trjfile   : trajectory CRD file (can be gzipped) or NetCDF file
 prmtopfile: PARM7 file
 nskip     : number of configs in trajectory to skip (default is 0)
 nread     : number of configs in trajectory to read; -1 is all (default -1)
@@ -36,7 +36,7 @@ else:
   NStride = 1
 
 RefPos = coords.GetPdbCoords(PdbFile)
-t = coords.TrjClass(TrjFile, PrmtopFile, 
+t = coords.OpenTrj(TrjFile, PrmtopFile, 
     NRead = NRead, NSkip = NSkip, NStride = NStride)
 
 NAtom = len(RefPos)
@@ -44,14 +44,13 @@ print "Found %d atoms" % NAtom
 dSq = zeros(NAtom, float)
 N = 0
 
-for Pos in t:
-  N += 1
-  r = rmsd.RMSD(RefPos, Pos, Align = True)
-  dSq += ((RefPos - Pos)**2).sum(axis=1)
-  if N % 100 == 0: print "Analyzed %d frames" % N
+for Pos in t.IterChunks(rmsd.BlockSize):
+  N += len(Pos)
+  r = rmsd.RMSDMany(RefPos, Pos, Align = True)
+  dSq += ((RefPos - Pos)**2).sum(axis=2).sum(axis=0)
+  print "Analyzed %d frames" % N
 dSq = dSq/N
 dSq = sqrt(dSq)
-print "Analyzed %d frames" % N
 
 #s = "FLUCTUATION RESULTS\n"
 #s += "atom number, root-mean-square fluctuation\n"
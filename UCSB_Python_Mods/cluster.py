@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-#LAST MODIFIED: 01-26-09
+#LAST MODIFIED: 10-18-26
 
 Usage = """Runs clustering on pdb files in a directory or on an amber trajectory.
 Produces clustresults.txt, clust####.txt, and clust####.pdb files."
@@ -9,7 +9,7 @@ Usage     : cluster.py PDBFILES [OPTIONS]
    OR     : cluster.py TRJFILE PRMTOPFILE [OPTIONS]
 
 PDBFILES  : list of pdb files
-TRJFILE   : trajectory CRD file (can be gzipped)
+TRJFILE   : trajectory CRD file (can be gzipped) or NetCDF file
 PRMTOPFILE: PARM7 file
 OPTIONS   : "--rmsd=X" to set the rmsd tolerance (default 2.0)
             "--nskip=X" number of configs in trajectory to skip (default is 0)
@@ -24,6 +24,10 @@ OPTIONS   : "--rmsd=X" to set the rmsd tolerance (default 2.0)
             "--prefix=X" to change the output prefix (default "clust")
             "--compres='1,3-5'" to use residues 1 and 3-5 to minimize RMSD
             "--calcres='1-5,9'" to calculate rmsd only for residues 1-5 and 9
+            "--nproc=X" number of processes comparing configs to clusters (default 1)
+            "--relaxed" to keep the parallel comparisons even if clusters move
+                        during an iteration; faster, but clusters may differ
+                        from a serial run
 """
 
 #check for instructions
@@ -53,6 +57,8 @@ if __name__ == '__main__':
   if MaxClusterWork == 0: MaxClusterWork = None
   RmsdTol = float(Args.get("rmsd", 2.0))
   Prefix = Args.get("prefix", "clust")
+  NProc = int(Args.get("nproc", 1))
+  Relaxed = "relaxed" in Args["FLAGS"]
   CompResInd = scripttools.GetNumList(Args.get("compres", None), Offset = -1)
   CalcResInd = scripttools.GetNumList(Args.get("calcres", None), Offset = -1)
 
@@ -75,7 +81,7 @@ if __name__ == '__main__':
   else:
     Mode = 1
     TrjFile, PrmtopFile = Args[1], Args[2]
-    cobj = coords.TrjClass(TrjFile, PrmtopFile, Mask = Mask,
+    cobj = coords.OpenTrj(TrjFile, PrmtopFile, Mask = Mask,
                            NRead = NRead, NSkip = NSkip, NStride = NStride)
 
   #examine any residue specific masks
@@ -86,7 +92,7 @@ if __name__ == '__main__':
   #run the cluster algorithm
   Pos, ClustNum, ClustWeights, ClustPop, ConfRmsd, ClustRmsd = rmsd.ClusterMSS(cobj,
     RmsdTol, MaxIter = MaxIter, MaxCluster = MaxCluster, MaxClusterWork = MaxClusterWork,
-    Method = 0, CompInd = CompInd, CalcInd = CalcInd)
+    Method = 0, CompInd = CompInd, CalcInd = CalcInd, NProc = NProc, Relaxed = Relaxed)
   Indices = cobj.GetIndices()
 
   if Mode == 0:
@@ -1,12 +1,24 @@
 #!/usr/bin/env python
 
-#LAST MODIFIED: 10-29-08
+#LAST MODIFIED: 10-18-26
 
 #DESCRIPTION: Provides reading and writing routines for popular
 #coordinate file formats.  Currently: pdb and amber trajectory.
 
 from numpy import *
-import copy, os, gzip, pdbtools
+import sys, copy, os, re, zlib, gzip, pdbtools, gzindex, threading, Queue
+
+#try to load a NetCDF reader; Scientific is used elsewhere in these
+#scripts, and scipy's pure python reader is the fallback
+try:
+  from Scientific.IO.NetCDF import NetCDFFile
+  NetCDFMthd = lambda fn: NetCDFFile(fn, "r")
+except ImportError:
+  try:
+    from scipy.io.netcdf import netcdf_file
+    NetCDFMthd = lambda fn: netcdf_file(fn, "r", mmap = True)
+  except ImportError:
+    NetCDFMthd = None
 
 #Masks for backbone atoms
 NoMask = []
@@ -33,14 +45,20 @@ def GetPdbCoords(PdbFile, Mask = NoMask):
   "Gets coordinates from a Pdb file."
   if os.path.isfile(PdbFile):
     f = open(PdbFile, "rU")
-    Pos = []
-    while True:
-      s = f.readline()
-      if len(s) == 0: break
-      if s[0:4] == "ATOM" and (s[13:15].strip() in Mask or Mask == NoMask):
-        Pos.append([float(s[30:38]),float(s[38:46]), float(s[46:54])])
+    Lines = f.read().split("\n")
     f.close()
-    return array(Pos,float)
+    if Mask == NoMask:
+      Cols = [s[30:54] for s in Lines if s[0:4] == "ATOM"]
+    else:
+      Cols = [s[30:54] for s in Lines if s[0:4] == "ATOM" and s[13:15].strip() in Mask]
+    if len(Cols) == 0:
+      return array([], float)
+    elif min([len(c) for c in Cols]) == 24:
+      #parse all of the coordinate columns at once
+      return ParseFixedWidth("".join(Cols), 8).reshape((-1,3))
+    else:
+      return array([[float(c[0:8]), float(c[8:16]), float(c[16:24])]
+                    for c in Cols], float)
   else:
     raise IOError, "Pdb file does not exist."
 
@@ -97,66 +115,386 @@ def SavePdbCoordsObj(Pos, CoordsObj, PdbFile, Mask = NoMask, Standardize = True)
   SavePdbCoords(Pos, CoordsObj.AtomNames, CoordsObj.AtomRes,
                 CoordsObj.Seq, PdbFile, Mask = Mask, Standardize = Standardize)
 
+def ParseFixedWidth(s, Width):
+  """Parses a text string of fixed-width numeric fields into a float
+array, ignoring line breaks.  The conversion is done by numpy in a
+single call rather than one float() per field."""
+  vals = s.replace("\n","")
+  r = len(vals) % Width
+  if r > 0: vals = vals + " " * (Width - r)
+  return frombuffer(vals, dtype = "S%d" % Width).astype(float)
+
+
+def IsNoMask(Mask):
+  "Returns True if Mask selects all atoms."
+  return Mask is None or (not isinstance(Mask, ndarray) and len(Mask) == 0)
+
+
+def MaskInd(AtomNames, Mask):
+  """Returns an index array of the atoms in AtomNames passing Mask,
+or None if no mask is used.  Mask is a list of atom names or an index
+array; Amber mask strings must first be compiled with ResolveMask."""
+  if IsNoMask(Mask): return None
+  if isinstance(Mask, ndarray): return Mask
+  if isinstance(Mask, str):
+    raise ValueError, "Amber mask %s needs a topology to compile." % Mask
+  return array([i for (i, a) in enumerate(AtomNames) if a.strip() in Mask], int)
+
+
+def ResolveMask(Mask, PrmtopFile):
+  """Returns an index array for an Amber mask string compiled (and
+cached) against a prmtop file; other masks are returned unchanged."""
+  if Mask is None: return NoMask
+  if isinstance(Mask, str):
+    import ambermask
+    return ambermask.GetMaskInd(PrmtopFile, Mask)
+  return Mask
+
+
 def ParseCrdString(s, AtomNames = [], Mask = NoMask):
   """Takes a text string of Crd coordinates and parses into an array."""
   #parse into a n by 3 array
   try:
-    vals = s.replace("\n","")
-    vals = [float(vals[i:i+8]) for i in range(0, len(vals), 8)]
-    Pos = array(vals, float)
+    Pos = ParseFixedWidth(s, 8)
   except ValueError:
     raise ValueError, "Improper number of coordinates found in Crd string."
   if mod(len(Pos), 3) == 0:
     Pos = reshape(Pos, (-1,3))
     #if using mask remove the extraneous coordinates
-    if not Mask == NoMask and len(AtomNames) == len(Pos):
-      Pos = compress([a.strip() in Mask for a in AtomNames], Pos, 0)
+    if not IsNoMask(Mask) and len(AtomNames) == len(Pos):
+      Pos = Pos.take(MaskInd(AtomNames, Mask), axis=0)
     return Pos
   else:
     raise ValueError, "Improper number of coordinates found in Crd string."
 
 
+def ParseCrdFrames(s, NAtom, AtomNames = [], Mask = NoMask):
+  """Takes a text string holding one or more consecutive Crd frames
+and parses it into an array of dimensions [NFrame,NAtom,3]."""
+  try:
+    Pos = ParseFixedWidth(s, 8)
+  except ValueError:
+    raise ValueError, "Improper number of coordinates found in Crd string."
+  if NAtom <= 0 or not mod(len(Pos), 3 * NAtom) == 0:
+    raise ValueError, "Improper number of coordinates found in Crd string."
+  Pos = reshape(Pos, (-1, NAtom, 3))
+  if not IsNoMask(Mask) and len(AtomNames) == NAtom:
+    Pos = Pos.take(MaskInd(AtomNames, Mask), axis=1)
+  return Pos
+
+
 def ParseRstString(s, AtomNames = [], Mask = NoMask):
   """Takes a text string of Rst coordinates and parses into an array;
 Note that this will return velocities as well."""
   #parse into a n by 3 array
   try:
-    vals = s.replace("\n","")
-    vals = [float(vals[i:i+12]) for i in range(0, len(vals), 12)]
-    Pos = array(vals, float)
+    Pos = ParseFixedWidth(s, 12)
   except ValueError:
     raise ValueError, "Improper number of coordinates found in Crd string."
   if mod(len(Pos), 3) == 0:
     Pos = reshape(Pos, (-1,3))
     #if using mask remove the extraneous coordinates
-    if not Mask == NoMask and len(AtomNames) == len(Pos):
-      Pos = compress([a.strip() in Mask for a in AtomNames], Pos, 0)
+    if not IsNoMask(Mask) and len(AtomNames) == len(Pos):
+      Pos = Pos.take(MaskInd(AtomNames, Mask), axis=0)
     return Pos
   else:
     raise IOError, "Improper number of coordinates found in Rst file."
 
 
-def GetPrmtopBlock(PrmtopFile, Flag, BlockLen = None):
-  "Gets Prmtop data for a specified Flag."
-  if os.path.isfile(PrmtopFile):
-    f = open(PrmtopFile, "rU")
-    Dat = []
-    line = f.readline()
-    while len(line) > 0 and not line.startswith(Flag):
-      line = f.readline()
-    f.readline()
-    line = f.readline()
-    while len(line) > 0 and not line[0:1] == "%":
-      if BlockLen is None:
-        Dat.extend(line.split())
+class Prmtop:
+  """Holds the sections of a prmtop file, read in a single pass or
+loaded from a binary snapshot (see SavePrmtopSnapshot)."""
+
+  def __init__(self, PrmtopFile, SnapshotFile = None):
+    """Reads a prmtop file.
+* PrmtopFile: string name of prmtop file
+* SnapshotFile: if given, a snapshot file to load instead of parsing"""
+    self.PrmtopFile = PrmtopFile
+    #the file is kept as the text before the first % line (Pre), the
+    #% lines (Heads), and the text following each % line, which is
+    #either kept as is or rebuilt from a typed array on demand
+    self.__Text = {}
+    self.__Typed = {}
+    self.__Specs = {}
+    if SnapshotFile is None:
+      if not os.path.isfile(PrmtopFile):
+        raise IOError, "Could not find Prmtop file."
+      f = open(PrmtopFile, "rb")
+      s = f.read()
+      f.close()
+      #treat the file as GetPrmtopBlock always did, with universal newlines
+      self.Exact = not "\r" in s
+      if not self.Exact: s = s.replace("\r\n", "\n").replace("\r", "\n")
+      Lines = s.splitlines(True)
+      HeadInd = [i for (i, l) in enumerate(Lines) if l[0:1] == "%"]
+      self.Heads = [Lines[i] for i in HeadInd]
+      self.Pre = "".join(Lines[:HeadInd[0]]) if HeadInd else s
+      for (j, i) in enumerate(HeadInd):
+        Stop = (HeadInd[j+1:] + [len(Lines)])[0]
+        self.__Text[j] = "".join(Lines[i+1:Stop])
+    else:
+      d = load(SnapshotFile)
+      self.Exact = True
+      self.Pre = str(d["pre"].item())
+      self.Heads = [str(x) for x in d["heads"]]
+      for j in range(len(self.Heads)):
+        if "raw%d" % j in d:
+          self.__Text[j] = str(d["raw%d" % j].item())
+        elif "data%d" % j in d:
+          self.__Typed[j] = d["data%d" % j]
+          self.__Specs[j] = (str(d["spec%d" % j].item()), int(d["count%d" % j]))
+        else:
+          self.__Text[j] = ""
+      d.close()
+    #find the flags and their formats
+    self.Flags = []
+    self.Formats = {}
+    self.__FlagInd = {}
+    for (j, l) in enumerate(self.Heads):
+      if l.startswith("%FLAG"):
+        Flag = l[5:].strip()
+        if Flag in self.__FlagInd: continue
+        self.Flags.append(Flag)
+        self.__FlagInd[Flag] = j
+        if j + 1 < len(self.Heads) and self.__PieceText(j) == "" \
+           and self.Heads[j+1].startswith("%FORMAT"):
+          self.Formats[Flag] = self.Heads[j+1][7:].strip().strip("()")
+    self.__Blocks = {}
+    self.__Arrays = {}
+
+  def __PieceText(self, j):
+    """Returns the text following % line j, formatting it from its
+typed array if needed."""
+    if not j in self.__Text:
+      self.__Text[j] = FormatPrmtopData(self.__Typed[j], *self.__Specs[j])
+    return self.__Text[j]
+
+  def Text(self):
+    "Returns the full text of the prmtop file."
+    return self.Pre + "".join([h + self.__PieceText(j)
+                               for (j, h) in enumerate(self.Heads)])
+
+  def Write(self, FileName):
+    "Writes the prmtop file out to FileName."
+    f = open(FileName, "wb")
+    f.write(self.Pre)
+    for (j, h) in enumerate(self.Heads):
+      f.write(h)
+      f.write(self.__PieceText(j))
+    f.close()
+
+  def __DataLines(self, Flag):
+    """Returns the data lines following the first line that starts
+with Flag, skipping the format line."""
+    Ind = [j for (j, h) in enumerate(self.Heads) if h.startswith(Flag)]
+    if len(Ind) == 0:
+      if Flag.startswith("%"): return []
+      #not a section header; search the whole file
+      Lines = self.Text().splitlines(True)
+      Ind = [i for (i, l) in enumerate(Lines) if l.startswith(Flag)]
+      if len(Ind) == 0: return []
+      Stop = [i for (i, l) in enumerate(Lines)
+              if i >= Ind[0] + 2 and l[0:1] == "%"] + [len(Lines)]
+      return Lines[Ind[0]+2:Stop[0]]
+    j = Ind[0]
+    Lines = self.__PieceText(j).splitlines(True)
+    if len(Lines) > 0:
+      return Lines[1:]
+    elif j + 1 < len(self.Heads):
+      return self.__PieceText(j+1).splitlines(True)
+    else:
+      return []
+
+  def GetBlock(self, Flag, BlockLen = None):
+    """Returns a new list of the data for a section header, eg "%FLAG
+ATOM_NAME", split by whitespace or into fields of BlockLen characters."""
+    Key = (Flag, BlockLen)
+    if not Key in self.__Blocks:
+      Dat = []
+      for line in self.__DataLines(Flag):
+        if BlockLen is None:
+          Dat.extend(line.split())
+        else:
+          Dat.extend([line[i:i+BlockLen] for i in xrange(0,len(line)-1,BlockLen)])
+      self.__Blocks[Key] = Dat
+    return list(self.__Blocks[Key])
+
+  def __ParseFormat(self, Flag):
+    """Returns the type letter, count per line, and width of a flag's
+format, or None if it isn't a simple format."""
+    m = re.match(r"(\d*)([aAiIeEfF])(\d+)(\.\d+)?", self.Formats.get(Flag, ""))
+    if m is None: return None
+    return m.group(2), int(m.group(1) or 1), int(m.group(3)), m.group(4) or ""
+
+  def GetArray(self, Flag):
+    """Returns the data for a flag name, eg "CHARGE", as a numpy array of
+the type given by its format: int, float, or string.  The array is shared
+by every user of this Prmtop, so it is read-only; copy it to change it."""
+    if not Flag in self.__Arrays:
+      j = self.__FlagInd.get(Flag)
+      if j is not None and j + 1 in self.__Typed:
+        Dat = self.__Typed[j+1]
       else:
-        Dat.extend([line[i:i+BlockLen] for i in xrange(0,len(line)-1,BlockLen)])
-      line = f.readline()
+        Fmt = self.__ParseFormat(Flag)
+        if Fmt is None:
+          raise KeyError, "Prmtop %s has no flag %s." % (self.PrmtopFile, Flag)
+        Type, Width = Fmt[0].upper(), Fmt[2]
+        s = "".join([l.rstrip("\n") for l in self.__DataLines("%FLAG " + Flag)])
+        if Type == "A":
+          r = len(s) % Width
+          if r > 0: s = s + " " * (Width - r)
+          Dat = frombuffer(s, dtype = "S%d" % Width).copy()
+        elif Type == "I":
+          Dat = ParseFixedWidth(s, Width).astype(int)
+        else:
+          Dat = ParseFixedWidth(s, Width)
+      Dat.flags.writeable = False
+      self.__Arrays[Flag] = Dat
+    return self.__Arrays[Flag]
+
+  def GetPointers(self):
+    "Returns the POINTERS section as an int array."
+    return self.GetArray("POINTERS")
+
+  def SaveSnapshot(self, SnapshotFile):
+    """Saves the prmtop to a binary snapshot file.  Sections are saved as
+typed arrays when they format back to exactly the original text, and as
+raw text otherwise, so the prmtop can always be rebuilt byte for byte."""
+    if not self.Exact:
+      raise ValueError, "Prmtop %s can't be saved exactly." % self.PrmtopFile
+    d = {"version" : array(PrmtopSnapshotVersion), "pre" : array(self.Pre),
+         "heads" : array(self.Heads, dtype = str)}
+    st = os.stat(self.PrmtopFile)
+    d["source"] = array(os.path.abspath(self.PrmtopFile))
+    d["stamp"] = array([st.st_size, st.st_mtime], float)
+    for (j, h) in enumerate(self.Heads):
+      Text = self.__PieceText(j)
+      if len(Text) == 0: continue
+      if j > 0 and h.startswith("%FORMAT") and self.Heads[j-1].startswith("%FLAG"):
+        Flag = self.Heads[j-1][5:].strip()
+        Fmt = self.__ParseFormat(Flag)
+        if not Fmt is None and self.__FlagInd.get(Flag) == j - 1:
+          Type, Count, Width, Prec = Fmt
+          if Type in "aA":
+            Spec = "%%-%ds" % Width
+          elif Type in "iI":
+            Spec = "%%%dd" % Width
+          else:
+            Spec = "%%%d%s%s" % (Width, Prec, Type)
+          try:
+            Dat = self.GetArray(Flag)
+            if FormatPrmtopData(Dat, Spec, Count) == Text:
+              d["data%d" % j] = Dat
+              d["spec%d" % j] = array(Spec)
+              d["count%d" % j] = array(Count)
+              continue
+          except (ValueError, TypeError):
+            pass
+      d["raw%d" % j] = array(Text)
+    f = open(SnapshotFile, "wb")
+    savez(f, **d)
     f.close()
-    return Dat
-  else:
+
+
+def FormatPrmtopData(Dat, Spec, Count):
+  """Formats an array of prmtop values with a printf Spec, Count values to
+a line, as in the prmtop FORMAT statements."""
+  n = len(Dat)
+  if n == 0: return ""
+  nLine, nLeft = divmod(n, Count)
+  Fmt = (Spec * Count + "\n") * nLine
+  if nLeft > 0: Fmt += Spec * nLeft + "\n"
+  return Fmt % tuple(Dat.tolist())
+
+
+#snapshots are off by default; when on (UsePrmtopSnapshots = True, or the
+#environment variable PRMTOP_SNAPSHOTS=1 for command-line tools) a binary
+#snapshot is saved next to each prmtop read, or in PrmtopSnapshotDir if the
+#prmtop's directory can't be written, and later reads load it instead
+UsePrmtopSnapshots = os.environ.get("PRMTOP_SNAPSHOTS", "0") == "1"
+PrmtopSnapshotExt = ".snap.npz"
+PrmtopSnapshotDir = os.path.join(os.path.expanduser("~"), ".prmtop_snapshots")
+PrmtopSnapshotVersion = 1
+
+def PrmtopSnapshotFiles(PrmtopFile):
+  """Returns the possible snapshot file names for a prmtop file, next to
+the file and in the snapshot directory."""
+  Path = os.path.abspath(PrmtopFile)
+  Name = os.path.basename(Path) + "." + "%08x" % (zlib.crc32(Path) & 0xffffffff)
+  return [Path + PrmtopSnapshotExt,
+          os.path.join(PrmtopSnapshotDir, Name + PrmtopSnapshotExt)]
+
+def LoadPrmtopSnapshot(PrmtopFile):
+  """Returns a Prmtop object loaded from a current snapshot of PrmtopFile,
+or None if there isn't one."""
+  Path = os.path.abspath(PrmtopFile)
+  st = os.stat(PrmtopFile)
+  for fn in PrmtopSnapshotFiles(PrmtopFile):
+    if not os.path.isfile(fn): continue
+    try:
+      d = load(fn)
+      Current = int(d["version"]) == PrmtopSnapshotVersion \
+                and str(d["source"].item()) == Path \
+                and tuple(d["stamp"]) == (st.st_size, float(st.st_mtime))
+      d.close()
+      if Current: return Prmtop(PrmtopFile, SnapshotFile = fn)
+    except Exception:
+      pass
+  return None
+
+def SavePrmtopSnapshot(Prm):
+  """Saves a snapshot of a Prmtop object next to its file or in the
+snapshot directory.  Returns the snapshot file name, or None if it could
+not be written."""
+  for fn in PrmtopSnapshotFiles(Prm.PrmtopFile):
+    Tmp = fn + ".%d.tmp" % os.getpid()
+    try:
+      if not os.path.isdir(os.path.dirname(fn)): os.makedirs(os.path.dirname(fn))
+      Prm.SaveSnapshot(Tmp)
+      os.rename(Tmp, fn)
+      return fn
+    except (IOError, OSError):
+      if os.path.isfile(Tmp): os.remove(Tmp)
+  return None
+
+
+#cache of Prmtop objects by path; each is reused while the file's
+#(size, mtime) stays the same, and the least recently used is dropped
+#once there are more than PrmtopCacheSize
+PrmtopCache = {}
+PrmtopCacheOrder = []
+PrmtopCacheSize = 16
+
+def GetPrmtop(PrmtopFile):
+  """Returns a Prmtop object for a prmtop file, reusing a cached one if
+current.  Otherwise it is parsed; if UsePrmtopSnapshots is set, it is
+loaded from a current snapshot if there is one, or parsed and a snapshot
+saved."""
+  if not os.path.isfile(PrmtopFile):
     raise IOError, "Could not find Prmtop file."
-    return None
+  Key = os.path.abspath(PrmtopFile)
+  st = os.stat(PrmtopFile)
+  Stamp = (st.st_size, st.st_mtime)
+  if Key in PrmtopCache:
+    PrmtopCacheOrder.remove(Key)
+    if PrmtopCache[Key][0] == Stamp:
+      PrmtopCacheOrder.append(Key)
+      return PrmtopCache[Key][1]
+    del PrmtopCache[Key]
+  Prm = None
+  if UsePrmtopSnapshots: Prm = LoadPrmtopSnapshot(PrmtopFile)
+  if Prm is None:
+    Prm = Prmtop(PrmtopFile)
+    if UsePrmtopSnapshots and Prm.Exact: SavePrmtopSnapshot(Prm)
+  PrmtopCache[Key] = (Stamp, Prm)
+  PrmtopCacheOrder.append(Key)
+  while len(PrmtopCacheOrder) > PrmtopCacheSize:
+    del PrmtopCache[PrmtopCacheOrder.pop(0)]
+  return Prm
+
+def GetPrmtopBlock(PrmtopFile, Flag, BlockLen = None):
+  "Gets Prmtop data for a specified Flag."
+  return GetPrmtop(PrmtopFile).GetBlock(Flag, BlockLen)
 
 def GetPrmtopAtomNames(PrmtopFile):
   "Gets the names of atoms from a Prmtop file."
@@ -178,16 +516,14 @@ def GetPrmtopAtomRes(PrmtopFile):
   ResPtr = GetPrmtopBlock(PrmtopFile, "%FLAG RESIDUE_POINTER", BlockLen = 8)
   if ResPtr is None: return None
   AtomNames = GetPrmtopAtomNames(PrmtopFile)
-  ResPtr = [int(x) for x in ResPtr] + [len(AtomNames) + 1]
-  AtomRes = []
-  for i in range(0, len(ResPtr)-1):
-    AtomRes.extend([i] * (ResPtr[i+1] - ResPtr[i]))
-  return AtomRes
+  ResPtr = array([int(x) for x in ResPtr] + [len(AtomNames) + 1], int)
+  return repeat(arange(len(ResPtr)-1), clip(diff(ResPtr), 0, None)).tolist()
 
 
 def GetCrdCoords(CrdFile, PrmtopFile = "", Mask = NoMask):
   "Gets coordinates from a Crd and Prmtop set of files."
-  if len(Mask) > 0:
+  Mask = ResolveMask(Mask, PrmtopFile)
+  if not IsNoMask(Mask):
     AtomNames = GetPrmtopAtomNames(PrmtopFile)
     if AtomNames is None: return
   else:
@@ -203,23 +539,85 @@ def GetCrdCoords(CrdFile, PrmtopFile = "", Mask = NoMask):
     raise IOError, "Crd file not found."
 
 
+#number of values formatted at once by CrdWriter
+CrdWriterChunkVals = 1000000
+
+def FormatFrames(Pos, Fmt, NPerLine):
+  """Formats one [NAtom,3] or more [N,NAtom,3] frames of coordinates
+with NPerLine values per line, starting a new line for each frame."""
+  Pos = asarray(Pos, float)
+  if Pos.ndim < 3: Pos = Pos.reshape((1, -1))
+  NFrame = len(Pos)
+  NVal = Pos.size / max(NFrame, 1)
+  if NVal == 0: return ""
+  #the format string for one frame, repeated for the block
+  r = NVal % NPerLine
+  FrameFmt = ((Fmt * NPerLine + "\n") * (NVal / NPerLine))
+  if r > 0: FrameFmt += Fmt * r + "\n"
+  return (FrameFmt * NFrame) % tuple(Pos.ravel().tolist())
+
+
+class CrdWriter:
+  """Writes coordinates to an Amber crd trajectory file, keeping the file
+open between frames; each frame starts on a new line.  Restart files hold
+a single frame and are written by SaveRstCoords."""
+
+  def __init__(self, CrdFile, Mode = "wb", Head = True,
+               Title = "ACE", CompressLevel = None):
+    """Opens the trajectory file for writing.
+* CrdFile: string name of crd file
+* Mode: file mode; "ab" appends to an existing file
+* Head: True to write a title line
+* Title: title line text
+* CompressLevel: None for a plain file, or a gzip compression level
+  from 1 to 9 to write gzipped output"""
+    self.CrdFile = CrdFile
+    self.__f = None
+    if CompressLevel is None:
+      self.__f = open(CrdFile, Mode)
+    else:
+      self.__f = gzip.GzipFile(CrdFile, Mode, CompressLevel)
+    if Head: self.__f.write(Title.ljust(80)[:80] + "\n")
+    self.NAtom = None
+    self.NFrame = 0
+
+  def Write(self, Pos):
+    """Writes a frame [NAtom,3] or block of frames [N,NAtom,3]; blocks are
+formatted ChunkVals values at a time."""
+    Pos = asarray(Pos, float)
+    if Pos.ndim < 3: Pos = Pos.reshape((1, -1, 3))
+    if self.NAtom is None:
+      self.NAtom = Pos.shape[1]
+    elif not Pos.shape[1] == self.NAtom:
+      raise ValueError, "Expected %d atoms but got %d." % (self.NAtom, Pos.shape[1])
+    n = max(CrdWriterChunkVals / max(3 * self.NAtom, 1), 1)
+    for i in xrange(0, len(Pos), n):
+      self.__f.write(FormatFrames(Pos[i:i+n], "%8.3f", 10))
+    self.NFrame += len(Pos)
+
+  def Close(self):
+    "Closes the file."
+    if not self.__f is None:
+      self.__f.close()
+      self.__f = None
+
+  def __del__(self):
+    self.Close()
+
+
 def SaveCrdCoords(Pos, CrdFile, Mode = "wb", Head = True):
-  "Saves coordinates to a Crd file."
-  NPerLine = 10
-  Fmt = "%8.3f"
+  """Saves coordinates to a Crd file as one run of values, ten per line,
+without line breaks between frames; use CrdWriter for per-frame layout."""
   f = open(CrdFile, Mode)
   if Head: f.write("ACE".ljust(80) + "\n")
-  p = [Fmt % x for x in Pos.flat]
-  r = mod(len(p),NPerLine)
-  if r > 0: p.extend([""]*(NPerLine-r))
-  for i in xrange(0, len(p), NPerLine):
-    f.write("".join(p[i:i+NPerLine]) + "\n")
+  f.write(FormatFrames(asarray(Pos, float).ravel(), "%8.3f", 10))
   f.close()
 
 
 def GetRstCoords(RstFile, PrmtopFile = "", Mask = NoMask):
   "Gets coordinates from an amber restart file."
-  if len(Mask) > 0:
+  Mask = ResolveMask(Mask, PrmtopFile)
+  if not IsNoMask(Mask):
     AtomNames = GetPrmtopAtomNames(PrmtopFile)
     if AtomNames is None: return
   else:
@@ -242,11 +640,7 @@ def SaveRstCoords(Pos, RstFile):
   f = open(RstFile, "w")
   f.write("ACE".ljust(80) + "\n")
   f.write("%5d  0.0000000E+00\n" % len(Pos))
-  p = [Fmt % x for x in Pos.flat]
-  r = mod(len(p),NPerLine)
-  if r > 0: p.extend([""]*(NPerLine-r))
-  for i in xrange(0, len(p), NPerLine):
-    f.write("".join(p[i:i+NPerLine]) + "\n")
+  f.write(FormatFrames(Pos, Fmt, NPerLine))
   f.close()  
   
 
@@ -283,28 +677,28 @@ def SavePdbCoordsAmb2(Pos, PrmtopFile, PdbFile, AAtm = False, BRes = False):
   AmbToPdb("rst.tmp", PrmtopFile, PdbFile, AAtm, BRes)
   os.remove("rst.tmp")
 
-def PdbsToCrd(PdbFileList, CrdFile):
-  """Saves multiple pdb files as a crd file"""
-  NPerLine = 10
-  Fmt = "%8.3f"
+def PdbsToCrd(PdbFileList, CrdFile, CompressLevel = None):
+  """Saves multiple pdb files as a crd file, gzipped with the given
+compression level (1 to 9) if CompressLevel is not None."""
   NAtom = -1
-  f = open(CrdFile, "w")
-  f.write("ACE".ljust(80) + "\n")
-  for fn in PdbFileList:
-    Pos = GetPdbCoords(fn)
-    if NAtom < 0:
-      NAtom = len(Pos)
-    elif not len(Pos) == NAtom:
-      f.close()
-      raise IOError, "Pdb files do not have same number of atoms."      
-    p = [Fmt % x for x in Pos.flat]
-    r = mod(len(p),NPerLine)
-    if r > 0: p.extend([""]*(NPerLine-r))
-    for i in xrange(0, len(p), NPerLine):
-      f.write("".join(p[i:i+NPerLine]) + "\n")
-  f.close()
-    
-  
+  w = CrdWriter(CrdFile, CompressLevel = CompressLevel)
+  try:
+    #frames are written a block at a time
+    Block = []
+    for fn in PdbFileList:
+      Pos = GetPdbCoords(fn)
+      if NAtom < 0:
+        NAtom = len(Pos)
+      elif not len(Pos) == NAtom:
+        raise IOError, "Pdb files do not have same number of atoms."      
+      Block.append(Pos)
+      if len(Block) * NAtom * 3 >= CrdWriterChunkVals:
+        w.Write(array(Block))
+        Block = []
+    if len(Block) > 0: w.Write(array(Block))
+  finally:
+    w.Close()
+
 
 def GetTrjLenOld(TrjFile, PrmtopFile):
   "Gets the number of frames in a trajectory."
@@ -338,7 +732,7 @@ def GetTrjLen(TrjFile, PrmtopFile):
   if r > 0: NLine += 1
   #use gzip?
   if TrjFile.strip().lower().endswith("gz"):
-    FileMthd = gzip.GzipFile
+    FileMthd = gzindex.GzipIndexFile
   else:
     FileMthd = file
   #open the trj file
@@ -353,20 +747,12 @@ def GetTrjLen(TrjFile, PrmtopFile):
   BytesCoords = 0
   for i in range(NLine):
     BytesCoords += len(Trj.readline())
-  #unfortunately for gzip files, we can't seek to end, so we need to
-  #do this bit to get the total size:
-  Trj.seek(0)
-  BytesTot = 0
-  #try to catch errors in the gzipped file; stride 1024 bytes
-  try:
-    while len(Trj.read(1024)) > 0: pass
-  except IOError:
-    #find the exact byte number
-    try:
-      while len(Trj.read(1)) > 0: pass
-    except IOError:
-      pass
-  BytesTot = max(Trj.tell(), 0)
+  #get the total size; the gzip index finds it in one pass and
+  #remembers it for later runs
+  if FileMthd is file:
+    BytesTot = os.path.getsize(TrjFile)
+  else:
+    BytesTot = Trj.Size()
   #return the total number of configs
   Trj.close()
   del Trj
@@ -378,15 +764,18 @@ class TrjClass:
   
   def __init__(self, TrjFile, PrmtopFile, Mask = NoMask,
                NSkip = 0, NRead = None, NStride = 1,
-               LinkPos = None):
+               LinkPos = None, Prefetch = 0):
     """Initializes the class and opens the trajectory file for reading.
 * TrjFile: string name of trj file
 * PrmtopFile: string name of prmtop file
-* Mask: list of strings; filter for atom names (default is no mask/empty list)
+* Mask: list of strings; filter for atom names (default is no mask/empty list),
+  or an index array or Amber mask string (eg, ":1-20@CA,C,N")
 * NSkip: number of configurations to skip
 * NRead: maximum number of configurations to read (default is all)
 * NStride: stride between configuration frames (default is 1)
-* LinkPos: an outside array that is updated automatically as Pos are read"""
+* LinkPos: an outside array that is updated automatically as Pos are read
+* Prefetch: number of frames a background thread reads and parses ahead
+  of sequential access (default is 0, no prefetching)"""
     IsFile1, IsFile2 = os.path.isfile(PrmtopFile), os.path.isfile(TrjFile)
     if IsFile1 and IsFile2:
       #set the filenames
@@ -410,12 +799,17 @@ class TrjClass:
       self.Index = -1
       self.SliceIndex = -1
       #set the mask option
-      self.Mask = Mask
-      if self.Mask is None: self.Mask = NoMask
+      self.Mask = ResolveMask(Mask, PrmtopFile)
       #set the linked pos
       self.LinkPos = LinkPos
+      #prefetching is turned on after initialization
+      self.Prefetch = 0
+      self.__Thread = None
+      #guards seeks and reads shared with the prefetch thread
+      self.__TrjLock = threading.Lock()
       #initialize everything
       self.__Init()
+      self.Prefetch = max(Prefetch, 0)
     else:
       if not IsFile2:
         raise IOError, "Could not find %s." % TrjFile
@@ -424,6 +818,7 @@ class TrjClass:
 
   def Reset(self):
     "Resets current configuration to trajectory start."
+    self.__StopPrefetch()
     if not self.__Trj is None:
       #skip to the right configuration
       self.__Trj.seek(self.BytesHead + self.NSkip * self.BytesCoords)
@@ -442,10 +837,78 @@ class TrjClass:
       
   def Close(self):
     "Closes any open files."
+    self.__StopPrefetch()
     if self.__Trj is not None:
       self.__Trj.close()
       self.__Trj = None
 
+  def __StartPrefetch(self, ind):
+    """Starts a background thread reading frames from slice index ind."""
+    self.__StopPrefetch()
+    self.__Queue = Queue.Queue(self.Prefetch)
+    self.__Stop = threading.Event()
+    self.__NextInd = ind
+    #the thread reads through this object's file, which keeps any gzip
+    #checkpoints from one prefetch run to the next
+    self.__Open()
+    self.__Thread = threading.Thread(target = self.__PrefetchLoop,
+                                     args = (ind, self.__Queue, self.__Stop))
+    self.__Thread.setDaemon(True)
+    self.__Thread.start()
+
+  def __StopPrefetch(self):
+    """Stops any background prefetch thread."""
+    if self.__Thread is None: return
+    self.__Stop.set()
+    #empty the queue so the thread isn't left waiting to put
+    while True:
+      try:
+        self.__Queue.get_nowait()
+      except Queue.Empty:
+        break
+    self.__Thread.join()
+    self.__Thread = None
+
+  def __PrefetchLoop(self, ind, q, Stop):
+    """Reads and parses frames into queue q until the end of the
+slice or until Stop is set; runs in the prefetch thread.  Errors are
+passed on as (-1, sys.exc_info())."""
+    def Put(Item):
+      while not Stop.isSet():
+        try:
+          q.put(Item, True, 0.1)
+          return True
+        except Queue.Full:
+          pass
+      return False
+    f = self.__Trj
+    try:
+      for i in xrange(ind, self.SliceNCoords):
+        if Stop.isSet(): break
+        self.__TrjLock.acquire()
+        try:
+          f.seek(self.BytesHead + self.BytesCoords*(self.NSkip + self.NStride*i))
+          s = f.read(self.BytesCoords)
+        finally:
+          self.__TrjLock.release()
+        if len(s) < self.BytesCoords:
+          raise IOError, "Could not read frame %d of trajectory." % i
+        if not Put((i, ParseCrdString(s, self.AtomNames, self.__MaskInd))): break
+    except Exception:
+      Put((-1, sys.exc_info()))
+
+  def __GetPrefetched(self, ind):
+    """Returns the frame at slice index ind from the prefetch thread."""
+    if self.__Thread is None or not self.__NextInd == ind:
+      self.__StartPrefetch(ind)
+    i, Pos = self.__Queue.get()
+    if i < 0:
+      #re-raise the thread's error with its traceback
+      self.__StopPrefetch()
+      raise Pos[0], Pos[1], Pos[2]
+    self.__NextInd = i + 1
+    return Pos
+
   def __Init(self):
     """Initializes internal variables from disk data."""
     #get the atom names, seq, and residue nums
@@ -457,9 +920,10 @@ class TrjClass:
       return
     self.AtomRes = GetPrmtopAtomRes(self.PrmtopFile)
     self.Seq = GetPrmtopSeq(self.PrmtopFile)
+    self.__MaskInd = MaskInd(self.AtomNames, self.Mask)
     #set the file method
     if self.TrjFile.split(".")[-1].strip().lower() == "gz":
-      self.__FileMthd = gzip.GzipFile
+      self.__FileMthd = gzindex.GzipIndexFile
       self.Gzip = True
     else:
       self.__FileMthd = open
@@ -494,14 +958,8 @@ class TrjClass:
     for i in range(0, self.__NLine):
       self.BytesCoords += len(self.__Trj.readline())
     if self.Gzip:
-      #unfortunately for gzip files, we need to do this bit to get the total size:
-      self.__Trj.seek(0)
-      self.BytesTot = 0
-      Incr = os.path.getsize(self.TrjFile)
-      while self.BytesTot == self.__Trj.tell():
-        self.BytesTot += Incr
-        self.__Trj.seek(self.BytesTot)
-      self.BytesTot = max(self.__Trj.tell(), 0)
+      #the gzip index knows the total size, or finds it in one pass
+      self.BytesTot = self.__Trj.Size()
     else:
       self.BytesTot = os.path.getsize(self.TrjFile)
     if 1==2: 
@@ -537,7 +995,14 @@ class TrjClass:
     #check bounds
     if ind < 0 or ind >= self.SliceNCoords:
       raise IndexError, "Index out of bounds for trj class."
+    elif self.Prefetch > 0 and Mask is self.Mask and ind == self.SliceIndex + 1:
+      #sequential reads come from the prefetch thread
+      self.Pos = self.__GetPrefetched(ind)
+      self.SliceIndex = ind
+      self.Index = self.NSkip + self.NStride * ind
     else:
+      #random access stops any prefetching
+      self.__StopPrefetch()
       #make sure we're open
       self.__Open()
       #calculate the absolute index
@@ -552,10 +1017,14 @@ class TrjClass:
         raise IOError
         return
       #parse the crd string
+      if Mask is self.Mask:
+        Mask = self.__MaskInd
+      else:
+        Mask = ResolveMask(Mask, self.PrmtopFile)
       self.Pos = ParseCrdString(s, self.AtomNames, Mask)
-      #update a linked coord array
-      if not self.LinkPos is None: self.LinkPos[:,:] = self.Pos
-      return self.Pos
+    #update a linked coord array
+    if not self.LinkPos is None: self.LinkPos[:,:] = self.Pos
+    return self.Pos
 
   def __getitem__(self, ind):
     return self.Get(ind)
@@ -590,6 +1059,320 @@ class TrjClass:
     "Returns the configuration indices of all read in so far."
     return range(self.NSkip, self.NCoords, self.NStride)
 
+  def IterChunks(self, NFrames, Mask = None):
+    """Iterates over the trajectory in chunks of up to NFrames frames,
+yielding arrays of dimensions [n,NAtomSelected,3].  The atom selection
+is computed once and the output array is reused between chunks, so
+copy a chunk if it needs to be kept.  Does not change the position
+of GetNextCoords iteration or update LinkPos."""
+    if Mask is None: Mask = self.Mask
+    NFrames = max(int(NFrames), 1)
+    if Mask is self.Mask:
+      Ind = self.__MaskInd
+    else:
+      Ind = MaskInd(self.AtomNames, ResolveMask(Mask, self.PrmtopFile))
+    if Ind is None:
+      NSel = self.NAtom
+    else:
+      NSel = len(Ind)
+    Buf = zeros((NFrames, NSel, 3), float)
+    self.__Open()
+    for Start in xrange(0, self.SliceNCoords, NFrames):
+      n = min(NFrames, self.SliceNCoords - Start)
+      Index = self.NSkip + self.NStride * Start
+      self.__TrjLock.acquire()
+      try:
+        if self.NStride == 1:
+          #consecutive frames come off the disk in one read
+          self.__Trj.seek(self.BytesHead + self.BytesCoords*Index)
+          s = self.__Trj.read(self.BytesCoords * n)
+        else:
+          l = []
+          for i in xrange(n):
+            self.__Trj.seek(self.BytesHead + self.BytesCoords*(Index + self.NStride*i))
+            l.append(self.__Trj.read(self.BytesCoords))
+          s = "".join(l)
+      finally:
+        self.__TrjLock.release()
+      if len(s) < self.BytesCoords * n:
+        raise IOError, "Could not read %d frames from trajectory." % n
+      Pos = ParseCrdFrames(s, self.NAtom)
+      if Ind is None:
+        Buf[:n] = Pos
+      else:
+        Buf[:n] = Pos.take(Ind, axis=1)
+      yield Buf[:n]
+
+
+class NetCDFTrjClass:
+  "Provides a class for reading successive sets of coordinates from Amber NetCDF trajectory files."
+
+  def __init__(self, TrjFile, PrmtopFile, Mask = NoMask,
+               NSkip = 0, NRead = None, NStride = 1,
+               LinkPos = None, NBuffer = 100):
+    """Initializes the class and opens the trajectory file for reading.
+* TrjFile: string name of NetCDF trj file
+* PrmtopFile: string name of prmtop file
+* Mask: list of strings; filter for atom names (default is no mask/empty list),
+  or an index array or Amber mask string (eg, ":1-20@CA,C,N")
+* NSkip: number of configurations to skip
+* NRead: maximum number of configurations to read (default is all)
+* NStride: stride between configuration frames (default is 1)
+* LinkPos: an outside array that is updated automatically as Pos are read
+* NBuffer: number of frames read at once during sequential access"""
+    if NetCDFMthd is None:
+      raise ImportError, "Could not find a NetCDF library (Scientific or scipy)."
+    IsFile1, IsFile2 = os.path.isfile(PrmtopFile), os.path.isfile(TrjFile)
+    if IsFile1 and IsFile2:
+      #set the filenames
+      self.TrjFile = TrjFile
+      self.PrmtopFile = PrmtopFile
+      #set the frames to skip, read, and stride
+      if NSkip < 0:
+        raise ValueError, "NSkip is less than zero."
+      self.NSkip = NSkip
+      self.NRead = NRead
+      self.NStride = max(NStride, 1)
+      if self.NRead < 0: self.NRead = None
+      self.NBuffer = max(NBuffer, 1)
+      self.NCoords = 0
+      self.SliceNCoords = 0
+      #set the counters
+      self.Count = 0
+      self.Index = -1
+      self.SliceIndex = -1
+      #set the mask option
+      self.Mask = ResolveMask(Mask, PrmtopFile)
+      #set the linked pos
+      self.LinkPos = LinkPos
+      #initialize everything
+      self.__Init()
+    else:
+      if not IsFile2:
+        raise IOError, "Could not find %s." % TrjFile
+      if not IsFile1:
+        raise IOError, "Could not find %s." % PrmtopFile
+
+  def Reset(self):
+    "Resets current configuration to trajectory start."
+    self.Index, self.SliceIndex = -1, -1
+    self.Count = 0
+
+  def __Open(self):
+    """Opens the trajectory file for reading"""
+    if self.__Trj is None:
+      try:
+        self.__Trj = NetCDFMthd(self.TrjFile)
+      except IOError:
+        raise IOError, "There was an error opening the trajectory file."
+
+  def Close(self):
+    "Closes any open files."
+    self.__Buf, self.__BufStart = None, -1
+    if self.__Trj is not None:
+      self.__Trj.close()
+      self.__Trj = None
+
+  def __Init(self):
+    """Initializes internal variables from disk data."""
+    #get the atom names, seq, and residue nums
+    self.AtomNames = GetPrmtopAtomNames(self.PrmtopFile)
+    self.AtomNames = AmbToPdbAtomNames(self.AtomNames)
+    self.NAtom = len(self.AtomNames)
+    if self.NAtom == 0:
+      raise IOError, "There was an error reading the Prmtop file."
+    self.AtomRes = GetPrmtopAtomRes(self.PrmtopFile)
+    self.Seq = GetPrmtopSeq(self.PrmtopFile)
+    self.__Trj = None
+    self.__Buf, self.__BufStart = None, -1
+    self.__MaskInd = MaskInd(self.AtomNames, self.Mask)
+    self.__Open()
+    Vars = self.__Trj.variables
+    if not "coordinates" in Vars:
+      self.Close()
+      raise IOError, "%s is not an Amber NetCDF trajectory." % self.TrjFile
+    if not Vars["coordinates"].shape[1] == self.NAtom:
+      self.Close()
+      raise IOError, "Prmtop file and trajectory have different numbers of atoms."
+    self.HasVel = "velocities" in Vars
+    self.HasBox = "cell_lengths" in Vars
+    #set the total number of configs
+    self.NCoords = Vars["coordinates"].shape[0]
+    del Vars
+    self.NSkip = min(self.NSkip, self.NCoords)
+    a = self.NCoords - self.NSkip
+    self.SliceNCoords = a / self.NStride
+    if a % self.NStride > 0: self.SliceNCoords += 1
+    #set the limit of how many to read in
+    if self.NRead is None:
+      self.NRead = self.SliceNCoords
+    else:
+      self.SliceNCoords = min(self.NRead, self.SliceNCoords)
+    self.Reset()
+    #get an initial set of positions
+    if len(self) > 0:
+      self.Pos = self[0]
+    else:
+      self.Pos = None
+    self.Reset()
+    #close for now
+    self.Close()
+
+  def __AbsIndex(self, ind):
+    """Returns the absolute frame index for a slice index."""
+    if ind < 0:
+      ind += self.SliceNCoords
+    if ind < 0 or ind >= self.SliceNCoords:
+      raise IndexError, "Index out of bounds for trj class."
+    return self.NSkip + self.NStride * ind
+
+  def __Read(self, Var, ind, Mask):
+    """Reads one frame of a per-atom variable, applying a mask."""
+    self.__Open()
+    Pos = array(self.__Trj.variables[Var][ind], float)
+    if Mask is self.Mask:
+      Ind = self.__MaskInd
+    else:
+      Ind = MaskInd(self.AtomNames, ResolveMask(Mask, self.PrmtopFile))
+    if not Ind is None: Pos = Pos.take(Ind, axis=0)
+    return Pos
+
+  def GetFrames(self, Start, Stop, Mask = None):
+    """Returns coordinates for slice indices [Start,Stop) as an
+array of dimensions [N,NAtom,3], read with one strided slice."""
+    if Mask is None: Mask = self.Mask
+    Start, Stop = max(Start, 0), min(Stop, self.SliceNCoords)
+    if Stop <= Start:
+      return zeros((0, self.NAtom, 3), float)
+    self.__Open()
+    a = self.NSkip + self.NStride * Start
+    b = self.NSkip + self.NStride * (Stop - 1) + 1
+    Pos = array(self.__Trj.variables["coordinates"][a:b:self.NStride], float)
+    if Mask is self.Mask:
+      Ind = self.__MaskInd
+    else:
+      Ind = MaskInd(self.AtomNames, ResolveMask(Mask, self.PrmtopFile))
+    if not Ind is None: Pos = Pos.take(Ind, axis=1)
+    return Pos
+
+  def Get(self, ind, Mask = None):
+    if Mask is None: Mask = self.Mask
+    if ind < 0:
+      ind += self.SliceNCoords
+    self.Index = self.__AbsIndex(ind)
+    Sequential = (ind == self.SliceIndex + 1)
+    self.SliceIndex = ind
+    if Mask is self.Mask and not self.__Buf is None \
+       and self.__BufStart <= ind < self.__BufStart + len(self.__Buf):
+      #serve from the read-ahead buffer
+      self.Pos = self.__Buf[ind - self.__BufStart].copy()
+    elif Mask is self.Mask and Sequential:
+      #read the next block of frames in one slice
+      self.__Buf = self.GetFrames(ind, ind + self.NBuffer, Mask)
+      self.__BufStart = ind
+      self.Pos = self.__Buf[0].copy()
+    else:
+      self.Pos = self.__Read("coordinates", self.Index, Mask)
+    #update a linked coord array
+    if not self.LinkPos is None: self.LinkPos[:,:] = self.Pos
+    return self.Pos
+
+  def GetVel(self, ind, Mask = None):
+    "Returns the velocities for a slice index, or None if not present."
+    if not self.HasVel: return None
+    if Mask is None: Mask = self.Mask
+    return self.__Read("velocities", self.__AbsIndex(ind), Mask)
+
+  def GetBox(self, ind):
+    """Returns the box lengths and angles for a slice index, or
+None if not present."""
+    if not self.HasBox: return None
+    self.__Open()
+    i = self.__AbsIndex(ind)
+    Vars = self.__Trj.variables
+    Lengths = array(Vars["cell_lengths"][i], float)
+    if "cell_angles" in Vars:
+      Angles = array(Vars["cell_angles"][i], float)
+    else:
+      Angles = array([90., 90., 90.], float)
+    return Lengths, Angles
+
+  def __getitem__(self, ind):
+    return self.Get(ind)
+
+  def __len__(self):
+    return self.SliceNCoords
+
+  def __iter__(self):
+    self.Reset()
+    return self
+
+  def next(self):
+    ind = self.SliceIndex + 1
+    if ind < self.SliceNCoords:
+      self.Count += 1
+      return self[ind]
+    else:
+      self.Reset()
+      raise StopIteration
+
+  def GetNextCoords(self, Mask = None):
+    "Returns the next set of coordinates in the Trj file, or None if the end is reached."
+    ind = self.SliceIndex + 1
+    if ind < self.SliceNCoords:
+      self.Count += 1
+      result = self.Get(ind, Mask)
+    else:
+      result = None
+    return result
+
+  def GetIndices(self):
+    "Returns the configuration indices of all read in so far."
+    return range(self.NSkip, self.NCoords, self.NStride)[:self.SliceNCoords]
+
+  def IterChunks(self, NFrames, Mask = None):
+    """Iterates over the trajectory in chunks of up to NFrames frames,
+yielding arrays of dimensions [n,NAtomSelected,3].  The atom selection
+is computed once and the output array is reused between chunks, so
+copy a chunk if it needs to be kept.  Does not change the position
+of GetNextCoords iteration or update LinkPos."""
+    if Mask is None: Mask = self.Mask
+    NFrames = max(int(NFrames), 1)
+    if Mask is self.Mask:
+      Ind = self.__MaskInd
+    else:
+      Ind = MaskInd(self.AtomNames, ResolveMask(Mask, self.PrmtopFile))
+    if Ind is None:
+      NSel = self.NAtom
+    else:
+      NSel = len(Ind)
+    Buf = zeros((NFrames, NSel, 3), float)
+    for Start in xrange(0, self.SliceNCoords, NFrames):
+      Pos = self.GetFrames(Start, Start + NFrames, NoMask)
+      n = len(Pos)
+      if Ind is None:
+        Buf[:n] = Pos
+      else:
+        Buf[:n] = Pos.take(Ind, axis=1)
+      yield Buf[:n]
+
+
+def IsNetCDF(TrjFile):
+  "Returns True if a file is in NetCDF format."
+  f = open(TrjFile, "rb")
+  s = f.read(3)
+  f.close()
+  return s == "CDF"
+
+
+def OpenTrj(TrjFile, PrmtopFile, *args, **kwargs):
+  """Returns a NetCDFTrjClass or TrjClass object for a trajectory,
+depending on its format; arguments are passed to the class."""
+  if os.path.isfile(TrjFile) and IsNetCDF(TrjFile):
+    return NetCDFTrjClass(TrjFile, PrmtopFile, *args, **kwargs)
+  else:
+    return TrjClass(TrjFile, PrmtopFile, *args, **kwargs)
+
 
 class PdbListClass:
   "Provides a class for reading successive sets of coordinates from pdb files."
@@ -598,7 +1381,8 @@ class PdbListClass:
                LinkPos = None):
     """Initializes the class and checks for pdb file existence.
 * PdbFileList: list of string names of pdb files
-* Mask: list of strings; filter for atom names (default is no mask/empty list)
+* Mask: list of strings; filter for atom names (default is no mask/empty list),
+  or an index array or Amber mask string (eg, ":1-20@CA,C,N")
 * LinkPos: an outside array that is updated automatically as coords are read
 """
     #check for file existence
@@ -610,9 +1394,6 @@ class PdbListClass:
     self.LastLen = -1
     #set the total count
     self.TotalCount = len(self.PdbFileList)
-    #set the mask option
-    self.Mask = Mask
-    if self.Mask is None: self.Mask = NoMask
     #set the linked pos
     self.LinkPos = LinkPos
     #get the sequence, atom names, and atom residues
@@ -620,6 +1401,8 @@ class PdbListClass:
     self.AtomNames = pdbtools.Atoms(f)
     self.AtomRes = [int(x)-1 for x in pdbtools.AtomResNums(pdbtools.Renumber(f))]
     self.Seq = pdbtools.Seq(f)
+    #set the mask option
+    self.Mask = self.__ResolveMask(Mask)
     #reset
     self.Reset()
     #get initial positions
@@ -632,6 +1415,16 @@ class PdbListClass:
   def __len__(self):
     "Returns the number of configurations."
     return len(self.PdbFileList)
+
+  def __ResolveMask(self, Mask):
+    """Compiles an Amber mask string against the atoms of the first
+pdb file; other masks are returned unchanged."""
+    if Mask is None: return NoMask
+    if isinstance(Mask, str):
+      import ambermask
+      Top = ambermask.MaskTopology(self.AtomNames, self.Seq, self.AtomRes)
+      return ambermask.CompileMask(Mask, Top)
+    return Mask
     
   def Reset(self):
     "Resets current configuration to list start."
@@ -661,7 +1454,11 @@ class PdbListClass:
     if ind < 0 or ind >= len(self.PdbFileList):
       raise IndexError, "Index out of bounds for pdb coords class."
     self.Index = ind
-    self.Pos = GetPdbCoords(self.PdbFileList[ind], Mask)
+    if not Mask is self.Mask: Mask = self.__ResolveMask(Mask)
+    if isinstance(Mask, ndarray):
+      self.Pos = GetPdbCoords(self.PdbFileList[ind]).take(Mask, axis=0)
+    else:
+      self.Pos = GetPdbCoords(self.PdbFileList[ind], Mask)
     if self.LastLen > 0 and not self.LastLen == len(self.Pos):
       raise ValueError, "Configuration read with different number of atoms from last read."
     self.LastLen = len(self.Pos)
@@ -685,14 +1482,48 @@ class PdbListClass:
       self.Reset()
       raise StopIteration
 
+  def IterChunks(self, NFrames, Mask = None):
+    """Iterates over the pdb files in chunks of up to NFrames files,
+yielding arrays of dimensions [n,NAtomSelected,3].  The atom selection
+is computed once and the output array is reused between chunks, so
+copy a chunk if it needs to be kept.  Does not change the position
+of GetNextCoords iteration or update LinkPos."""
+    if Mask is None: Mask = self.Mask
+    NFrames = max(int(NFrames), 1)
+    if not Mask is self.Mask: Mask = self.__ResolveMask(Mask)
+    #use the same atom name columns as GetPdbCoords
+    if IsNoMask(Mask):
+      Ind = None
+      NSel = len(self.AtomNames)
+    elif isinstance(Mask, ndarray):
+      Ind = Mask
+      NSel = len(Ind)
+    else:
+      Ind = array([i for (i, a) in enumerate(self.AtomNames)
+                   if a[1:3].strip() in Mask], int)
+      NSel = len(Ind)
+    Buf = zeros((NFrames, NSel, 3), float)
+    for Start in xrange(0, len(self.PdbFileList), NFrames):
+      n = min(NFrames, len(self.PdbFileList) - Start)
+      for i in xrange(n):
+        Pos = GetPdbCoords(self.PdbFileList[Start + i])
+        if not len(Pos) == len(self.AtomNames):
+          raise ValueError, "Configuration read with different number of atoms from last read."
+        if Ind is None:
+          Buf[i] = Pos
+        else:
+          Buf[i] = Pos.take(Ind, axis=0)
+      yield Buf[:n]
+
     
 class MultiCoordClass:
   "Provides a class for linking multiple coordinate files together."
   
-  def __init__(self, CoordObjList, LinkPos = None):
+  def __init__(self, CoordObjList, LinkPos = None, Prefetch = None):
     """Initializes the class and opens the trajectory file for reading.
 * CoordObjList gives a list of the coordinate objects
-* LinkPos: an outside array that is updated automatically as coords are read"""
+* LinkPos: an outside array that is updated automatically as coords are read
+* Prefetch: if not None, sets the prefetch depth of objects that support it"""
     def CmpArrays(a,b):
       if not len(a) == len(b):
         return False
@@ -707,6 +1538,8 @@ class MultiCoordClass:
     self.NAtom = len(self.AtomNames)
     self.Seq = self.CoordObjList[0].Seq
     self.AtomRes = self.CoordObjList[0].AtomRes
+    self.Mask = getattr(self.CoordObjList[0], "Mask", NoMask)
+    self.PrmtopFile = getattr(self.CoordObjList[0], "PrmtopFile", None)
     #check that we have the same sequences and atoms
     for Obj in self.CoordObjList[1:]:
       if not CmpArrays(self.AtomNames, Obj.AtomNames):
@@ -717,6 +1550,10 @@ class MultiCoordClass:
         raise ValueError, "Multiple coordinate objects have different residue names."
     #set the linked pos
     self.LinkPos = LinkPos
+    #set prefetching on the objects
+    if not Prefetch is None:
+      for Obj in self.CoordObjList:
+        if hasattr(Obj, "Prefetch"): Obj.Prefetch = max(Prefetch, 0)
     #reset
     self.Reset()
     #initial positions
@@ -729,6 +1566,8 @@ class MultiCoordClass:
     self.__OpenObjNum = None
 
   def Reset(self):
+    for Obj in self.CoordObjList:
+      Obj.Reset()
     self.Index = -1
     self.Count = 0
     self.__OpenObjNum = None
@@ -787,4 +1626,29 @@ class MultiCoordClass:
   def GetIndices(self):
     "Returns the configuration indices of all read in so far."
     return range(self.NCoords)
+
+  def IterChunks(self, NFrames, Mask = None):
+    """Iterates over all coordinate objects in chunks of up to NFrames
+frames, yielding arrays of dimensions [n,NAtomSelected,3].  Chunks
+span object boundaries and the output array is reused between chunks,
+so copy a chunk if it needs to be kept."""
+    NFrames = max(int(NFrames), 1)
+    Buf = None
+    n = 0
+    for Obj in self.CoordObjList:
+      for Pos in Obj.IterChunks(NFrames, Mask):
+        if Buf is None:
+          Buf = zeros((NFrames,) + Pos.shape[1:], float)
+        i = 0
+        while i < len(Pos):
+          m = min(NFrames - n, len(Pos) - i)
+          Buf[n:n+m] = Pos[i:i+m]
+          n += m
+          i += m
+          if n == NFrames:
+            yield Buf
+            n = 0
+      Obj.Close()
+    if n > 0:
+      yield Buf[:n]
   
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-#LAST MODIFIED: 12-09-08
+#LAST MODIFIED: 10-18-26
 
 #CONVENTION: angles are in DEGREES
 
@@ -19,6 +19,9 @@ except ImportError:
 #globals
 DegPerRad = 180./pi
 RadPerDeg = pi/180.
+QCPPrec = 1.e-11     #relative precision of the QCP eigenvalue
+QCPMaxIter = 50      #maximum Newton iterations for the QCP eigenvalue
+QCPDirectTol = 1.e-4 #Resid/E0 below which QCP residuals are summed directly
 
 
 #======== VECTOR FUNCTIONS ========
@@ -378,16 +381,28 @@ Returns RotMat such that Pos1 is aligned to dot(Pos2, RotMat)"""
   return dot(V, Wt)
 
 
-def AlignmentRMSD(Pos1, Pos2, Center = True):
+def CenterVecs(Pos, Weights = None):
+  """Returns the vectors that move the (weighted) centers of an [N,3]
+array or an [n,N,3] block of arrays to the origin."""
+  if Weights is None:
+    return -Pos.mean(axis=-2)
+  else:
+    return -tensordot(Weights / Weights.sum(), Pos, axes = ([0], [-2]))
+
+
+def AlignmentRMSD(Pos1, Pos2, Center = True, Weights = None):
   """Returns the translation vectors, rotation matrix, and sum of
 residuals squared (Pos1Vec, Pos2Vec, RotMat, Resid), for aligning
 Pos1 to Pos2, such that Pos1 + Pos1Vec is aligned to
-dot(Pos2 + Pos2Vec, RotMat)."""
+dot(Pos2 + Pos2Vec, RotMat).  Weights optionally gives a weight
+for each position (eg, masses), in which case the weighted centers
+are used and Resid is the weighted sum."""
+  if not Weights is None: Weights = asarray(Weights, float)
   d1, d2 = Pos1.shape
   #get centers
   if Center:
-    Pos1Vec = -average(Pos1, axis=0)
-    Pos2Vec = -average(Pos2, axis=0)
+    Pos1Vec = CenterVecs(Pos1, Weights)
+    Pos2Vec = CenterVecs(Pos2, Weights)
     p1 = Pos1 + Pos1Vec
     p2 = Pos2 + Pos2Vec
   else:
@@ -396,6 +411,10 @@ dot(Pos2 + Pos2Vec, RotMat)."""
   #check for identity
   if all(p1 == p2):
     return Pos1Vec, Pos2Vec, identity(d2, Pos1.dtype), 0.
+  #weighted fits are unweighted fits of positions scaled by sqrt(weight)
+  if not Weights is None:
+    w = sqrt(Weights)[:,newaxis]
+    p1, p2 = p1 * w, p2 * w
   #calculate E0
   E0 = sum(p1*p1, axis=None) + sum(p2*p2, axis=None)
   #calculate correlation matrix
@@ -416,6 +435,144 @@ dot(Pos2 + Pos2Vec, RotMat)."""
   return Pos1Vec, Pos2Vec, U, Residuals
 
 
+def AlignmentRMSDMany(Pos1, Pos2, Center = True, Weights = None):
+  """Like AlignmentRMSD, for aligning Pos1 to each array in a block Pos2
+of dimensions [n,N,3]; returns Pos2Vec, RotMat and Resid as arrays of
+dimensions [n,3], [n,3,3] and [n].  The singular value decomps of
+all of the correlation matrices are done at once."""
+  if not Weights is None: Weights = asarray(Weights, float)
+  #get centers
+  if Center:
+    Pos1Vec = CenterVecs(Pos1, Weights)
+    Pos2Vec = CenterVecs(Pos2, Weights)
+    p1 = Pos1 + Pos1Vec
+    p2 = Pos2 + Pos2Vec[:,newaxis,:]
+  else:
+    Pos1Vec, Pos2Vec = zeros(3, float), zeros((len(Pos2), 3), float)
+    p1, p2 = Pos1, Pos2
+  if not Weights is None:
+    w = sqrt(Weights)[:,newaxis]
+    p1, p2 = p1 * w, p2 * w
+  #correlation matrices and their singular value decomps
+  E0 = sum(p1*p1) + (p2*p2).sum(axis=2).sum(axis=1)
+  C = einsum("nki,kj->nij", p2, p1)
+  V, S, Wt = linalg.svd(C)
+  #if it's a reflection, reflect along lowest eigenvalue
+  d = sign(linalg.det(V) * linalg.det(Wt))
+  d[d == 0.] = 1.
+  S[:,-1] = S[:,-1] * d
+  Wt[:,-1,:] = Wt[:,-1,:] * d[:,newaxis]
+  U = matmul(V, Wt)
+  Residuals = maximum(E0 - 2. * S.sum(axis=1), 0.)
+  return Pos1Vec, Pos2Vec, U, Residuals
+
+
+def QuatRotMats(q):
+  """Returns rotation matrices, as in RotMatQ, for an [n,4] array of
+unit quaternions."""
+  q0, q1, q2, q3 = q[:,0], q[:,1], q[:,2], q[:,3]
+  r = empty((len(q), 3, 3), float)
+  r[:,0,0] = q0*q0 + q1*q1 - q2*q2 - q3*q3
+  r[:,0,1] = 2*(q1*q2 + q0*q3)
+  r[:,0,2] = 2*(q1*q3 - q0*q2)
+  r[:,1,0] = 2*(q1*q2 - q0*q3)
+  r[:,1,1] = q0*q0 - q1*q1 + q2*q2 - q3*q3
+  r[:,1,2] = 2*(q2*q3 + q0*q1)
+  r[:,2,0] = 2*(q1*q3 + q0*q2)
+  r[:,2,1] = 2*(q2*q3 - q0*q1)
+  r[:,2,2] = q0*q0 - q1*q1 - q2*q2 + q3*q3
+  return r
+
+
+def QCPAlignment(Pos1, Pos2, Center = True, Weights = None, RetRot = False):
+  """Returns (Pos1Vec, Pos2Vec, RotMat, Resid) as in AlignmentRMSD, using
+the quaternion characteristic polynomial (QCP) method of Theobald.  The
+minimum residual comes from the largest eigenvalue of a 4x4 key matrix,
+found by Newton's method, so no rotation matrix is needed; RotMat is
+None unless RetRot is True.  Pos2 may be an [N,3] array or an [n,N,3]
+block, in which case Pos2Vec, RotMat and Resid are arrays over the block.
+Weights optionally gives a weight for each position (eg, masses).
+Precision: Resid = 2(E0 - Lambda) loses about eps*E0 to cancellation,
+which for near-identical conformations can leave rmsds of 1e-7 A
+where the true value is zero.  Frames with Resid/E0 below QCPDirectTol
+are therefore rotated by their eigenvector and their residuals summed
+directly from the aligned positions, which is as precise as SVD."""
+  if not Weights is None: Weights = asarray(Weights, float)
+  Single = (Pos2.ndim == 2)
+  if Single: Pos2 = Pos2[newaxis]
+  #get centers
+  if Center:
+    Pos1Vec = CenterVecs(Pos1, Weights)
+    Pos2Vec = CenterVecs(Pos2, Weights)
+    p1 = Pos1 + Pos1Vec
+    p2 = Pos2 + Pos2Vec[:,newaxis,:]
+  else:
+    Pos1Vec, Pos2Vec = zeros(3, float), zeros((len(Pos2), 3), float)
+    p1, p2 = Pos1, Pos2
+  if Weights is None:
+    wp1 = p1
+    G2 = einsum("nki,nki->n", p2, p2)
+  else:
+    wp1 = p1 * Weights[:,newaxis]
+    G2 = einsum("k,nki,nki->n", Weights, p2, p2)
+  G1 = sum(wp1 * p1)
+  #correlation matrices and the symmetric, traceless key matrices
+  S = einsum("nki,kj->nij", p2, wp1)
+  Sxx, Sxy, Sxz = S[:,0,0], S[:,0,1], S[:,0,2]
+  Syx, Syy, Syz = S[:,1,0], S[:,1,1], S[:,1,2]
+  Szx, Szy, Szz = S[:,2,0], S[:,2,1], S[:,2,2]
+  K = empty((len(S), 4, 4), float)
+  K[:,0,0] = Sxx + Syy + Szz
+  K[:,1,1] = Sxx - Syy - Szz
+  K[:,2,2] = -Sxx + Syy - Szz
+  K[:,3,3] = -Sxx - Syy + Szz
+  K[:,0,1] = K[:,1,0] = Syz - Szy
+  K[:,0,2] = K[:,2,0] = Szx - Sxz
+  K[:,0,3] = K[:,3,0] = Sxy - Syx
+  K[:,1,2] = K[:,2,1] = Sxy + Syx
+  K[:,1,3] = K[:,3,1] = Szx + Sxz
+  K[:,2,3] = K[:,3,2] = Syz + Szy
+  #characteristic polynomial x^4 + C2 x^2 + C1 x + C0 of K
+  K2 = matmul(K, K)
+  C2 = -0.5 * trace(K2, axis1=1, axis2=2)
+  C1 = -einsum("nij,nji->n", K2, K) / 3.
+  C0 = linalg.det(K)
+  #Newton's method from E0, which bounds the largest eigenvalue from above
+  E0 = 0.5 * (G1 + G2)
+  Lambda = E0.copy()
+  for i in range(QCPMaxIter):
+    L2 = Lambda * Lambda
+    b = (L2 + C2) * Lambda
+    a = b + C1
+    Deriv = 2. * L2 * Lambda + b + a
+    Delta = (a * Lambda + C0) / where(Deriv == 0., 1., Deriv)
+    Lambda = Lambda - Delta
+    if all(abs(Delta) <= QCPPrec * abs(Lambda)): break
+  Residuals = maximum(2. * (E0 - Lambda), 0.)
+  #the rotation is given by the eigenvector of the largest eigenvalue
+  if RetRot:
+    q = linalg.eigh(K)[1][:,:,-1]
+    RotMat = QuatRotMats(q)
+  else:
+    RotMat = None
+  #sum small residuals directly to avoid cancellation in E0 - Lambda
+  Small = flatnonzero(Residuals < QCPDirectTol * E0)
+  if len(Small):
+    if RetRot:
+      r = RotMat[Small]
+    else:
+      r = QuatRotMats(linalg.eigh(K[Small])[1][:,:,-1])
+    d = (p1 - matmul(p2[Small], r))**2
+    if Weights is None:
+      Residuals[Small] = d.sum(axis=2).sum(axis=1)
+    else:
+      Residuals[Small] = dot(d.sum(axis=2), Weights)
+  if Single:
+    Pos2Vec, Residuals = Pos2Vec[0], Residuals[0]
+    if RetRot: RotMat = RotMat[0]
+  return Pos1Vec, Pos2Vec, RotMat, Residuals
+
+
 def RMSD(Pos1, Pos2, Center = True):
   """Returns root mean squared displacement for aligning
 Pos1 to Pos2, such that Pos1 + Pos1Vec is aligned to
@@ -522,6 +679,62 @@ def TestLib():
     l.extend([dRMSD(Pos, Pos2)])
     for x in l: print x
     print "Elapsed time: %.3f sec\n" % (time.time() - StartTime)
-  
-  
-  
+
+
+def TestQCP(NTrial = 200, NAtom = 50, RTol = 1.e-9, PosTol = 1.e-6):
+  """Runs comparison tests between the QCP and singular value decomp
+alignment routines, with and without weights, and returns the largest
+differences in rmsd and in aligned positions.  Rmsds are checked against
+residuals summed directly from the SVD-aligned positions, including
+identical and near-identical conformations; raises AssertionError if a
+difference exceeds RTol (rmsd) or PosTol (positions), in angstroms."""
+  MaxdR, MaxdPos = 0., 0.
+  for Weighted in [False, True]:
+    if Weighted:
+      print "Weighted fits..."
+      w = random.rand(NAtom) * 15. + 1.
+    else:
+      print "Unweighted fits..."
+      w = None
+    Pos1 = random.randn(NAtom, 3) * 10.
+    #random rotations and translations, with increasing noise and with
+    #noise from 1e-3 down to 1e-12 angstroms; also include exact and
+    #translated copies, a mirror image, and a planar conformation
+    Noise = list(linspace(0., 5., NTrial)) + [10.**(-k) for k in range(3, 13)]
+    Pos2 = [dot(Pos1 + random.randn(NAtom, 3) * x, RandRotMat(180.)) + random.randn(3)
+            for x in Noise]
+    Pos2.append(Pos1.copy())
+    Pos2.append(Pos1 + array([3., -1., 2.]))
+    Pos2.append(Pos1 * array([1., 1., -1.]))
+    Planar = Pos1.copy()
+    Planar[:,2] = 0.
+    Pos2.append(Planar)
+    Pos2 = array(Pos2)
+    if w is None:
+      Norm = float(NAtom)
+      ww = ones(NAtom, float)
+    else:
+      Norm = w.sum()
+      ww = w
+    for Center in [True, False]:
+      StartTime = time.time()
+      Res = [AlignmentRMSD(Pos1, p, Center = Center, Weights = w) for p in Pos2]
+      tSVD = time.time() - StartTime
+      StartTime = time.time()
+      v1, v2, rm, r = QCPAlignment(Pos1, Pos2, Center = Center, Weights = w)
+      tQCP = time.time() - StartTime
+      v1, v2, rmr, rr = QCPAlignment(Pos1, Pos2, Center = Center, Weights = w,
+                                     RetRot = True)
+      for (i, (a1, a2, arm, ar)) in enumerate(Res):
+        p = dot(Pos2[i] + v2[i], rmr[i]) - v1
+        ap = dot(Pos2[i] + a2, arm) - a1
+        RefR = sqrt(dot(ww, ((ap - Pos1)**2).sum(axis=1)) / Norm)
+        MaxdR = max(MaxdR, abs(RefR - sqrt(r[i] / Norm)),
+                    abs(RefR - sqrt(rr[i] / Norm)))
+        MaxdPos = max(MaxdPos, abs(p - ap).max())
+      print "Center=%s: SVD %.3f sec, QCP %.3f sec" % (Center, tSVD, tQCP)
+  print "Maximum rmsd difference:     %.3e" % MaxdR
+  print "Maximum position difference: %.3e" % MaxdPos
+  if MaxdR > RTol or MaxdPos > PosTol:
+    raise AssertionError, "QCP and SVD alignments differ."
+  return MaxdR, MaxdPos
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+#LAST MODIFIED: 10-18-26
+
+#DESCRIPTION: Provides a seekable reader for gzipped files.  A table of
+#decompression checkpoints is kept so that a seek to any position costs
+#at most one checkpoint spacing of decompression instead of a rewind to
+#the start of the file.
+#
+#Checkpoints inside a gzip member hold a copy of the zlib decompressor
+#and only live in memory.  The start of every gzip member is a restart
+#point that needs no decompressor state, so member starts are saved,
+#with the uncompressed size, in a sidecar file (FILE.gz.gzidx) and are
+#reused across runs while the gzipped file is unchanged.  Files written
+#by appending gzip members (like the mdsim master files) therefore get
+#persistent random access.
+
+import os, zlib, bisect, cPickle
+
+#GLOBALS
+SpacingDflt = 4 * 1024 * 1024   #uncompressed bytes between checkpoints
+ReadSize = 64 * 1024             #compressed bytes read at a time
+IndexExt = ".gzidx"
+GzipMagic = "\x1f\x8b"
+
+
+def IndexFileName(FileName):
+  "Returns the name of the sidecar index file for a gzipped file."
+  return FileName + IndexExt
+
+def FileStamp(FileName):
+  "Returns the (size, mtime) stamp used to check index freshness."
+  st = os.stat(FileName)
+  return (st.st_size, st.st_mtime)
+
+def LoadIndex(FileName):
+  """Returns the saved index dictionary for a gzipped file, or None
+if there is no index or it is out of date."""
+  fn = IndexFileName(FileName)
+  if not os.path.isfile(fn): return None
+  try:
+    f = open(fn, "rb")
+    Index = cPickle.load(f)
+    f.close()
+  except Exception:
+    return None
+  if not Index.get("Stamp") == FileStamp(FileName): return None
+  return Index
+
+def SaveIndex(FileName, Members, USize):
+  """Saves member start points [(UOff, COff), ...] and the uncompressed
+size of a gzipped file to its sidecar index.  Failures to write
+(e.g., read-only directories) are ignored."""
+  Index = {"Stamp" : FileStamp(FileName), "Members" : list(Members),
+           "USize" : USize}
+  try:
+    f = open(IndexFileName(FileName), "wb")
+    cPickle.dump(Index, f, 2)
+    f.close()
+  except (IOError, OSError):
+    pass
+
+def AddMember(FileName, UOff, COff, USize):
+  """Records a gzip member appended to FileName that starts at
+compressed byte COff and uncompressed byte UOff, where USize is the new
+uncompressed size of the file.  The index is only updated if it was
+current before the append (COff equal to its recorded size); otherwise
+it is dropped and rebuilt by the next reader."""
+  fn = IndexFileName(FileName)
+  Index = None
+  if os.path.isfile(fn):
+    try:
+      f = open(fn, "rb")
+      Index = cPickle.load(f)
+      f.close()
+    except Exception:
+      Index = None
+  if UOff == 0 and COff == 0:
+    Members = []
+  elif Index is None or not Index["Stamp"][0] == COff \
+       or not Index["USize"] == UOff:
+    if os.path.isfile(fn): os.remove(fn)
+    return
+  else:
+    Members = Index["Members"]
+  Members.append((UOff, COff))
+  SaveIndex(FileName, Members, USize)
+
+
+class GzipIndexFile:
+  "Provides a read-only, seekable file object for gzipped files."
+
+  def __init__(self, FileName, Mode = "r", Spacing = SpacingDflt,
+               UseIndexFile = True):
+    """Opens a gzipped file for reading.
+* FileName: string name of gzipped file
+* Mode: must be a read mode
+* Spacing: uncompressed bytes between in-memory checkpoints
+* UseIndexFile: True to load and save the sidecar index file"""
+    if "w" in Mode or "a" in Mode:
+      raise ValueError, "GzipIndexFile only supports reading."
+    self.FileName = FileName
+    self.Spacing = max(Spacing, ReadSize)
+    self.UseIndexFile = UseIndexFile
+    self.__f = open(FileName, "rb")
+    #checkpoints; PtU holds sorted uncompressed offsets and Pts holds
+    #(compressed offset, decompressor or None for a member start)
+    self.__PtU = [0]
+    self.__Pts = [(0, None)]
+    self.__Members = [(0, 0)]
+    self.__USize = None
+    if UseIndexFile:
+      Index = LoadIndex(FileName)
+      if not Index is None:
+        self.__USize = Index["USize"]
+        for (UOff, COff) in Index["Members"]:
+          self.__AddPoint(UOff, COff, None)
+        self.__Members = list(Index["Members"])
+    self.__Restart(0)
+
+  def __AddPoint(self, UOff, COff, State):
+    """Adds a checkpoint if one is not already at UOff."""
+    i = bisect.bisect_left(self.__PtU, UOff)
+    if i < len(self.__PtU) and self.__PtU[i] == UOff: return
+    self.__PtU.insert(i, UOff)
+    self.__Pts.insert(i, (COff, State))
+
+  def __Restart(self, ind):
+    """Restarts decompression from checkpoint number ind."""
+    COff, State = self.__Pts[ind]
+    if State is None:
+      self.__d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    else:
+      self.__d = State.copy()
+    self.__f.seek(COff)
+    self.__COff = COff
+    self.__BufOff = self.__PtU[ind]
+    self.__Buf = ""
+    self.__Pos = self.__BufOff
+    self.__EOF = False
+
+  def __Fill(self):
+    """Decompresses the next block of compressed data into the buffer.
+Returns False at the end of the data."""
+    if self.__EOF: return False
+    Data = self.__f.read(ReadSize)
+    if len(Data) == 0:
+      self.__SetEOF()
+      return False
+    self.__COff += len(Data)
+    Out = []
+    UEnd = self.__BufOff + len(self.__Buf)
+    while len(Data) > 0:
+      try:
+        s = self.__d.decompress(Data)
+      except zlib.error:
+        #corrupt or garbage data; treat as the end of the file
+        self.__Buf = self.__Buf + "".join(Out)
+        self.__SetEOF()
+        return len(Out) > 0
+      Out.append(s)
+      UEnd += len(s)
+      Data = self.__d.unused_data
+      if len(Data) > 0:
+        #the member ended; start the next one
+        s = self.__d.flush()
+        Out.append(s)
+        UEnd += len(s)
+        if not Data.startswith(GzipMagic[:len(Data)]):
+          self.__Buf = self.__Buf + "".join(Out)
+          self.__SetEOF()
+          return len(Out) > 0
+        COff = self.__COff - len(Data)
+        self.__AddPoint(UEnd, COff, None)
+        if not (UEnd, COff) in self.__Members:
+          self.__Members.append((UEnd, COff))
+        self.__d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    self.__Buf = self.__Buf + "".join(Out)
+    #add an in-memory checkpoint if we've moved far enough along
+    i = bisect.bisect_right(self.__PtU, UEnd) - 1
+    if UEnd - self.__PtU[i] >= self.Spacing:
+      self.__AddPoint(UEnd, self.__COff, self.__d.copy())
+    return True
+
+  def __SetEOF(self):
+    """Marks the end of data and saves the index if it's new."""
+    self.__EOF = True
+    USize = self.__BufOff + len(self.__Buf)
+    if self.__USize is None:
+      self.__USize = USize
+      if self.UseIndexFile:
+        SaveIndex(self.FileName, self.__Members, USize)
+
+  def __Trim(self):
+    """Drops buffered data before the current position."""
+    n = self.__Pos - self.__BufOff
+    if n > 0:
+      self.__Buf = self.__Buf[n:]
+      self.__BufOff = self.__Pos
+
+  def Size(self):
+    "Returns the uncompressed size of the file."
+    if self.__USize is None:
+      Pos = self.__Pos
+      self.seek(self.__PtU[-1])
+      while self.__Fill():
+        self.__Pos = self.__BufOff + len(self.__Buf)
+        self.__Trim()
+      self.seek(Pos)
+    return self.__USize
+
+  def seek(self, Pos, Whence = 0):
+    "Seeks to an uncompressed byte position."
+    if Whence == 1:
+      Pos += self.__Pos
+    elif Whence == 2:
+      Pos += self.Size()
+    Pos = max(Pos, 0)
+    #find the nearest checkpoint at or before Pos
+    i = bisect.bisect_right(self.__PtU, Pos) - 1
+    BufEnd = self.__BufOff + len(self.__Buf)
+    if Pos >= self.__BufOff and (Pos <= BufEnd or self.__PtU[i] <= BufEnd):
+      #we can get there from the current state
+      if Pos > BufEnd: self.__Pos = BufEnd
+    else:
+      self.__Restart(i)
+    #decompress forward to Pos
+    while self.__BufOff + len(self.__Buf) < Pos:
+      self.__Pos = self.__BufOff + len(self.__Buf)
+      self.__Trim()
+      if not self.__Fill(): break
+    self.__Pos = min(Pos, self.__BufOff + len(self.__Buf))
+
+  def tell(self):
+    return self.__Pos
+
+  def read(self, Size = -1):
+    "Reads Size uncompressed bytes, or to the end if Size < 0."
+    self.__Trim()
+    while Size < 0 or len(self.__Buf) < Size:
+      if not self.__Fill(): break
+    if Size < 0: Size = len(self.__Buf)
+    s = self.__Buf[:Size]
+    self.__Pos += len(s)
+    return s
+
+  def readline(self, Size = -1):
+    "Reads a line of uncompressed data."
+    self.__Trim()
+    Start = 0
+    while True:
+      i = self.__Buf.find("\n", Start)
+      if i >= 0:
+        n = i + 1
+        break
+      Start = len(self.__Buf)
+      if 0 <= Size <= Start or not self.__Fill():
+        n = len(self.__Buf)
+        break
+    if Size >= 0: n = min(n, Size)
+    s = self.__Buf[:n]
+    self.__Pos += len(s)
+    return s
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    s = self.readline()
+    if len(s) == 0: raise StopIteration
+    return s
+
+  def close(self):
+    if not self.__f is None:
+      self.__f.close()
+      self.__f = None
+      self.__Buf = ""
@@ -42,7 +42,7 @@ if __name__ == "__main__" and len(sys.argv) < 4:
 
 from numpy import *
 import os, time, shutil, gzip, copy, random, cPickle, sys, zlib, StringIO, re
-import sequence, pdbtools, protein, geometry, scripttools, coords
+import sequence, pdbtools, protein, geometry, scripttools, coords, gzindex
 
 
 #======== MAKE AMBER EXCEPTION ========
@@ -377,6 +377,12 @@ EneHeadLines = 10
 EneBlockLines = 10
 #This gives the number of header lines in the trj file.
 TrjHeadLines = 1
+#This gives the number of bytes copied at a time when concatenating data.
+ConcatChunkSize = 1024 * 1024
+#This gives the gzip compression level for concatenated data.
+ConcatCompressLevel = 6
+#This gives the extension of the frame index kept next to master ene files.
+FrameIndexExt = ".frameidx"
 
 #These are all the files which must be saved prior to an undo.
 DataFiles = ["mdout.txt","mdout.crd","mdtrj.crd","mdene.txt","current.crd"]
@@ -1998,55 +2004,19 @@ mdtrj.crd, and mdene.txt.
 * Gzip: Boolean specifying whether to use Gzip (default is True)
 * Current: True will update current.pdb
 * Params: True will update prmtop.parm7"""
-    def TrimLines(s, NLines):
-      """Removes first NLines of s"""
-      n = 0
-      for i in range(NLines):
-        n = s.find("\n", n) + 1
-        if n <= 0: return ""
-      return s[n:]
-    def ConcatFile(BaseFile, ConcatFile, NHeadLines):
-      """Concatenates File to ConcatFile."""
-      if os.path.isfile(BaseFile):     
-        s = file(BaseFile, "r").read()
-        if len(s) == 0 and RaiseErrors:
-          print "File %s is zero-length" % BaseFile
-        if os.path.isfile(ConcatFile):
-          s = TrimLines(s, NHeadLines)
-          myFile(ConcatFile, "a").write(s)
-        else:
-          myFile(ConcatFile, "w").write(s)
-      elif RaiseErrors:
-        raise IOError, "Cannot find %s" % BaseFile
-    #change to DataPath so gzip names files correctly
-    cwd = os.getcwd()
     if UseFullPath:
       rp = self.RunPath
     else:
-      rp = os.path.join(cwd, self.RunPath)
-    os.chdir(DataPath)
-    cpfiles = []
-    if Current: cpfiles.append("current.pdb")
-    if Params: cpfiles.append("prmtop.parm7")
-    for f in cpfiles:
-      df = os.path.join(rp,f)
-      if os.path.isfile(df):
-        shutil.copy(df, Prefix + f)
-      elif RaiseErrors:
-        raise IOError, "Cannot find %s" % df
-    trjFn2 = os.path.join(rp, "mdtrj.crd")
-    eneFn2 = os.path.join(rp, "mdene.txt")
-    ext = ""
-    if Gzip: ext = ".gz"
-    trjFn1 = Prefix + "mdtrj.crd" + ext
-    eneFn1 = Prefix + "mdene.txt" + ext
-    ConcatFile(trjFn2, trjFn1, TrjHeadLines)
-    ConcatFile(eneFn2, eneFn1, EneHeadLines)
-    os.chdir(cwd)
+      rp = os.path.abspath(self.RunPath)
+    ConcatRunData(rp, Prefix, DataPath, Gzip = Gzip, Current = Current,
+                  Params = Params, RaiseErrors = RaiseErrors)
 
   def DelConcatData(self, Prefix, DataPath):
     for f in ["prmtop.parm7", "current.pdb", "mdene.txt",
-              "mdene.txt.gz", "mdtrj.crd", "mdtrj.crd.gz"]:
+              "mdene.txt.gz", "mdtrj.crd", "mdtrj.crd.gz",
+              "mdene.txt.gz" + gzindex.IndexExt,
+              "mdtrj.crd.gz" + gzindex.IndexExt,
+              "mdene.txt" + FrameIndexExt, "mdene.txt.gz" + FrameIndexExt]:
       fn = os.path.join(DataPath, Prefix + f)
       if os.path.isfile(fn): os.remove(fn)    
 
@@ -2054,6 +2024,198 @@ mdtrj.crd, and mdene.txt.
 
 #======== FUNCTIONS OPERATING ON CONCAT DATA ========
 
+def ConcatFile(BaseFile, CatFile, NHeadLines, RaiseErrors = True):
+  """Appends BaseFile to CatFile, skipping the first NHeadLines lines
+if CatFile already exists.  Data are copied ConcatChunkSize bytes at a
+time; if CatFile ends in .gz they are compressed into a new gzip member
+that is recorded in the file's gzindex index."""
+  if not os.path.isfile(BaseFile):
+    if RaiseErrors: raise IOError, "Cannot find %s" % BaseFile
+    return
+  if os.path.getsize(BaseFile) == 0 and RaiseErrors:
+    print "File %s is zero-length" % BaseFile
+  Append = os.path.isfile(CatFile)
+  fin = file(BaseFile, "rb")
+  if Append:
+    for i in range(NHeadLines): fin.readline()
+  if CatFile.endswith(".gz"):
+    #find where the new member starts, compressed and uncompressed
+    if Append:
+      COff = os.path.getsize(CatFile)
+      Index = gzindex.LoadIndex(CatFile)
+      if Index is None:
+        UOff = -1
+      else:
+        UOff = Index["USize"]
+    else:
+      COff, UOff = 0, 0
+    fobj = file(CatFile, "ab")
+    fout = gzip.GzipFile(filename = os.path.basename(CatFile), mode = "wb",
+                         compresslevel = ConcatCompressLevel, fileobj = fobj)
+  else:
+    fobj = None
+    fout = file(CatFile, "ab")
+  USize = 0
+  try:
+    while True:
+      s = fin.read(ConcatChunkSize)
+      if len(s) == 0: break
+      fout.write(s)
+      USize += len(s)
+  finally:
+    fin.close()
+    fout.close()
+    if not fobj is None: fobj.close()
+  if not fobj is None:
+    gzindex.AddMember(CatFile, UOff, COff, UOff + USize)
+
+def ConcatRunData(RunPath, Prefix, DataPath, Gzip = True,
+  Current = True, Params = True, RaiseErrors = True):
+  """Updates master files in DataPath with the trajectory and energy
+data of a simulation in RunPath; see SimClass.ConcatData.  Only full
+paths are used, so different runs can be concatenated concurrently."""
+  cpfiles = []
+  if Current: cpfiles.append("current.pdb")
+  if Params: cpfiles.append("prmtop.parm7")
+  for f in cpfiles:
+    df = os.path.join(RunPath, f)
+    if os.path.isfile(df):
+      shutil.copy(df, os.path.join(DataPath, Prefix + f))
+    elif RaiseErrors:
+      raise IOError, "Cannot find %s" % df
+  ext = ""
+  if Gzip: ext = ".gz"
+  ConcatFile(os.path.join(RunPath, "mdtrj.crd"),
+             os.path.join(DataPath, Prefix + "mdtrj.crd" + ext),
+             TrjHeadLines, RaiseErrors)
+  #update the frame index along with the ene file
+  EneFn1 = os.path.join(RunPath, "mdene.txt")
+  EneFn2 = os.path.join(DataPath, Prefix + "mdene.txt" + ext)
+  if os.path.isfile(EneFn2):
+    Index = LoadFrameIndex(EneFn2)
+  else:
+    Index = {"NFrame" : 0, "HeadBytes" : None, "BlockBytes" : None}
+  ConcatFile(EneFn1, EneFn2, EneHeadLines, RaiseErrors)
+  if os.path.isfile(EneFn1) and os.path.isfile(EneFn2):
+    UpdateFrameIndex(EneFn2, Index, ScanEneFile(EneFn1))
+
+def ScanEneFile(fn):
+  """Finds the header and block sizes in bytes and the number of frames
+in an ene file.  Returns an index dictionary with keys HeadBytes,
+BlockBytes (None if there is no full record) and NFrame."""
+  HeadBytes, BlockBytes = 0, 0
+  f = myFile(fn, "r")
+  try:
+    try:
+      for i in range(0,EneHeadLines):
+        HeadBytes += len(f.readline())
+      for i in range(EneBlockLines):
+        m = len(f.readline())
+        if m == 0:
+          #could not read first record
+          BlockBytes = None
+          break
+        BlockBytes += m
+    except IOError:
+      BlockBytes = None
+  finally:
+    f.close()
+  if BlockBytes is None:
+    return {"HeadBytes" : HeadBytes, "BlockBytes" : None, "NFrame" : 0}
+  if fn.endswith(".gz"):
+    #the gzip index gives the size without decompressing if it's current
+    g = gzindex.GzipIndexFile(fn)
+    Size = g.Size()
+    g.close()
+  else:
+    Size = os.path.getsize(fn)
+  NFrame = (Size - HeadBytes) / BlockBytes
+  return {"HeadBytes" : HeadBytes, "BlockBytes" : BlockBytes, "NFrame" : NFrame}
+
+def LoadFrameIndex(fn):
+  """Returns the frame index for a master ene file, or None if it is
+missing or out of date."""
+  IndexFn = fn + FrameIndexExt
+  if not os.path.isfile(IndexFn) or not os.path.isfile(fn): return None
+  try:
+    f = file(IndexFn, "rb")
+    Index = cPickle.load(f)
+    f.close()
+  except Exception:
+    return None
+  st = os.stat(fn)
+  if not Index.get("Stamp") == (st.st_size, st.st_mtime): return None
+  return Index
+
+def SaveFrameIndex(fn, Index):
+  """Saves the frame index for a master ene file, stamped with the file's
+current size and mtime.  Failures to write are ignored."""
+  st = os.stat(fn)
+  Index = dict(Index)
+  Index["Stamp"] = (st.st_size, st.st_mtime)
+  try:
+    f = file(fn + FrameIndexExt, "wb")
+    cPickle.dump(Index, f, 2)
+    f.close()
+  except (IOError, OSError):
+    pass
+
+def UpdateFrameIndex(fn, Index, Segment):
+  """Adds the frames of an appended segment to a frame index and saves
+it; if Index was not current before the append or the block sizes don't
+match, the index is removed so it will be rebuilt when next needed."""
+  if not Index is None:
+    #the master file's header comes from its first segment
+    if Index["HeadBytes"] is None: Index["HeadBytes"] = Segment["HeadBytes"]
+    if Index["BlockBytes"] is None: Index["BlockBytes"] = Segment["BlockBytes"]
+  if Index is None or not (Segment["BlockBytes"] is None
+                           or Segment["BlockBytes"] == Index["BlockBytes"]):
+    if os.path.isfile(fn + FrameIndexExt): os.remove(fn + FrameIndexExt)
+    return
+  Index["NFrame"] += Segment["NFrame"]
+  SaveFrameIndex(fn, Index)
+
+def GetFrameIndex(fn):
+  """Returns the frame index for a master ene file, scanning the file
+and saving a new index if needed."""
+  Index = LoadFrameIndex(fn)
+  if Index is None:
+    Index = ScanEneFile(fn)
+    SaveFrameIndex(fn, Index)
+  return Index
+
+def EneFileName(DataPath, Prefix = ""):
+  "Returns the name of the master ene file, gzipped or not."
+  fn = os.path.join(DataPath, Prefix + "mdene.txt.gz")
+  if not os.path.isfile(fn):
+    fn = os.path.join(DataPath, Prefix + "mdene.txt")
+  return fn
+
+def _ConcatTask(Task):
+  "Runs ConcatRunData for one (args, kwargs) task; used by ConcatAllData."
+  Args, KwArgs = Task
+  ConcatRunData(*Args, **KwArgs)
+
+def ConcatAllData(SimList, PrefixList, DataPath, NProc = 4, **kwargs):
+  """Runs ConcatData for many simulations at once from a pool of threads.
+* SimList: list of SimClass objects
+* PrefixList: list of the prefix to use for each simulation
+* DataPath: string specifying path location of the master files
+* NProc: number of threads
+* kwargs: other keyword arguments to ConcatData"""
+  from multiprocessing.pool import ThreadPool
+  Tasks = [((os.path.abspath(Sim.RunPath), Prefix, DataPath), kwargs)
+           for (Sim, Prefix) in zip(SimList, PrefixList)]
+  if NProc <= 1 or len(Tasks) <= 1:
+    map(_ConcatTask, Tasks)
+  else:
+    Pool = ThreadPool(NProc)
+    try:
+      Pool.map(_ConcatTask, Tasks)
+    finally:
+      Pool.close()
+      Pool.join()
+
 
 def GetHistory(DataPath, Prefix = "", Vars = [v for v in EneParseData.iterkeys()],
                NFrameSkip = 0, NFrameRead = -1):
@@ -2072,36 +2234,23 @@ data from concatenated files.
   if len(l) == 0:
     return
   #check for file existence
-  fn = os.path.join(DataPath, Prefix + "mdene.txt.gz")
+  fn = EneFileName(DataPath, Prefix)
   if not os.path.isfile(fn):
-    fn = os.path.join(DataPath, Prefix + "mdene.txt")
-  f = myFile(fn, "r")
-  #skip over header
-  for i in range(0,EneHeadLines):
-    f.readline()
-  #mark current position
-  CurPos = f.tell()
-  #get block size
-  try:
-    BytesPerBlock = 0
-    for i in range(EneBlockLines):
-      m = len(f.readline())
-      if m == 0:
-        #could not read first record
-        f.close()
-        return l
-      BytesPerBlock += m
-  except IOError:
-    f.close()
+    raise IOError, "Cannot find %s" % fn
+  #get the block size from the frame index
+  Index = GetFrameIndex(fn)
+  BytesPerBlock = Index["BlockBytes"]
+  if BytesPerBlock is None:
+    #could not read first record
     return l
-  #go back to original position
-  f.seek(CurPos)
-  #skip as necessary
-  try:
-    f.seek(CurPos + BytesPerBlock * NFrameSkip)
-  except IOError:
-    print "Could not skip required number of frames in %s" % os.path.abspath(fn)
-    raise
+  if NFrameSkip > Index["NFrame"]:
+    raise IOError, "Could not skip required number of frames in %s" % os.path.abspath(fn)
+  #jump straight to the first frame
+  if fn.endswith(".gz"):
+    f = gzindex.GzipIndexFile(fn)
+  else:
+    f = file(fn, "rb")
+  f.seek(Index["HeadBytes"] + BytesPerBlock * NFrameSkip)
   #read in data
   n = 0
   while n < NFrameRead or NFrameRead < 0:
@@ -2131,48 +2280,13 @@ data from concatenated files.
   return l
 
 def GetNFrames(DataPath, Prefix = ""):
-  """Returns the number of frames in concatenated data.
+  """Returns the number of frames in concatenated data, from the frame
+index kept by ConcatData.
 * Prefix: string with the prefix to add to each file it updates
 * DataPath: string specifying path location of the master files"""
-  #check for file existence
-  fn = os.path.join(DataPath, Prefix + "mdene.txt.gz")
-  try:
-    f = myFile(fn, "r")
-  except IOError:
-    f.close()
-    return 0
-  #skip over header
-  for i in range(0,EneHeadLines):
-    f.readline()
-  #initialize count
-  n = 0
-  #read first record
-  try:
-    BytesPerBlock = 0
-    for i in range(EneBlockLines):
-      m = len(f.readline())
-      if m == 0:
-        #could not read first record
-        f.close()
-        return 0
-      BytesPerBlock += m
-    n = 1
-  except IOError:
-    f.close()
-    return 0
-  #now read remaining records  
-  while True:
-    #read data and get tokens
-    try:
-      s = f.read(BytesPerBlock)
-      if len(s) < BytesPerBlock:
-        break
-    except IOError:
-      break
-    n += 1
-  f.close()
-  #return length
-  return n
+  fn = EneFileName(DataPath, Prefix)
+  if not os.path.isfile(fn): return 0
+  return GetFrameIndex(fn)["NFrame"]
 
 
 #======== PREPARING PDB FILES FOR INPUT ========
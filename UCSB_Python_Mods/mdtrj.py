@@ -3,11 +3,11 @@
 #CONTAINS ROUTINES FOR ANALYZING TRAJECTORIES;
 #ANALAGOUS TO PTRAJ
 
-#LAST MODIFIED: 05-11-07
+#LAST MODIFIED: 10-18-26
 
 
 from numpy import *
-import os, sys, glob, gzip
+import os, sys, glob, gzip, multiprocessing
 import coords, sequence
 
 #GLOBALS
@@ -15,6 +15,8 @@ BlockLen = 13
 DistFmt = "%.3f"
 VerboseDflt = False
 DistMethodDesc = ["alpha carbons", "beta carbons", "residue centroid"]
+ChunkSize = 100
+NProcDflt = 1
 
 
 
@@ -28,23 +30,75 @@ Returns GroupAtoms, PairGroups.
     return [], []
   GroupAtoms = []
   PairGroups = []
-  for Atoms1, Atoms2 in PairAtoms:
+  #group number of each atom list, keyed by tuple
+  GroupNum = {}
+  def GetGroup(Atoms):
     #put single entries in a list
-    if not type(Atoms1) is list:
-      Atoms1 = [Atoms1]
-    if not type(Atoms2) is list:
-      Atoms2 = [Atoms2]  
-    #check to see if groups are already there
-    if not Atoms1 in GroupAtoms:
-      GroupAtoms.append(Atoms1)
-    if not Atoms2 in GroupAtoms:
-      GroupAtoms.append(Atoms2)
-    #update the group pair list
-    Group1 = GroupAtoms.index(Atoms1)
-    Group2 = GroupAtoms.index(Atoms2)
-    PairGroups.append((Group1,Group2))
+    if not type(Atoms) is list:
+      Atoms = [Atoms]
+    Key = tuple(Atoms)
+    if not Key in GroupNum:
+      GroupNum[Key] = len(GroupAtoms)
+      GroupAtoms.append(Atoms)
+    return GroupNum[Key]
+  for Atoms1, Atoms2 in PairAtoms:
+    PairGroups.append((GetGroup(Atoms1), GetGroup(Atoms2)))
   return GroupAtoms, PairGroups  
 
+
+class AtomIndex:
+  """Maps (residue number, atom name) to atom numbers and residue
+numbers to their atoms for a prmtop file."""
+
+  def __init__(self, PrmtopFile):
+    """Builds the index in one pass over the atoms.
+* PrmtopFile: string, path of prmtop file"""
+    AtomNames = coords.GetPrmtopAtomNames(PrmtopFile)
+    AtomRes = coords.GetPrmtopAtomRes(PrmtopFile)
+    self.NAtom = len(AtomNames)
+    self.Seq = coords.GetPrmtopSeq(PrmtopFile)
+    #first atom with each (residue, name), and the atoms of each residue
+    self.Atoms = {}
+    self.ResAtomList = {}
+    for (i, (ResInd, Name)) in enumerate(zip(AtomRes, AtomNames)):
+      Key = (ResInd, Name.strip())
+      if not Key in self.Atoms: self.Atoms[Key] = i
+      self.ResAtomList.setdefault(ResInd, []).append(i)
+
+  def Atom(self, ResInd, Name):
+    """Returns the atom number of an atom name in a residue; raises
+ValueError if it is not found."""
+    try:
+      return self.Atoms[(ResInd, Name)]
+    except KeyError:
+      raise ValueError, "Could not find atom %s in res %d." % (Name, ResInd)
+
+  def FindAtom(self, ResInd, NameList):
+    """Returns the first atom in a residue found from a list of names,
+or the first atom of the residue if none are found."""
+    for Name in NameList:
+      if (ResInd, Name) in self.Atoms: return self.Atoms[(ResInd, Name)]
+    if ResInd in self.ResAtomList: return self.ResAtomList[ResInd][0]
+    raise IndexError, "Could not find atoms in res %d." % ResInd
+
+  def ResAtoms(self, ResInd):
+    "Returns a new list of the atom numbers in a residue."
+    return list(self.ResAtomList.get(ResInd, []))
+
+
+#cache of atom indices by prmtop path; each is reused while the
+#file's (size, mtime) stays the same
+AtomIndexCache = {}
+
+def GetAtomIndex(PrmtopFile):
+  "Returns the AtomIndex for a prmtop file, reusing a cached one if current."
+  Key = os.path.abspath(PrmtopFile)
+  st = os.stat(PrmtopFile)
+  Stamp = (st.st_size, st.st_mtime)
+  if not Key in AtomIndexCache or not AtomIndexCache[Key][0] == Stamp:
+    AtomIndexCache[Key] = (Stamp, AtomIndex(PrmtopFile))
+  return AtomIndexCache[Key][1]
+
     
 def GetResPairAtoms(PrmtopFile, PairList, DistMethod):
   """Makes a list of all the atoms involved in residue pairs.
@@ -53,30 +107,18 @@ Returns PairAtoms.
 * PairList: list of pairs of residue numbers
 * DistMethod: int, 0 = CAs, 1 = CBs, 2 = residue COM
 * PairAtoms: list of pairs of lists of atom numbers"""
-  AtomNames = coords.GetPrmtopAtomNames(PrmtopFile)
-  AtomRes = coords.GetPrmtopAtomRes(PrmtopFile)
-  NAtom = len(AtomNames)
-  #make a list of (residue num, atom name)
-  AtomDat = [(AtomRes[i], AtomNames[i].strip()) for i in range(0,NAtom)]
+  Index = GetAtomIndex(PrmtopFile)
   PairAtoms = []
-  def GetInd(Dat, ResInd, NameList):
-    #first search through name list
-    for Name in NameList:
-      if (ResInd, Name) in Dat: return Dat.index((ResInd, Name))
-    #just get any atom with the residue
-    for (i, (ResInd2, Name)) in enumerate(Dat):
-      if ResInd2 == ResInd: return i
-    raise IndexError, "Could not find atoms in res %d." % ResInd
   for a,b in PairList:
     if DistMethod == 0:
-      Atoms1 = GetInd(AtomDat, a, ["CA", "CH3", "N"])
-      Atoms2 = GetInd(AtomDat, b, ["CA", "CH3", "N"])
+      Atoms1 = Index.FindAtom(a, ["CA", "CH3", "N"])
+      Atoms2 = Index.FindAtom(b, ["CA", "CH3", "N"])
     elif DistMethod == 1:
-      Atoms1 = GetInd(AtomDat, a, ["CB", "CA", "CH3", "N"])
-      Atoms2 = GetInd(AtomDat, b, ["CB", "CA", "CH3", "N"])
+      Atoms1 = Index.FindAtom(a, ["CB", "CA", "CH3", "N"])
+      Atoms2 = Index.FindAtom(b, ["CB", "CA", "CH3", "N"])
     else:
-      Atoms1 = [i for i in range(0,NAtom) if AtomRes[i]==a]
-      Atoms2 = [i for i in range(0,NAtom) if AtomRes[i]==b]
+      Atoms1 = Index.ResAtoms(a)
+      Atoms2 = Index.ResAtoms(b)
     PairAtoms.append((Atoms1, Atoms2))
   return PairAtoms
 
@@ -89,12 +131,9 @@ Returns PairAtoms, PairList.
 * PairList: list of residue number pairs
 * MinCO: minimum contact order to consider"""
   ###WARNING: THIS FUNCTION DOES NOT WORK ANYMORE
-  AtomNames = coords.GetPrmtopAtomNames(PrmtopFile)
-  AtomRes = coords.GetPrmtopAtomRes(PrmtopFile)
-  Seq = coords.GetPrmtopSeq(PrmtopFile)
-  NAtom, NRes = len(AtomNames), len(Seq)
-  #make a list of (residue num, atom name)
-  AtomDat = [(AtomRes[i], AtomNames[i].strip()) for i in range(0,NAtom)]
+  Index = GetAtomIndex(PrmtopFile)
+  Seq = Index.Seq
+  NRes = len(Seq)
   PairAtoms = []
   PairList = []
   for i in range(0, NRes):
@@ -106,9 +145,9 @@ Returns PairAtoms, PairList.
       #check opp charge
       if not Charge1*Charge2 < 0: continue
       for Name1 in Names1:
-        Atom1 = AtomDat.index((i, Name1))
+        Atom1 = Index.Atom(i, Name1)
         for Name2 in Names2:
-          Atom2 = AtomDat.index((j, Name2))
+          Atom2 = Index.Atom(j, Name2)
           PairAtoms.append((Atom1, Atom2))
           PairList.append((i,j))
   return PairAtoms, PairList
@@ -122,7 +161,7 @@ Returns PairAtoms, PairList.
 * PairAtoms: list of pairs of lists of atom numbers
 * PairList: list of residue number pairs
 * MinCO: minimum contact order to consider"""
-  Seq = coords.GetPrmtopSeq(PrmtopFile)
+  Seq = GetAtomIndex(PrmtopFile).Seq
   NRes = len(Seq)
   PairList = []
   for i in range(0, NRes):
@@ -154,7 +193,7 @@ def SaveTrjDists(TrjFile, PrmtopFile, OutputPath, PairAtoms,
   GroupAtoms, PairGroups = MakeAtomGroups(PairAtoms)
   NGroup = len(GroupAtoms)
   #make trj object
-  Trj = coords.TrjClass(TrjFile, PrmtopFile, NSkip = NSkip, NRead = NRead, NStride = NStride)
+  Trj = coords.OpenTrj(TrjFile, PrmtopFile, NSkip = NSkip, NRead = NRead, NStride = NStride)
   #check labels
   if PairLabels is None:
     PairLabels = ["pair%d" % i for i in range(0,len(PairAtoms))]
@@ -164,26 +203,26 @@ def SaveTrjDists(TrjFile, PrmtopFile, OutputPath, PairAtoms,
   f = gzip.GzipFile(fn, "w")
   f.write("".join(ColHead) + "\n")
   #initialize variables
-  GroupPos = zeros((NGroup,3), float)
-  #now parse the trajectory
-  for Pos in Trj:
+  Group1 = array([a for (a,b) in PairGroups], int)
+  Group2 = array([b for (a,b) in PairGroups], int)
+  Indices = Trj.GetIndices()
+  FrameNum = 0
+  #now parse the trajectory a chunk of frames at a time
+  for Pos in Trj.IterChunks(ChunkSize):
     #calculate the centroid of group coordinates
-    GroupPos.fill(0.)
-    for i in range(0,NGroup):
-      Group = GroupAtoms[i]
-      for AtomNum in Group:
-        GroupPos[i,:] += Pos[AtomNum,:]
-      GroupPos[i,:] /= float(len(Group))
+    GroupPos = zeros((len(Pos), NGroup, 3), float)
+    for (i, Group) in enumerate(GroupAtoms):
+      GroupPos[:,i,:] = Pos[:,Group,:].sum(axis=1) / float(len(Group))
     #calculate the distances
-    DistList = []
-    for Group1, Group2 in PairGroups:
-      Dist = sqrt( sum((GroupPos[Group1,:] - GroupPos[Group2,:])**2) )
-      DistList.append(Dist)
+    Dists = sqrt(((GroupPos[:,Group1,:] - GroupPos[:,Group2,:])**2).sum(axis=2))
     #output to file
-    s = ("%d" % Trj.Index).ljust(BlockLen-1) + " "
-    s += " ".join([(DistFmt % d).ljust(BlockLen-1) for d in DistList])
-    s += "\n"
-    f.write(s)
+    l = []
+    for DistList in Dists:
+      s = ("%d" % Indices[FrameNum]).ljust(BlockLen-1) + " "
+      s += " ".join([(DistFmt % d).ljust(BlockLen-1) for d in DistList])
+      l.append(s + "\n")
+      FrameNum += 1
+    f.write("".join(l))
   f.close()
   Trj.Close()
 
@@ -210,9 +249,73 @@ def GetTrjList(DataPath, ReplicaInd = None):
         raise IOError, "Trajectory %d in %s not found" % (i, DataPath)
   return TrjList, ReplicaInd
 
+def GetTrjPrefix(TrjFile):
+  """Returns the replica prefix of a trajectory file, eg "0." for
+"0.mdtrj.crd.gz"."""
+  return os.path.basename(TrjFile).replace("mdtrj.crd", "").replace(".gz", "").strip()
+
+def GetTrjPrmtop(DataPath, TrjFile):
+  "Returns the prmtop file that goes with a replica trajectory."
+  return os.path.join(DataPath, GetTrjPrefix(TrjFile) + "prmtop.parm7")
+
+def _RunTrjTask(Task):
+  """Runs a single trajectory task; used by RunAllTrj in worker processes."""
+  Func, TrjFile, PrmtopFile, Args, KwArgs = Task
+  Func(TrjFile, PrmtopFile, *Args, **KwArgs)
+  return TrjFile
+
+def RunAllTrj(DataPath, Func, Args = (), KwArgs = {}, ReplicaInd = None,
+  Prefix = "", NProc = NProcDflt, Verbose = VerboseDflt):
+  """Runs a function on every trajectory in a path, split over processes.
+* DataPath: path with trajectories and prmtop files
+* Func: function called as Func(TrjFile, PrmtopFile, *Args, **KwArgs);
+        must be defined at module level so that it can be sent to workers
+* Args: tuple of additional arguments to Func
+* KwArgs: dictionary of additional keyword arguments to Func
+* ReplicaInd: indices of replicas to be considered (default is all)
+* Prefix: if not None, Func gets a Prefix keyword of the replica prefix
+          plus this string, eg "0.prefix"
+* NProc: number of processes (default 1 runs in this process; None is
+         the number of cpus)
+* Verbose: boolean, display progress messages?
+Each worker process handles one trajectory and is then replaced, so
+memory does not build up across replicas.  Returns the list of
+trajectory files processed."""
+  #find all trajectories
+  TrjList, ReplicaInd = GetTrjList(DataPath, ReplicaInd)
+  #make the tasks
+  Tasks = []
+  for TrjFile in TrjList:
+    ThisKwArgs = dict(KwArgs)
+    if not Prefix is None:
+      ThisKwArgs["Prefix"] = GetTrjPrefix(TrjFile) + Prefix
+    Tasks.append((Func, TrjFile, GetTrjPrmtop(DataPath, TrjFile),
+                  tuple(Args), ThisKwArgs))
+  if NProc is None: NProc = multiprocessing.cpu_count()
+  NProc = max(min(NProc, len(Tasks)), 1)
+  if NProc == 1:
+    #run serially in this process
+    for (i, Task) in enumerate(Tasks):
+      if Verbose: print "Processing trajectory %s" % Task[1]
+      _RunTrjTask(Task)
+      if Verbose: print "Finished %d of %d trajectories" % (i+1, len(Tasks))
+  else:
+    if Verbose: print "Processing %d trajectories on %d processes" % (len(Tasks), NProc)
+    Pool = multiprocessing.Pool(NProc, maxtasksperchild = 1)
+    try:
+      for (i, TrjFile) in enumerate(Pool.imap_unordered(_RunTrjTask, Tasks)):
+        if Verbose: print "Finished trajectory %s (%d of %d)" % (TrjFile, i+1, len(Tasks))
+      Pool.close()
+    except:
+      Pool.terminate()
+      raise
+    finally:
+      Pool.join()
+  return TrjList
+
 def SaveAllTrjDists(DataPath, OutputPath, PairAtoms,
   PairLabels = None, ReplicaInd = None, NSkip = 0, NRead = None, NStride = 1,
-  Prefix = "", Verbose = VerboseDflt):
+  Prefix = "", NProc = NProcDflt, Verbose = VerboseDflt):
   """Saves distances from all trajectories in a path to gzipped files.
 * DataPath: path with trajectories and prmtop files
 * OutputPath: string, path to save distance files
@@ -223,20 +326,15 @@ def SaveAllTrjDists(DataPath, OutputPath, PairAtoms,
 * NRead: maximum number of configurations to read (default is all)
 * NStride: stride between configuration frames (default is 1)
 * Prefix: will be added after the number, eg "0.prefixdist.txt.gz"
+* NProc: number of processes over which to split trajectories
 * Verbose: boolean, display verbose messages?"""
   #check path
   if not os.path.isdir(OutputPath): os.mkdir(OutputPath)
-  #find all trajectories
-  TrjList, ReplicaInd = GetTrjList(DataPath, ReplicaInd)  
-  #for each trajectory
-  for TrjFile in TrjList:
-    #get trj prefix
-    if Verbose: print "Processing trajectory %s" % TrjFile
-    TrjPrefix = os.path.basename(TrjFile).replace("mdtrj.crd", "").replace(".gz", "").strip()
-    PrmtopFile =  os.path.join(DataPath, TrjPrefix + "prmtop.parm7")
-    SaveTrjDists(TrjFile, PrmtopFile, OutputPath, PairAtoms,
-      PairLabels = PairLabels, NSkip = NSkip, NRead = NRead, NStride = NStride,
-      Prefix = TrjPrefix + Prefix, Verbose = Verbose)   
+  #run each trajectory
+  RunAllTrj(DataPath, SaveTrjDists, Args = (OutputPath, PairAtoms),
+    KwArgs = {"PairLabels" : PairLabels, "NSkip" : NSkip, "NRead" : NRead,
+              "NStride" : NStride, "Verbose" : Verbose},
+    ReplicaInd = ReplicaInd, Prefix = Prefix, NProc = NProc, Verbose = Verbose)
   if Verbose: print "Done processing trajectory distances"
   
 
@@ -275,7 +373,8 @@ def SaveTrjResDists(TrjFile, PrmtopFile, OutputPath, PairList,
     
 def SaveAllTrjResDists(DataPath, OutputPath, PairList,
   ReplicaInd = None, NSkip = 0, NRead = None, NStride = 1,
-  DistMethod = 0, StartRes = 0, Prefix = "", Verbose = VerboseDflt):
+  DistMethod = 0, StartRes = 0, Prefix = "", NProc = NProcDflt,
+  Verbose = VerboseDflt):
   """Saves distances from all trajectories in a path to gzipped files.
 * DataPath: path with trajectories and prmtop files
 * OutputPath: string, path to save distance files
@@ -290,21 +389,16 @@ def SaveAllTrjResDists(DataPath, OutputPath, PairList,
             equal to 2 means a pair between the 2nd and 3rd residues
             in the trajectory
 * Prefix: will be added after the number, eg "0.prefixdist.txt.gz"
+* NProc: number of processes over which to split trajectories
 * Verbose: boolean, display verbose messages?"""
   #check path
   if not os.path.isdir(OutputPath): os.mkdir(OutputPath)
-  #find all trajectories
-  TrjList, ReplicaInd = GetTrjList(DataPath, ReplicaInd)       
-  #for each trajectory
-  for TrjFile in TrjList:
-    #get trj prefix
-    if Verbose: print "Processing trajectory %s" % TrjFile
-    TrjPrefix = os.path.basename(TrjFile).replace("mdtrj.crd", "").replace(".gz", "").strip()
-    PrmtopFile =  os.path.join(DataPath, TrjPrefix + "prmtop.parm7")
-    SaveTrjResDists(TrjFile, PrmtopFile, OutputPath, PairList,
-      NSkip = NSkip, NRead = NRead, NStride = NStride,
-      Prefix = TrjPrefix + Prefix, DistMethod = DistMethod,
-      StartRes = StartRes, Verbose = Verbose)   
+  #run each trajectory
+  RunAllTrj(DataPath, SaveTrjResDists, Args = (OutputPath, PairList),
+    KwArgs = {"NSkip" : NSkip, "NRead" : NRead, "NStride" : NStride,
+              "DistMethod" : DistMethod, "StartRes" : StartRes,
+              "Verbose" : Verbose},
+    ReplicaInd = ReplicaInd, Prefix = Prefix, NProc = NProc, Verbose = Verbose)
   if Verbose: print "Done processing trajectory distances"
   
 
@@ -7,7 +7,7 @@ Produces mesoresults.txt."
 
 Usage     : mesoanalysis.py trjfile prmtopfile [nskip nread nstride]
 
-trjfile   : trajectory CRD file (can be gzipped)
+trjfile   : trajectory CRD file (can be gzipped) or NetCDF file
 prmtopfile: PARM7 file
 nskip     : number of configs in trajectory to skip (default is 0)
 nread     : number of configs in trajectory to read; -1 is all (default -1)
@@ -166,7 +166,7 @@ def RunAnalTrj(TrjFile, PrmtopFile, OutputPath = None, Prefix = None,
   NSkip = 0, NRead = None, NStride = 1):
   "Runs a mesostring analysis of a trajectory."
   #make the coords object
-  CoordsObj = coords.TrjClass(TrjFile, PrmtopFile,
+  CoordsObj = coords.OpenTrj(TrjFile, PrmtopFile,
       NSkip = NSkip, NRead = NRead, NStride = NStride)
   ConfMeso, MesoPop, MesoEntropy = RunAnal(CoordsObj, OutputPath, Prefix)
   return ConfMeso, MesoPop, MesoEntropy
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+
+#LAST MODIFIED: 10-18-26
+
+Usage = """Computes the rmsd between all pairs of frames in an amber trajectory
+or a list of pdb files.  The matrix is saved as a float32 numpy .npy file
+that can be memory-mapped with numpy.load(OUTFILE, mmap_mode='r').
+
+Usage     : pairrmsd.py TRJFILE PRMTOPFILE OUTFILE [OPTIONS]
+   OR     : pairrmsd.py PDBFILES OUTFILE [OPTIONS]
+
+PDBFILES  : list of pdb files
+TRJFILE   : trajectory CRD file (can be gzipped) or NetCDF file
+PRMTOPFILE: PARM7 file
+OUTFILE   : output .npy file; rerunning an interrupted run with the same
+            OUTFILE continues from the last finished tile
+OPTIONS   : "--nskip=X" number of configs in trajectory to skip (default is 0)
+            "--nread=X" number of configs in trajectory to read; -1 is all (default -1)
+            "--nstride=X" read configs every nstride frames (default is 1)
+            "--allatom" to use all atom rmsd (default is backbone)
+            "--alphacarbon" to use just alpha carbon (default is backbone)
+            "--compres='1,3-5'" to use residues 1 and 3-5 to minimize RMSD
+            "--calcres='1-5,9'" to calculate rmsd only for residues 1-5 and 9
+            "--nproc=X" number of processes (default 1)
+            "--tile=X" number of frames along each side of a tile (default 512)
+"""
+
+#check for instructions
+import sys
+if __name__ == "__main__" and len(sys.argv) == 1:
+  print Usage
+  sys.exit()
+
+from numpy import *
+from numpy.lib.format import open_memmap
+import os, time, zlib, multiprocessing
+import coords, rmsd, ambermask, scripttools
+
+#GLOBALS
+TileSize = 512          #frames along each side of a tile
+NProcDflt = 1
+FramesExt = ".frames.npy"
+DoneExt = ".done"
+
+
+def SubsetInd(CompInd, CalcInd):
+  """Returns (AtomInd, CompInd, CalcInd) where AtomInd holds the atoms used
+by either of CompInd and CalcInd (None for all), and the returned CompInd and
+CalcInd index within AtomInd."""
+  if CompInd is None or CalcInd is None:
+    return None, CompInd, CalcInd
+  AtomInd = union1d(CompInd, CalcInd)
+  return AtomInd, searchsorted(AtomInd, CompInd), searchsorted(AtomInd, CalcInd)
+
+
+def EndFrames(CoordsObj):
+  """Returns the first and last frames of a coords object as a float32
+array of dimensions [2,N,3], which identify its input."""
+  return array([CoordsObj.Get(0), CoordsObj.Get(len(CoordsObj) - 1)], float32)
+
+
+def CacheFrames(CoordsObj, FramesFile, AtomInd = None, Verbose = True,
+                Ends = None):
+  """Saves the positions of the atoms AtomInd (None for all) in every frame
+of a coords object to a float32 .npy file, so that worker processes can
+memory-map them.  An existing file is reused only if it has the right shape
+and the same first and last frames; Ends optionally gives those frames, as
+from EndFrames."""
+  NFrame = len(CoordsObj)
+  if Ends is None: Ends = EndFrames(CoordsObj)
+  if not AtomInd is None: Ends = Ends.take(AtomInd, axis=1)
+  Shape = (NFrame,) + Ends.shape[1:]
+  if os.path.isfile(FramesFile):
+    try:
+      Frames = load(FramesFile, mmap_mode = "r")
+      Same = Frames.shape == Shape and all(Frames[0] == Ends[0]) \
+             and all(Frames[-1] == Ends[1])
+      del Frames
+      if Same:
+        if Verbose: print "Using cached frames in %s" % FramesFile
+        return
+    except (IOError, ValueError):
+      pass
+  if Verbose: print "Caching %d frames in %s" % (NFrame, FramesFile)
+  #write to a temporary file so a partial cache is never reused
+  TmpFile = FramesFile + ".tmp.npy"
+  Frames = open_memmap(TmpFile, mode = "w+", dtype = float32, shape = Shape)
+  Start = 0
+  for Block in rmsd.IterFrameBlocks(CoordsObj):
+    if not AtomInd is None: Block = Block.take(AtomInd, axis=1)
+    Frames[Start:Start+len(Block)] = Block
+    Start += len(Block)
+  if not Start == NFrame:
+    raise IOError, "Read %d frames but expected %d." % (Start, NFrame)
+  Frames.flush()
+  del Frames
+  os.rename(TmpFile, FramesFile)
+
+
+def GetTiles(NFrame, Size):
+  "Returns the tiles (i0, i1, j0, j1) covering the upper triangle."
+  Starts = range(0, NFrame, Size)
+  return [(i0, min(i0+Size, NFrame), j0, min(j0+Size, NFrame))
+          for i0 in Starts for j0 in Starts if j0 >= i0]
+
+
+def DoneHeader(NFrame, Size, AtomInd, CompInd, CalcInd, Ends, Ident = ""):
+  """Returns the first line of a done file, which identifies the frame and
+atom counts, tiling, atom selections and input of a calculation; Ends holds
+the first and last frames (from EndFrames) and Ident is an optional string
+naming the input (eg, its files and options)."""
+  Key = zlib.crc32(repr([None if x is None else list(x)
+                         for x in (AtomInd, CompInd, CalcInd)]))
+  Key = zlib.crc32(Ends.tostring(), Key)
+  Key = zlib.crc32(Ident, Key) & 0xffffffff
+  return "# %d %d %d %08x\n" % (NFrame, Ends.shape[1], Size, Key)
+
+
+def LoadDone(DoneFile, Header):
+  """Returns the set of finished tiles (i0, j0) recorded in a done file,
+or None if the file is missing or was made for a different calculation."""
+  if not os.path.isfile(DoneFile): return None
+  Lines = file(DoneFile, "r").readlines()
+  if len(Lines) == 0 or not Lines[0] == Header:
+    return None
+  Done = set()
+  for l in Lines[1:]:
+    #skip a partly-written last line
+    if not l.endswith("\n"): continue
+    i0, j0 = [int(x) for x in l.split()]
+    Done.add((i0, j0))
+  return Done
+
+
+def _TileTask(Task):
+  """Computes one tile of the rmsd matrix and writes it, and its transpose,
+to the output file; used by PairRMSD in worker processes."""
+  FramesFile, OutFile, (i0, i1, j0, j1), CompInd, CalcInd = Task
+  Frames = load(FramesFile, mmap_mode = "r")
+  Out = load(OutFile, mmap_mode = "r+")
+  Rows = array(Frames[i0:i1], float)
+  Cols = array(Frames[j0:j1], float)
+  Tile = zeros((i1 - i0, j1 - j0), float32)
+  for (k, Pos) in enumerate(Rows):
+    #on diagonal tiles, only the part above the diagonal is needed
+    l = 0
+    if i0 == j0: l = k + 1
+    if l >= len(Cols): continue
+    Tile[k,l:] = rmsd.RMSDMany(Pos, Cols[l:], CompInd = CompInd, CalcInd = CalcInd)
+  if i0 == j0: Tile = Tile + Tile.T
+  Out[i0:i1,j0:j1] = Tile
+  Out[j0:j1,i0:i1] = Tile.T
+  Out.flush()
+  del Out
+  return (i0, j0)
+
+
+def PairRMSD(CoordsObj, OutFile, CompInd = None, CalcInd = None,
+             Size = None, NProc = NProcDflt, FramesFile = None,
+             KeepFrames = False, Ident = "", Verbose = True):
+  """Computes the rmsd between every pair of frames in a coords object and
+saves it as an N by N float32 matrix in the .npy file OutFile.  Returns the
+matrix, memory-mapped read-only.
+* CoordsObj: coords object (eg, from coords.OpenTrj)
+* OutFile: string name of the output .npy file
+* CompInd: indices for positions to perform alignment, or an Amber mask
+* CalcInd: indices for positions to compute RMSD, or an Amber mask
+* Size: number of frames along each side of a tile (default TileSize)
+* NProc: number of processes (default 1 runs in this process; None is
+         the number of cpus)
+* FramesFile: file for the cached frames (default OutFile + ".frames.npy")
+* KeepFrames: True to keep the cached frames when finished
+* Ident: optional string naming the input (eg, its files and options)
+The upper triangle is split into tiles that are computed independently.
+Finished tiles are recorded in OutFile + ".done", so a rerun of an
+interrupted calculation only computes the remaining tiles.  A rerun only
+resumes if the frame and atom counts, atom selections, tiling, Ident and
+first and last frames are all the same; otherwise it starts over."""
+  if Size is None: Size = TileSize
+  if FramesFile is None: FramesFile = OutFile + FramesExt
+  DoneFile = OutFile + DoneExt
+  NFrame = len(CoordsObj)
+  #compile any mask strings and keep only the atoms that are used
+  CompInd = ambermask.CoordsObjMaskInd(CoordsObj, CompInd)
+  CalcInd = ambermask.CoordsObjMaskInd(CoordsObj, CalcInd)
+  AtomInd, CompInd, CalcInd = SubsetInd(CompInd, CalcInd)
+  #find finished tiles from a previous run of the same calculation
+  Ends = EndFrames(CoordsObj)
+  Header = DoneHeader(NFrame, Size, AtomInd, CompInd, CalcInd, Ends, Ident)
+  Done = None
+  if os.path.isfile(OutFile):
+    Done = LoadDone(DoneFile, Header)
+    try:
+      if not load(OutFile, mmap_mode = "r").shape == (NFrame, NFrame):
+        Done = None
+    except (IOError, ValueError):
+      Done = None
+  if Done is None:
+    #start over, without any frames cached for a different calculation
+    Done = set()
+    if os.path.isfile(FramesFile): os.remove(FramesFile)
+    Out = open_memmap(OutFile, mode = "w+", dtype = float32, shape = (NFrame, NFrame))
+    del Out
+    f = file(DoneFile, "w")
+    f.write(Header)
+    f.close()
+  Tiles = [t for t in GetTiles(NFrame, Size) if not (t[0], t[2]) in Done]
+  if Verbose: print "%d of %d tiles left to compute" % (len(Tiles), len(Tiles) + len(Done))
+  if len(Tiles) > 0:
+    CacheFrames(CoordsObj, FramesFile, AtomInd, Verbose, Ends)
+    Tasks = [(FramesFile, OutFile, t, CompInd, CalcInd) for t in Tiles]
+    if NProc is None: NProc = multiprocessing.cpu_count()
+    NProc = max(min(NProc, len(Tasks)), 1)
+    StartTime = time.time()
+    if NProc == 1:
+      Results = (_TileTask(Task) for Task in Tasks)
+      Pool = None
+    else:
+      if Verbose: print "Computing tiles on %d processes" % NProc
+      Pool = multiprocessing.Pool(NProc)
+      Results = Pool.imap_unordered(_TileTask, Tasks)
+    f = file(DoneFile, "a")
+    try:
+      for (i, (i0, j0)) in enumerate(Results):
+        #tiles are only recorded once their data have been flushed
+        f.write("%d %d\n" % (i0, j0))
+        f.flush()
+        if Verbose: print "Finished tile %d of %d (%.0f sec)" % (i+1, len(Tasks),
+                                                               time.time() - StartTime)
+      if not Pool is None: Pool.close()
+    except:
+      if not Pool is None: Pool.terminate()
+      raise
+    finally:
+      f.close()
+      if not Pool is None: Pool.join()
+  if not KeepFrames and os.path.isfile(FramesFile):
+    os.remove(FramesFile)
+  return load(OutFile, mmap_mode = "r")
+
+
+#======== COMMAND LINE RUNNING ========
+
+if __name__ == "__main__":
+  Args = scripttools.ParseArgs(sys.argv[1:])
+  NSkip = int(Args.get("nskip", 0))
+  NRead = int(Args.get("nread", -1))
+  NStride = int(Args.get("nstride", 1))
+  NProc = int(Args.get("nproc", NProcDflt))
+  Size = int(Args.get("tile", TileSize))
+  CompResInd = scripttools.GetNumList(Args.get("compres", None), Offset = -1)
+  CalcResInd = scripttools.GetNumList(Args.get("calcres", None), Offset = -1)
+
+  #decide mask
+  if "allatom" in Args["FLAGS"]:
+    Mask = coords.NoMask
+  elif "alphacarbon" in Args["FLAGS"]:
+    Mask = coords.AlphaCarbonMask
+  else:
+    Mask = coords.BackboneMask
+
+  #decide mode
+  if ".pdb" in Args[0]:
+    PdbFiles, OutFile = Args["ARGS"][:-1], Args["ARGS"][-1]
+    cobj = coords.PdbListClass(PdbFiles, Mask = Mask)
+    Ident = repr([os.path.abspath(x) for x in PdbFiles])
+  else:
+    TrjFile, PrmtopFile, OutFile = Args["ARGS"][:3]
+    cobj = coords.OpenTrj(TrjFile, PrmtopFile, Mask = Mask,
+                          NRead = NRead, NSkip = NSkip, NStride = NStride)
+    Ident = repr([os.path.abspath(TrjFile), os.path.abspath(PrmtopFile),
+                  NSkip, NRead, NStride])
+  Ident += repr(Mask)
+
+  #examine any residue specific masks
+  AtomInd, CompInd, CalcInd = rmsd.GetCoordsObjMasks(cobj, AtomMask = Mask,
+                                                     CompResInd = CompResInd,
+                                                     CalcResInd = CalcResInd)
+  PairRMSD(cobj, OutFile, CompInd = CompInd, CalcInd = CalcInd,
+           Size = Size, NProc = NProc, Ident = Ident)
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-#LAST MODIFIED: 12-19-08
+#LAST MODIFIED: 10-18-26
 
 Usage = """Calculates rmsd between pdb files.
 
@@ -24,31 +24,61 @@ if __name__ == "__main__" and len(sys.argv) == 1:
   sys.exit()
 
 from numpy import *  
-import copy, os, coords, random
-import geometry, sequence, protein, scripttools
+import copy, os, coords, random, multiprocessing
+import geometry, sequence, protein, scripttools, ambermask
+
+#GLOBALS
+BlockSize = 256    #frames aligned at a time by RMSDMany callers
+UseQCP = True      #use QCP instead of SVD when no alignment is needed
+CentBlockSize = 16 #centroids compared at a time by ClusterMSS
+PruneTol = 1.e-5   #margin for triangle-inequality pruning in ClusterMSS
+
+
+def SameInd(Ind1, Ind2):
+  "Returns True if two index arrays (or None for all) are the same."
+  if Ind1 is None or Ind2 is None: return Ind1 is Ind2
+  return len(Ind1) == len(Ind2) and all(asarray(Ind1) == asarray(Ind2))
+
+
+def TakeWeights(Weights, Ind, N):
+  "Returns the weights and their sum for the positions in Ind."
+  if Weights is None:
+    if Ind is None: return None, float(N)
+    return None, float(len(Ind))
+  if not Ind is None: Weights = Weights.take(Ind)
+  return Weights, Weights.sum()
 
 
 def RMSD(Pos1, Pos2, Align = False, Center = True,
          CompInd = None, CalcInd = None, Verbose = False,
-         RetAlignment = False):
+         RetAlignment = False, Weights = None):
   """Calculates the RMSD between two conformations.
 * Pos1: array of dimensions [N,3] for conformation 1
 * Pos2: array of dimensions [N,3] for conformation 2
 * Align: True = modify Pos2 to be aligned to Pos1
   (default is False)
-* CompInd: indices in [0,N) for positions in Pos to perform alignment
+* CompInd: indices in [0,N) for positions in Pos to perform alignment,
+  eg, an index array from ambermask.GetMaskInd
 * CalcInd: indices in [0,N) for positions in Pos to compute RMSD
 * Verbose: true to report shape/size mismatches
-* RetAlignment: True to return the translation vectors and rotation matrix"""
+* RetAlignment: True to return the translation vectors and rotation matrix
+* Weights: optional array of N weights (eg, masses) for a weighted fit
+  and rmsd
+If neither Align nor RetAlignment is set, the rmsd comes from the QCP
+method (geometry.QCPAlignment) instead of a singular value decomp."""
   #clean indices
-  AllInd = arange(len(Pos1), dtype = int)
-  if all(CompInd == AllInd): CompInd = None
-  if all(CalcInd == AllInd): CalcInd = None
+  N = len(Pos1)
+  if not CompInd is None and len(CompInd) == N and SameInd(CompInd, arange(N)):
+    CompInd = None
+  if not CalcInd is None and len(CalcInd) == N and SameInd(CalcInd, arange(N)):
+    CalcInd = None
+  if not Weights is None: Weights = asarray(Weights, float)
   #get indices
   if CompInd is None:
-    p1, p2, n = Pos1, Pos2, len(Pos1)
+    p1, p2 = Pos1, Pos2
   else:
-    p1, p2, n = Pos1.take(CompInd, axis=0), Pos2.take(CompInd, axis=0), len(CompInd)
+    p1, p2 = Pos1.take(CompInd, axis=0), Pos2.take(CompInd, axis=0)
+  w, n = TakeWeights(Weights, CompInd, N)
   #check for correct shapes
   if not shape(p1) == shape(p2):
     if Verbose: print "Position vectors are not the same size."
@@ -57,17 +87,27 @@ def RMSD(Pos1, Pos2, Align = False, Center = True,
     if Verbose: print "Position vectors are not the correct rank."
     return
   #get alignment
-  Pos1Vec, Pos2Vec, RotMat, Resid = geometry.AlignmentRMSD(p1, p2, Center = Center)
+  SameCalc = SameInd(CompInd, CalcInd)
+  if UseQCP and not Align and not RetAlignment:
+    Pos1Vec, Pos2Vec, RotMat, Resid = geometry.QCPAlignment(p1, p2, Center = Center,
+                                      Weights = w, RetRot = not SameCalc)
+  else:
+    Pos1Vec, Pos2Vec, RotMat, Resid = geometry.AlignmentRMSD(p1, p2, Center = Center,
+                                                             Weights = w)
   #compute rmsd
-  if not all(CompInd == CalcInd):
+  if not SameCalc:
     if CalcInd is None:
-      p1, p2, n = Pos1, Pos2, len(Pos1)
+      p1, p2 = Pos1, Pos2
     else:
-      p1, p2, n = Pos1.take(CalcInd, axis=0), Pos2.take(CalcInd, axis=0), len(CalcInd)
+      p1, p2 = Pos1.take(CalcInd, axis=0), Pos2.take(CalcInd, axis=0)
+    w, n = TakeWeights(Weights, CalcInd, N)
     p1 = p1 + Pos1Vec
     p2 = dot(p2 + Pos2Vec, RotMat)
-    Resid = sum((p1 - p2)**2, axis=None)
-  r = sqrt(Resid / float(n))
+    if w is None:
+      Resid = sum((p1 - p2)**2, axis=None)
+    else:
+      Resid = dot(w, ((p1 - p2)**2).sum(axis=1))
+  r = sqrt(Resid / n)
   #align Pos2 to Pos1
   if Align: Pos2[:,:] = dot(Pos2 + Pos2Vec, RotMat) - Pos1Vec
   if RetAlignment:
@@ -76,6 +116,95 @@ def RMSD(Pos1, Pos2, Align = False, Center = True,
     return r
 
 
+def RMSDMany(Ref, Frames, Align = False, Center = True,
+             CompInd = None, CalcInd = None, RetAlignment = False,
+             Weights = None):
+  """Calculates the RMSD between one conformation and a block of
+conformations, aligning the whole block at once.
+* Ref: array of dimensions [N,3] for the reference conformation
+* Frames: array of dimensions [n,N,3] of conformations to compare
+* Align: True = modify Frames to be aligned to Ref (default is False);
+  Frames must then be a float array
+* CompInd: indices in [0,N) for positions in Pos to perform alignment
+* CalcInd: indices in [0,N) for positions in Pos to compute RMSD
+* RetAlignment: True to also return the translation vectors and
+  rotation matrices, as arrays of dimensions [3], [n,3] and [n,3,3]
+* Weights: optional array of N weights (eg, masses) for a weighted fit
+  and rmsd
+Returns an array of n RMSD values, or the tuple (r, RefVec,
+FramesVec, RotMat) if RetAlignment is True; each frame is aligned
+as dot(Frames[i] + FramesVec[i], RotMat[i]) - RefVec.  As in RMSD,
+the QCP method is used if neither Align nor RetAlignment is set."""
+  Ref = asarray(Ref, float)
+  if not Align:
+    Frames = asarray(Frames, float)
+  elif not isinstance(Frames, ndarray) or not Frames.dtype.kind == "f":
+    raise ValueError, "Frames must be a float array to be aligned in place."
+  if Frames.ndim == 2: Frames = Frames[newaxis]
+  N = len(Ref)
+  if not Frames.shape[1:] == Ref.shape:
+    raise ValueError, "Position arrays are not the same size."
+  if not CompInd is None and len(CompInd) == N and SameInd(CompInd, arange(N)):
+    CompInd = None
+  if not CalcInd is None and len(CalcInd) == N and SameInd(CalcInd, arange(N)):
+    CalcInd = None
+  if not Weights is None: Weights = asarray(Weights, float)
+  #get positions for the alignment
+  if CompInd is None:
+    p1, p2 = Ref, Frames
+  else:
+    p1, p2 = Ref.take(CompInd, axis=0), Frames.take(CompInd, axis=1)
+  w, n = TakeWeights(Weights, CompInd, N)
+  #align all of the frames at once
+  SameCalc = SameInd(CompInd, CalcInd)
+  if UseQCP and not Align and not RetAlignment:
+    RefVec, FramesVec, RotMat, Resid = geometry.QCPAlignment(p1, p2, Center = Center,
+                                       Weights = w, RetRot = not SameCalc)
+  else:
+    RefVec, FramesVec, RotMat, Resid = geometry.AlignmentRMSDMany(p1, p2,
+                                       Center = Center, Weights = w)
+  #compute rmsd
+  if not SameCalc:
+    if CalcInd is None:
+      p1, p2 = Ref, Frames
+    else:
+      p1, p2 = Ref.take(CalcInd, axis=0), Frames.take(CalcInd, axis=1)
+    w, n = TakeWeights(Weights, CalcInd, N)
+    p1 = p1 + RefVec
+    p2 = matmul(p2 + FramesVec[:,newaxis,:], RotMat)
+    if w is None:
+      Resid = ((p1 - p2)**2).sum(axis=2).sum(axis=1)
+    else:
+      Resid = dot(((p1 - p2)**2).sum(axis=2), w)
+  r = sqrt(Resid / n)
+  #align the frames to the reference
+  if Align:
+    Frames[:] = matmul(Frames + FramesVec[:,newaxis,:], RotMat) - RefVec
+  if RetAlignment:
+    return r, RefVec, FramesVec, RotMat
+  else:
+    return r
+
+
+def IterFrameBlocks(CoordsObj, NFrames = None):
+  """Iterates over the frames of a coords object in blocks of up to
+NFrames frames, yielding arrays of dimensions [n,N,3].  Blocks may be
+reused between iterations, so copy one if it needs to be kept."""
+  if NFrames is None: NFrames = BlockSize
+  if hasattr(CoordsObj, "IterChunks"):
+    for Block in CoordsObj.IterChunks(NFrames):
+      yield Block
+    return
+  CoordsObj.Reset()
+  l = []
+  for Pos in CoordsObj:
+    l.append(array(Pos, float))
+    if len(l) == NFrames:
+      yield array(l)
+      l = []
+  if len(l) > 0: yield array(l)
+
+
 def GetProteinClassMasks(p, AtomMask = None, CompResInd = None,
                          CalcResInd = None):
   if AtomMask is None:
@@ -134,14 +263,17 @@ def GetCoordsObjMasks(c, AtomMask = None, CompResInd = None,
   return AtomInd, CompInd, CalcInd
 
 
-def RMSDProteinClass(p1, p2, Center = True, Backbone = True, AlignSeq = False,
-                     CompResInd = None, CalcResInd = None, UpdateBFactors = False,
-                     AlignAtoms = False):
-  "Returns (RMSD,NRes)"
+def ProteinClassInd(p1, p2, Backbone = True, AlignSeq = False,
+                    CompResInd = None, CalcResInd = None, AlignAtoms = False):
+  """Returns (AtomInd1, AtomInd2, CompInd, CalcInd, NRes) for comparing two
+ProteinClass objects, where AtomInd1 and AtomInd2 index the atoms of p1 and
+p2 that are compared and CompInd and CalcInd index within those."""
   #align the sequences
-  p2orig = p2
+  Off1, Off2 = 0, 0
   if AlignSeq:
     Map = sequence.SeqMapClass(p1.Seq, p2.Seq)
+    if Map.a < len(p1.Res): Off1 = p1.Res[Map.a].StartAtom
+    if Map.c < len(p2.Res): Off2 = p2.Res[Map.c].StartAtom
     p1 = p1[Map.a:Map.b]
     p2 = p2[Map.c:Map.d]
   #filter res indices
@@ -164,23 +296,34 @@ def RMSDProteinClass(p1, p2, Center = True, Backbone = True, AlignSeq = False,
     AtomInd2, CompInd, CalcInd = GetProteinClassMasks(p2, AtomMask = AtomMask,
                                                       CompResInd = CompResInd,
                                                       CalcResInd = CalcResInd)
-  #filter positions
-  Pos1, Pos2 = p1.Pos.take(AtomInd1, axis=0), p2.Pos.take(AtomInd2, axis=0).copy()
-  #compute rmsd
-  r = RMSD(Pos1, Pos2, Align = True, Center = Center,
-           CompInd = CompInd, CalcInd = CalcInd)
   #determine num of residues used in rmsd calculation
   if CalcResInd is None:
     NRes = len(p1)
   else:
     NRes = len(CalcResInd)
+  AtomInd1 = asarray(AtomInd1, int) + Off1
+  AtomInd2 = asarray(AtomInd2, int) + Off2
+  return AtomInd1, AtomInd2, CompInd, CalcInd, NRes
+
+
+def RMSDProteinClass(p1, p2, Center = True, Backbone = True, AlignSeq = False,
+                     CompResInd = None, CalcResInd = None, UpdateBFactors = False,
+                     AlignAtoms = False):
+  "Returns (RMSD,NRes)"
+  AtomInd1, AtomInd2, CompInd, CalcInd, NRes = ProteinClassInd(p1, p2,
+    Backbone = Backbone, AlignSeq = AlignSeq, CompResInd = CompResInd,
+    CalcResInd = CalcResInd, AlignAtoms = AlignAtoms)
+  #filter positions
+  Pos1, Pos2 = p1.Pos.take(AtomInd1, axis=0), p2.Pos.take(AtomInd2, axis=0).copy()
+  #compute rmsd
+  r = RMSD(Pos1, Pos2, Align = True, Center = Center,
+           CompInd = CompInd, CalcInd = CalcInd)
   #see if we need to update bfactors
   if UpdateBFactors:
     if CalcInd is None: CalcInd = range(len(AtomInd2))
-    Shift = p2orig.Res[Map.c].StartAtom
     for i in CalcInd:
-      an = AtomInd2[i] + Shift
-      p2orig.Atoms[an].BFactor = sqrt(sum((Pos1[i] - Pos2[i])**2))   
+      an = AtomInd2[i]
+      p2.Atoms[an].BFactor = sqrt(sum((Pos1[i] - Pos2[i])**2))   
   return r, NRes
 
 
@@ -192,10 +335,119 @@ def RMSDPdb(PdbFile1, PdbFile2, Center = True, Backbone = True,
                           AlignSeq = AlignSeq, CompResInd = CompResInd,
                           CalcResInd = CalcResInd)
 
+class CentBoundsClass:
+  """Holds lower and upper bounds on the rmsd between each pair of
+cluster centroids, for pruning comparisons with the triangle inequality."""
+
+  def __init__(self):
+    self.N = 0
+    self.Lo = zeros((0,0), float)
+    self.Hi = zeros((0,0), float)
+
+  def Add(self, Lo, Hi):
+    "Adds a centroid with bounds Lo and Hi to each existing centroid."
+    if self.N == len(self.Lo):
+      #grow the storage by doubling
+      Cap = max(2 * self.N, 16)
+      NewLo, NewHi = zeros((Cap,Cap), float), zeros((Cap,Cap), float)
+      NewLo[:self.N,:self.N] = self.Lo[:self.N,:self.N]
+      NewHi[:self.N,:self.N] = self.Hi[:self.N,:self.N]
+      self.Lo, self.Hi = NewLo, NewHi
+    n = self.N
+    self.Lo[n,:n] = Lo
+    self.Lo[:n,n] = Lo
+    self.Hi[n,:n] = Hi
+    self.Hi[:n,n] = Hi
+    self.Lo[n,n], self.Hi[n,n] = 0., 0.
+    self.N += 1
+
+  def Move(self, i, Drift):
+    "Widens the bounds of centroid i after it moves by up to Drift."
+    n = self.N
+    self.Lo[i,:n] -= Drift
+    self.Lo[:n,i] -= Drift
+    self.Hi[i,:n] += Drift
+    self.Hi[:n,i] += Drift
+
+  def LowerBounds(self, Ind, r):
+    """Returns lower bounds on the rmsd of a configuration to every
+centroid, given its rmsd values r to the centroids in Ind."""
+    n = self.N
+    Lo = self.Lo[Ind,:n] - r[:,newaxis]
+    Lo = maximum(Lo, r[:,newaxis] - self.Hi[Ind,:n])
+    return Lo.max(axis=0)
+
+
+def CentRMSDMany(Pos, Cents, Method = 0, CompInd = None, CalcInd = None):
+  """Returns the rmsd between a configuration and an array of cluster
+centroids, with alignment (Method 0) or without (Method 1)."""
+  if Method == 0:
+    return RMSDMany(Pos, Cents, Center = True, CompInd = CompInd, CalcInd = CalcInd)
+  if not CalcInd is None:
+    Pos, Cents = Pos[CalcInd], Cents[:,CalcInd]
+  return sqrt(((Cents - Pos)**2).sum(axis=2).mean(axis=1))
+
+
+#iteration-start centroids and options in a ClusterMSS worker process
+__ScanData = None
+
+def __ScanInit(Cents, Cutoff, Method, CompInd, CalcInd):
+  "Stores the iteration-start centroids in a worker process."
+  global __ScanData
+  __ScanData = (Cents, Cutoff, Method, CompInd, CalcInd)
+
+def __ScanTask(Task):
+  """Returns (config index, rmsd values) for each weighted config in a
+block of frames, where the rmsd values are to the iteration-start centroids
+up to and including the first within the cutoff."""
+  Start, Block, Weights = Task
+  Cents, Cutoff, Method, CompInd, CalcInd = __ScanData
+  Ret = []
+  for (k, Pos) in enumerate(Block):
+    if Weights[k] == 0.: continue
+    r = zeros(0, float)
+    for i in range(0, len(Cents), CentBlockSize):
+      r = concatenate((r, CentRMSDMany(Pos, Cents[i:i+CentBlockSize], Method,
+                                       CompInd, CalcInd)))
+      Hits = nonzero(r[i:] < Cutoff)[0]
+      if len(Hits) > 0:
+        r = r[:i + Hits[0] + 1]
+        break
+    Ret.append((Start + k, r))
+  return Ret
+
+
+def __ScanSnapshot(CoordsObj, Cents, Cutoff, Method, CompInd, CalcInd,
+                   Weights, NProc):
+  """Compares every config to a fixed set of centroids on NProc processes;
+returns a list of the rmsd values from __ScanTask for each config (None for
+configs with zero weight)."""
+  Snap = [None] * len(Weights)
+  def Tasks():
+    Start = 0
+    for Block in IterFrameBlocks(CoordsObj):
+      #blocks may be reused by the coords object, so send copies
+      yield (Start, array(Block, float), Weights[Start:Start+len(Block)])
+      Start += len(Block)
+  Pool = multiprocessing.Pool(NProc, initializer = __ScanInit,
+                              initargs = (array(Cents), Cutoff, Method, CompInd, CalcInd))
+  try:
+    for Ret in Pool.imap_unordered(__ScanTask, Tasks()):
+      for (i, r) in Ret:
+        Snap[i] = r
+    Pool.close()
+  except:
+    Pool.terminate()
+    raise
+  finally:
+    Pool.join()
+  return Snap
+
+
 def ClusterMSS(CoordsObj, Cutoff, MaxIter = 3, MaxCluster = None,
   MaxClusterWork = None, Method = 0, CompInd = None, CalcInd = None,
   Weights = None, Verbose = True, IterMaxCluster = False,
-  IterNormalize = False):
+  IterNormalize = False, Prune = True, NProc = 1, Relaxed = False):
   """Clusters conformations in a trajectory based on RMSD distance.
 * CoordsObj: an object exposing the functions GetNextCoords() which
   returns an array object of the next set of coordinates (or None
@@ -209,20 +461,43 @@ def ClusterMSS(CoordsObj, Cutoff, MaxIter = 3, MaxCluster = None,
 * Method: 0 to cluster such that each RMSD between a configuration
   and the average cluster configuration is below Cutoff; 1 is
   same except no alignment is performed
-* CompInd: indices in [0,N) for positions in Pos to perform alignment
-* CalcInd: indices in [0,N) for positions in Pos to compute RMSD
+* CompInd: indices in [0,N) for positions in Pos to perform alignment,
+  or an Amber mask string (eg, ":1-20@CA") compiled against CoordsObj
+* CalcInd: indices in [0,N) for positions in Pos to compute RMSD,
+  or an Amber mask string
 * Weights: weighting factor for each conformation
 * IterMaxCluster: True will dump all but MaxCluster configs each iter
 * IterNormalize: True will dump previous iter contribs to centroids
+* Prune: True to skip centroids that the triangle inequality shows
+  are beyond Cutoff, trying the previous config's cluster first; this
+  does not change the assignments, and is only done when rmsd values
+  are a metric (Method 1, or CompInd the same as CalcInd)
+* NProc: number of processes that compare configs to the centroids at
+  the start of each iteration; clusters are still updated and created
+  serially (default 1 does everything serially; None is the number of cpus)
+* Relaxed: False (default) to recheck serially any config whose cluster
+  could have changed as centroids moved during the pass, which gives the
+  same clusters as NProc = 1; True to keep the parallel results, which
+  is faster but may assign some configs differently
 """
-  def BasicRMSD(Pos1, Pos2, Ind = None):
-    "Calculates the rmsd between two configurations without alignment."
-    if Ind is None:
-      rmsdsq = sum((Pos1-Pos2)**2) / float(size(Pos1,0))
-    else:
-      rmsdqs = sum((Pos1[Ind]-Pos2[Ind])**2) / float(size(Pos1[Ind],0))
-    rmsdsq = max([rmsdsq,0.])
-    return sqrt(rmsdsq)
+  def CentRMSD(Pos, Ind):
+    "Calculates the rmsd between a configuration and the centroids in Ind."
+    r = zeros(len(Ind), float)
+    for i in range(0, len(Ind), BlockSize):
+      ThisCents = array([Cents[j] for j in Ind[i:i+BlockSize]])
+      r[i:i+BlockSize] = CentRMSDMany(Pos, ThisCents, Method, CompInd, CalcInd)
+    return r
+  #compile any mask strings once, against the coords object's atoms
+  CompInd = ambermask.CoordsObjMaskInd(CoordsObj, CompInd)
+  CalcInd = ambermask.CoordsObjMaskInd(CoordsObj, CalcInd)
+  #the triangle inequality only holds if the rmsd is a metric
+  Metric = Method == 1 or SameInd(CompInd, CalcInd)
+  Prune = Prune and Metric
+  #exact parallel passes bound centroid movement with the triangle inequality
+  if NProc is None: NProc = multiprocessing.cpu_count()
+  if NProc > 1 and not Relaxed and not Metric:
+    if Verbose: print "Rmsd values are not a metric; clustering serially"
+    NProc = 1
   Iteration = 0   #iteration number
   WeightSum = []  #total weights of clusters
   PosSum = []        #list of cluster configuration arrays
@@ -253,6 +528,32 @@ def ClusterMSS(CoordsObj, Cutoff, MaxIter = 3, MaxCluster = None,
     ThisFrame = 0
     PosSumThis = copy.deepcopy(PosSum)
     WeightSumThis = copy.deepcopy(WeightSum)
+    #current centroids, updated as configs are added
+    Cents = [x / y for (x, y) in zip(PosSum, WeightSum)]
+    #compare every config to the starting centroids in parallel
+    NSnap = len(Cents)
+    Snap = None
+    if NProc > 1 and NSnap > 0:
+      if Verbose: print "Comparing configs to %d clusters on %d processes" % (NSnap, NProc)
+      Snap = __ScanSnapshot(CoordsObj, Cents, Cutoff, Method, CompInd, CalcInd,
+                            Weights, NProc)
+      #distance each starting centroid has moved, at most
+      Drift = zeros(NSnap, float)
+      NSnapUsed = 0
+    #pair bounds cost a serial pass over the centroids, which parallel
+    #iterations do without
+    PruneIter = Prune and Snap is None
+    #get the rmsd between each pair of starting centroids; this is cheaper
+    #than the pruning lost with bounds carried over from the last iteration
+    NPair = 0
+    if PruneIter:
+      NPair = len(Cents) * (len(Cents) - 1) / 2
+      Bounds = CentBoundsClass()
+      for i in range(len(Cents)):
+        r = CentRMSD(Cents[i], range(i))
+        Bounds.Add(r, r)
+    LastInd = -1     #cluster index of the previous config
+    NAlign, NScan = 0, 0
     #check where to start
     if NewStartInd >= 0: StartInd = NewStartInd
     NewStartInd = -1
@@ -265,39 +566,98 @@ def ClusterMSS(CoordsObj, Cutoff, MaxIter = 3, MaxCluster = None,
         continue
       ThisFrame += 1
       ind = -1  #cluster number assigned to this config; -1 means none
-      #calculate the rmsd between this configuration and each cluster config,
-      #but stop when a rmsd is found which is below the cutoff
-      minRMSD = 1.e300
-      for (i, PosSumi) in enumerate(PosSum):
-        ThisPos = PosSumi / WeightSum[i]
-        if Method == 0:
-          #rmsd between new config and average cluster config
-          r = RMSD(ThisPos, CurPos, Align = True, Center = True,
-                   CompInd = CompInd, CalcInd = CalcInd)
+      #calculate the rmsd between this configuration and blocks of cluster
+      #configs, but stop when a rmsd is found which is below the cutoff;
+      #r holds the rmsd to each cluster config, or -1 if not computed
+      NCent = len(Cents)
+      r = -ones(NCent, float)
+      Lo = zeros(NCent, float)
+      if not Snap is None:
+        #rmsd values to the starting centroids, up to the first within
+        #the cutoff; rs[-1] is below the cutoff if there is a hit
+        rs = Snap[CurInd]
+        Snap[CurInd] = None
+        m = len(rs)
+        Hit = m > 0 and rs[-1] < Cutoff
+        if Relaxed:
+          #keep the parallel result; otherwise only look at new clusters
+          if Hit:
+            ind = m - 1
+          else:
+            Lo[:NSnap] = inf
         else:
-          #rmsd between new config and average cluster config, without alignment
-          r = BasicRMSD(ThisPos, CurPos, Ind = CalcInd)
-        minRMSD = min(minRMSD, r)
-        if r < Cutoff:
-          #go with a cluster if rmsd is within the cutoff
-          ind = i
-          break
+          #the starting centroids have moved by at most Drift, so these
+          #are lower bounds on the rmsd to the current centroids
+          Lo[:m] = maximum(rs - Drift[:m], 0.)
+          if Hit and all(Lo[:m-1] >= Cutoff + PruneTol) \
+             and rs[-1] + Drift[m-1] < Cutoff - PruneTol:
+            ind = m - 1
+        if ind >= 0: NSnapUsed += 1
+      elif PruneIter and LastInd >= 0:
+        #start with the previous config's cluster; its rmsd bounds the
+        #rmsd to the other clusters
+        r[LastInd] = CentRMSD(CurPos, [LastInd])[0]
+        Lo = Bounds.LowerBounds([LastInd], r[LastInd:LastInd+1])
+        NAlign += 1
+      if ind < 0:
+        while True:
+          #the first cluster within the cutoff, so far
+          Hits = nonzero((r >= 0.) & (r < Cutoff))[0]
+          if len(Hits) > 0:
+            Last = Hits[0]
+          else:
+            Last = NCent
+          #clusters before it that haven't been checked or ruled out
+          Cand = nonzero((r[:Last] < 0.) & (Lo[:Last] < Cutoff + PruneTol))[0]
+          if len(Cand) == 0: break
+          Cand = Cand[:CentBlockSize]
+          r[Cand] = CentRMSD(CurPos, Cand)
+          NAlign += len(Cand)
+          if PruneIter: Lo = maximum(Lo, Bounds.LowerBounds(Cand, r[Cand]))
+        if Last < NCent: ind = Last
+        #rmsd values an unpruned search would have computed
+        NScan += min(Last + 1, NCent)
+      if ind >= 0 and Method == 0:
+        #align the config to the cluster config
+        CurPos = array(CurPos, float)
+        rAlign = RMSD(Cents[ind], CurPos, Align = True, Center = True,
+                      CompInd = CompInd, CalcInd = CalcInd)
+        if r[ind] < 0.: r[ind] = rAlign
       if ind >= 0:
         #add the configuration to the cluster
         PosSum[ind] = PosSum[ind] + CurPos * CurWeight
         WeightSum[ind] = WeightSum[ind] + CurWeight
         NAddThis[ind] = NAddThis[ind] + 1
         ClustNum[CurInd] = ind+1
+        Cents[ind] = PosSum[ind] / WeightSum[ind]
+        #the centroid moves by at most this config's share of its rmsd
+        if PruneIter: Bounds.Move(ind, r[ind] * CurWeight / WeightSum[ind])
+        if not Snap is None and ind < NSnap:
+          if r[ind] < 0.: r[ind] = rs[ind] + Drift[ind]
+          Drift[ind] += r[ind] * CurWeight / WeightSum[ind]
       elif len(PosSum) < MaxClusterWork or MaxClusterWork is None:
         #create a new cluster with this config, as long as it
         #doesn't exceed the maximum number of working clusters
-        if minRMSD == 1.e300: minRMSD = 0.
-        if Verbose: print "Adding cluster: config %d (%d/%d) | min RMSD %.1f | %d clusters tot" % (CoordsObj.Index+1,
-                          ThisFrame, NFrameTot, minRMSD, len(PosSum)+1)
+        if Verbose:
+          #rmsd to each cluster, or its lower bound where it was pruned
+          rMin = where(r >= 0., r, Lo)
+          if Relaxed and not Snap is None and m > 0:
+            rMin[:m] = where(r[:m] >= 0., r[:m], rs)
+          if NCent > 0:
+            minRMSD = rMin.min()
+          else:
+            minRMSD = 0.
+          print "Adding cluster: config %d (%d/%d) | min RMSD >= %.1f | %d clusters tot" % (CoordsObj.Index+1,
+                ThisFrame, NFrameTot, minRMSD, len(PosSum)+1)
         PosSum.append(CurPos * CurWeight)
         WeightSum.append(CurWeight)
         NAddThis.append(1)
+        Cents.append(PosSum[-1] / CurWeight)
         ClustNum[CurInd] = len(PosSum)
+        #this config's rmsd values (or their bounds) are the new centroid's
+        if PruneIter:
+          Bounds.Add(where(r >= 0., r, Lo), where(r >= 0., r, inf))
+        ind = len(PosSum) - 1
         FinalIters = 0
       else:
         #cluster is nothing
@@ -306,6 +666,13 @@ def ClusterMSS(CoordsObj, Cutoff, MaxIter = 3, MaxCluster = None,
         if NewStartInd < 0:
           NewStartInd = CurInd
           if Verbose: print "Ran out of clusters. Next iteration starting from config %d" % (CoordsObj.Index+1,)
+      LastInd = ind
+    if Verbose and not Snap is None:
+      print "Kept %d of %d parallel results; computed %d config-cluster rmsd values serially" % (
+            NSnapUsed, ThisFrame, NAlign)
+    elif Verbose and PruneIter:
+      print "Computed %d of %d config-cluster rmsd values (%d skipped), plus %d between clusters" % (
+            NAlign, NScan, max(NScan - NAlign, 0), NPair)
     #remove contribution to centroids from all but this round
     if IterNormalize:
       for i in range(len(PosSumThis)):
@@ -400,21 +767,19 @@ def __CalcForceClust(CoordsObj, ClustWeights, ClustPop, Pos, ClustNum, Weights,
   #count the number of clusterless configurations
   c = sum(ClustNum == 0)
   if Verbose: print "Forcing %d extraneous configurations to existing clusters" % c
-  #find the nearest cluster to each clusterless config and assign it
-  CoordsObj.Reset()
-  for (j, CurPos) in enumerate(CoordsObj):
-    if ClustNum[j] == 0:
-      ind = -1
-      minr = 0.
-      for (i, Posi) in enumerate(Pos):
-        r = RMSD(Posi, CurPos, Align = False, Center = True,
-                 CompInd = CompInd, CalcInd = CalcInd)
-        if r < minr or ind < 0: 
-          ind = i
-          minr = r
-      ClustNum[j] = ind + 1
-      ClustWeights[ind] = ClustWeights[ind] + Weights[j]
-      ClustPop[ind] = ClustPop[ind] + 1.
+  #find the nearest cluster to each clusterless config and assign it,
+  #a block of configs at a time
+  Start = 0
+  for Block in IterFrameBlocks(CoordsObj):
+    Ind = nonzero(ClustNum[Start:Start+len(Block)] == 0)[0]
+    if len(Ind) > 0:
+      r = array([RMSDMany(Posi, Block[Ind], CompInd = CompInd, CalcInd = CalcInd)
+                 for Posi in Pos])
+      for (j, ind) in zip(Ind + Start, r.argmin(axis=0)):
+        ClustNum[j] = ind + 1
+        ClustWeights[ind] = ClustWeights[ind] + Weights[j]
+        ClustPop[ind] = ClustPop[ind] + 1.
+    Start += len(Block)
   return ClustWeights, ClustPop, Pos, ClustNum
   
 
@@ -423,27 +788,26 @@ def __CalcRmsd(CoordsObj, Pos, ClustNum,
   if Verbose: print "Calculating cluster rmsd values"
   #calculate the pairwise cluster rmsd values
   ClustRmsd = zeros((len(Pos), len(Pos)),float)
-  for (i, Posi) in enumerate(Pos):
-    for (j, Posj) in enumerate(Pos):
-      if j <= i: continue
-      ClustRmsd[i,j] = RMSD(Posi, Posj, Align=False, Center=True,
-                            CompInd = CompInd, CalcInd = CalcInd)
-      ClustRmsd[j,i] = ClustRmsd[i,j]
+  for i in range(len(Pos) - 1):
+    ClustRmsd[i,i+1:] = RMSDMany(Pos[i], array(Pos[i+1:]),
+                                 CompInd = CompInd, CalcInd = CalcInd)
+    ClustRmsd[i+1:,i] = ClustRmsd[i,i+1:]
   if Verbose: print "Calculating final rmsd values"
-  #loop through configs and find the one with the lowest
-  #rmsd in each cluster
+  #compute config rmsd values a block at a time, one cluster at a time
   ConfRmsd = -1. * ones(len(ClustNum), float)
+  Start = 0
+  for Block in IterFrameBlocks(CoordsObj):
+    BlockClust = abs(ClustNum[Start:Start+len(Block)]) - 1
+    for i in unique(BlockClust[BlockClust >= 0]):
+      Ind = nonzero(BlockClust == i)[0]
+      ConfRmsd[Ind + Start] = RMSDMany(Pos[i], Block[Ind],
+                                       CompInd = CompInd, CalcInd = CalcInd)
+    Start += len(Block)
+  #find the config with the lowest rmsd in each cluster
   MinRmsd = [-1]*len(Pos)
-  CoordsObj.Reset()
-  for (CurInd, CurPos) in enumerate(CoordsObj):
-    i = abs(ClustNum[CurInd]) - 1
-    if i >= 0:
-      ConfRmsd[CurInd] = RMSD(Pos[i], CurPos, Align=False, Center=True,
-                              CompInd = CompInd, CalcInd = CalcInd)
-      if MinRmsd[i] < 0:
-        MinRmsd[i] = CurInd
-      elif ConfRmsd[MinRmsd[i]] > ConfRmsd[CurInd]:
-        MinRmsd[i] = CurInd
+  for i in range(len(Pos)):
+    Ind = nonzero(abs(ClustNum) == i + 1)[0]
+    if len(Ind) > 0: MinRmsd[i] = Ind[ConfRmsd[Ind].argmin()]
   #loop through the configs again and extract the
   #coords of the minimum-rmsd configs for each clust
   if Verbose: print "Finding nearest cluster structures"
@@ -493,6 +857,30 @@ def SaveClustResults(Pos, ClustNum, ClustWeights, ClustPop, ConfRmsd, ClustRmsd,
       file(fn, "w").write(s)
 
 
+def TestClusterMSS(CoordsObj, Cutoffs = [1., 2., 3.], Mask = "@CA", NProc = 2):
+  """Checks that pruned clustering, and clustering on NProc processes in
+exact (not Relaxed) mode, give the same cluster assignments as an unpruned
+serial search, for both methods, for aligning and computing the rmsd over
+different atoms, with weights, and with a limited number of working
+clusters.  Mask is the Amber mask used for the atom subsets.  Raises
+AssertionError for any difference."""
+  Weights = 0.5 + 0.5 * cos(arange(len(CoordsObj)))
+  Opts = [dict(), dict(Method = 1), dict(CompInd = Mask, CalcInd = Mask),
+          dict(CompInd = Mask), dict(Weights = Weights),
+          dict(MaxClusterWork = 4)]
+  Modes = [("pruned", dict()), ("parallel", dict(NProc = NProc))]
+  for Cutoff in Cutoffs:
+    for Opt in Opts:
+      Ref = ClusterMSS(CoordsObj, Cutoff, Prune = False, Verbose = False, **Opt)
+      for (Name, Mode) in Modes:
+        Kwargs = dict(Mode, **Opt)
+        ClustNum = ClusterMSS(CoordsObj, Cutoff, Verbose = False, **Kwargs)[1]
+        Same = all(ClustNum == Ref[1])
+        print "Cutoff %.1f %s: %d clusters, %s %s" % (Cutoff, sorted(Opt.keys()),
+              len(Ref[0]), Name, ["differs", "same"][Same])
+        if not Same:
+          raise AssertionError, "%s clustering differs from the serial search." % Name
+
 
 #======== COMMAND-LINE RUNNING ========
 
@@ -541,28 +929,38 @@ if __name__ == "__main__":
     NSkip = int(Args.get("nskip", 0))
     NRead = int(Args.get("nread", -1))
     NStride = int(Args.get("nstride", 1))
-    Trj = coords.TrjClass(TrjFile, PrmtopFile, NSkip = NSkip,
+    Trj = coords.OpenTrj(TrjFile, PrmtopFile, NSkip = NSkip,
                           NRead = NRead, NStride = NStride)
     pTrj = protein.ProteinClass()
     pTrj.LinkTrj(Trj)
     pRef = protein.ProteinClass(Pdb = PdbRef)
     print "%-10s %-8s %-8s %-5s" % ("Frame","BB_RMSD", "All_RMSD", "NRes")
+    #the compared atoms are the same in every frame, so find them once
+    #and align blocks of frames at a time
+    Ind1 = ProteinClassInd(pRef, pTrj, Backbone = True, AlignSeq = Align,
+                           CompResInd = CompResInd, CalcResInd = CalcResInd)
+    Ind2 = ProteinClassInd(pRef, pTrj, Backbone = False, AlignSeq = Align,
+                           CompResInd = CompResInd, CalcResInd = CalcResInd)
+    def BlockRMSD(Block, Ind):
+      AtomInd1, AtomInd2, CompInd, CalcInd, NRes = Ind
+      if not len(AtomInd1) == len(AtomInd2): return [None] * len(Block)
+      return RMSDMany(pRef.Pos.take(AtomInd1, axis=0), Block.take(AtomInd2, axis=1),
+                      CompInd = CompInd, CalcInd = CalcInd)
+    NRes = Ind2[-1]
     i = 0
     y1, y2 = [], []
     z1, z2 = [], []
-    for Pos in Trj:
-      i += 1
-      x1, NRes = RMSDProteinClass(pRef, pTrj, Backbone = True, AlignSeq = Align,
-                                  CompResInd = CompResInd, CalcResInd = CalcResInd)
-      x2, NRes = RMSDProteinClass(pRef, pTrj, Backbone = False, AlignSeq = Align,
-                                  CompResInd = CompResInd, CalcResInd = CalcResInd)
-      y1.append(x1)
-      y2.append(x2)
-      z1.append(ClipRMSD(x1))
-      z2.append(ClipRMSD(x2))
-      if i % NAvg == 0:
-        print "%-10d %-8s %-8s %-5d" % (Trj.Index+1, RepRMSD(y1), RepRMSD(y2), NRes)
-        y1, y2 = [], []
+    for Block in Trj.IterChunks(BlockSize, coords.NoMask):
+      for (x1, x2) in zip(BlockRMSD(Block, Ind1), BlockRMSD(Block, Ind2)):
+        i += 1
+        y1.append(x1)
+        y2.append(x2)
+        z1.append(ClipRMSD(x1))
+        z2.append(ClipRMSD(x2))
+        if i % NAvg == 0:
+          print "%-10d %-8s %-8s %-5d" % (Trj.NSkip + Trj.NStride*(i-1) + 1,
+                                          RepRMSD(y1), RepRMSD(y2), NRes)
+          y1, y2 = [], []
     pTrj.UnlinkTrj()
     if Cut > 0.:
       z1 = array(z1, float)
@@ -0,0 +1,244 @@
+"""
+This module provides lightweight access to Amber NetCDF trajectories and
+restarts. Files are read through Scientific.IO.NetCDF or scipy.io.netcdf,
+whichever is available, and are written directly in the 64-bit offset NetCDF
+format; trajectories are streamed to disk as frames come in instead of being
+held in memory until the file is closed.
+"""
+
+import numpy as np
+import struct
+
+try:
+   from Scientific.IO.NetCDF import NetCDFFile
+   def open_netcdf(fname):
+      """ Opens a NetCDF file for reading """
+      return NetCDFFile(fname, 'r')
+except ImportError:
+   try:
+      from scipy.io.netcdf import netcdf_file
+      def open_netcdf(fname):
+         """ Opens a NetCDF file for reading """
+         return netcdf_file(fname, 'r', mmap=True)
+   except ImportError:
+      def open_netcdf(fname):
+         """ Opens a NetCDF file for reading """
+         raise NetCDFError('Reading NetCDF files requires Scientific Python '
+                           'or scipy')
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+class NetCDFError(Exception):
+   """ Error reading or writing a NetCDF file """
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+# NetCDF header tags and types
+_NC_DIMENSION, _NC_VARIABLE, _NC_ATTRIBUTE = 0x0A, 0x0B, 0x0C
+_NC_CHAR, _NC_FLOAT, _NC_DOUBLE = 2, 5, 6
+_TYPE_CODES = {_NC_CHAR : 'S1', _NC_FLOAT : '>f4', _NC_DOUBLE : '>f8'}
+
+def _pad(n):
+   """ Number of bytes needed to pad n bytes to a 4-byte boundary """
+   return (4 - n % 4) % 4
+
+def _pack_name(name):
+   return struct.pack('>i', len(name)) + name + '\0' * _pad(len(name))
+
+def _pack_atts(atts):
+   """ Packs a list of (name, value) attributes with string or float values """
+   if not atts: return struct.pack('>ii', 0, 0)
+   ret = struct.pack('>ii', _NC_ATTRIBUTE, len(atts))
+   for name, value in atts:
+      if isinstance(value, str):
+         ret += _pack_name(name) + struct.pack('>ii', _NC_CHAR, len(value))
+         ret += value + '\0' * _pad(len(value))
+      else:
+         ret += _pack_name(name) + struct.pack('>iid', _NC_DOUBLE, 1, value)
+   return ret
+
+def _pack_file(dims, gatts, variables, numrecs=0):
+   """
+   Packs the header and fixed-size variable data of a 64-bit offset NetCDF
+   file. dims is a list of (name, length) with length 0 for the record
+   dimension 'frame', gatts is a list of global attributes, and variables is a
+   list of (name, dims, type, attributes, data) where data is None for record
+   variables. Returns the packed string
+   """
+   dimid = dict([(name, i) for i, (name, n) in enumerate(dims)])
+   dimlen = dict(dims)
+   # Size of each variable (per record for record variables)
+   vsizes = []
+   for name, vdims, vtype, atts, data in variables:
+      n = np.dtype(_TYPE_CODES[vtype]).itemsize
+      for d in vdims:
+         if d != 'frame': n *= dimlen[d]
+      vsizes.append(n + _pad(n))
+   # Build the header twice; the first pass just gets its length
+   def header(begins):
+      ret = 'CDF\x02' + struct.pack('>i', numrecs)
+      ret += struct.pack('>ii', _NC_DIMENSION, len(dims))
+      for name, n in dims:
+         ret += _pack_name(name) + struct.pack('>i', n)
+      ret += _pack_atts(gatts)
+      ret += struct.pack('>ii', _NC_VARIABLE, len(variables))
+      for i, (name, vdims, vtype, atts, data) in enumerate(variables):
+         ret += _pack_name(name) + struct.pack('>i', len(vdims))
+         ret += ''.join([struct.pack('>i', dimid[d]) for d in vdims])
+         ret += _pack_atts(atts)
+         ret += struct.pack('>iiq', vtype, vsizes[i], begins[i])
+      return ret
+   headlen = len(header([0] * len(variables)))
+   # Fixed variables come first, then the records
+   begins, offset = [], headlen
+   for i, var in enumerate(variables):
+      if var[4] is None: continue
+      begins.append((i, offset))
+      offset += vsizes[i]
+   for i, var in enumerate(variables):
+      if var[4] is not None: continue
+      begins.append((i, offset))
+      offset += vsizes[i]
+   begins = [b for i, b in sorted(begins)]
+   ret = [header(begins)]
+   for i, var in enumerate(variables):
+      if var[4] is None: continue
+      data = var[4]
+      if not isinstance(data, str):
+         data = np.asarray(data, _TYPE_CODES[var[2]]).tostring()
+      ret.append(data + '\0' * _pad(len(data)))
+   return ''.join(ret)
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+class NetCDFTrajWriter(object):
+   """
+   Writes an Amber NetCDF trajectory one frame (or block of frames) at a
+   time. The record count in the header is updated after every write, so the
+   file is always a valid trajectory of the frames written so far
+   """
+
+   def __init__(self, fname, natom, box=False, temp0=False,
+                title='', program='JmsScripts'):
+      """
+      Opens fname for writing a trajectory of natom atoms. box and temp0
+      control whether the cell_lengths/cell_angles and temp0 variables are
+      written for each frame
+      """
+      self.natom = natom
+      self.box = box
+      self.temp0 = temp0
+      self.nframes = 0
+      # Dimensions, in order
+      dims = [('frame', 0), ('spatial', 3), ('atom', natom)]
+      if box: dims += [('cell_spatial', 3), ('cell_angular', 3), ('label', 5)]
+      # Variables: (name, dims, type, attributes, data for fixed variables)
+      variables = [('spatial', ['spatial'], _NC_CHAR, [], 'xyz'),
+                   ('time', ['frame'], _NC_FLOAT,
+                    [('units', 'picosecond')], None),
+                   ('coordinates', ['frame', 'atom', 'spatial'], _NC_FLOAT,
+                    [('units', 'angstrom')], None)]
+      if box:
+         variables += [('cell_spatial', ['cell_spatial'], _NC_CHAR, [], 'abc'),
+                       ('cell_angular', ['cell_angular', 'label'], _NC_CHAR, [],
+                        'alphabeta gamma'),
+                       ('cell_lengths', ['frame', 'cell_spatial'], _NC_DOUBLE,
+                        [('units', 'angstrom')], None),
+                       ('cell_angles', ['frame', 'cell_angular'], _NC_DOUBLE,
+                        [('units', 'degree')], None)]
+      if temp0:
+         variables.append(('temp0', ['frame'], _NC_DOUBLE,
+                           [('units', 'kelvin')], None))
+      gatts = [('title', title), ('application', 'AMBER'),
+               ('program', program), ('programVersion', '1.0'),
+               ('Conventions', 'AMBER'), ('ConventionVersion', '1.0')]
+      self._file = open(fname, 'wb')
+      self._file.write(_pack_file(dims, gatts, variables, self.nframes))
+
+   #===================================================
+
+   def write(self, coords, time=None, box=None, temp0=None):
+      """
+      Writes a frame (coords is natom x 3) or a block of frames (coords is
+      nframe x natom x 3). box is the matching 6-element box (lengths and
+      angles) or nframe x 6 array, and time and temp0 are scalars or arrays
+      """
+      coords = np.asarray(coords)
+      if coords.ndim == 2: coords = coords[np.newaxis]
+      nframe = coords.shape[0]
+      if coords.shape[1:] != (self.natom, 3):
+         raise NetCDFError('Expected %d atoms, got %d' %
+                           (self.natom, coords.shape[1]))
+      if time is None: time = np.zeros(nframe)
+      # Lay out the records field by field in a structured array
+      fields = [('time', '>f4'), ('coordinates', '>f4', (self.natom, 3))]
+      if self.box:
+         fields += [('cell_lengths', '>f8', (3,)), ('cell_angles', '>f8', (3,))]
+      if self.temp0:
+         fields.append(('temp0', '>f8'))
+      rec = np.zeros(nframe, dtype=fields)
+      rec['time'] = time
+      rec['coordinates'] = coords
+      if self.box:
+         if box is None: raise NetCDFError('Box information is required')
+         box = np.asarray(box).reshape(-1, 6)
+         rec['cell_lengths'] = box[:,:3]
+         rec['cell_angles'] = box[:,3:]
+      if self.temp0:
+         if temp0 is None: raise NetCDFError('temp0 is required')
+         rec['temp0'] = temp0
+      self._file.write(rec.tostring())
+      # Keep the header up to date
+      self.nframes += nframe
+      self._file.seek(4)
+      self._file.write(struct.pack('>i', self.nframes))
+      self._file.seek(0, 2)
+
+   #===================================================
+
+   def close(self):
+      """ Closes the file """
+      if self._file is not None:
+         self._file.close()
+         self._file = None
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+def write_netcdf_restart(fname, coords, velocities=None, box=None, time=0.0,
+                         title='', program='JmsScripts'):
+   """
+   Writes an Amber NetCDF restart file. coords and velocities are natom x 3
+   (velocities in Amber's internal units, as stored in trajectories and ASCII
+   restarts) and box is a 3- or 6-element array of lengths and angles
+   """
+   coords = np.asarray(coords, float)
+   natom = coords.shape[0]
+   dims = [('spatial', 3), ('atom', natom)]
+   variables = [('spatial', ['spatial'], _NC_CHAR, [], 'xyz'),
+                ('time', [], _NC_DOUBLE, [('units', 'picosecond')],
+                 np.array([time])),
+                ('coordinates', ['atom', 'spatial'], _NC_DOUBLE,
+                 [('units', 'angstrom')], coords)]
+   if velocities is not None:
+      variables.append(('velocities', ['atom', 'spatial'], _NC_DOUBLE,
+                        [('units', 'angstrom/picosecond'),
+                         ('scale_factor', 20.455)], velocities))
+   if box is not None:
+      box = np.asarray(box, float)
+      if len(box) == 3: box = np.hstack((box, [90.0, 90.0, 90.0]))
+      dims += [('cell_spatial', 3), ('cell_angular', 3), ('label', 5)]
+      variables += [('cell_spatial', ['cell_spatial'], _NC_CHAR, [], 'abc'),
+                    ('cell_angular', ['cell_angular', 'label'], _NC_CHAR, [],
+                     'alphabeta gamma'),
+                    ('cell_lengths', ['cell_spatial'], _NC_DOUBLE,
+                     [('units', 'angstrom')], box[:3]),
+                    ('cell_angles', ['cell_angular'], _NC_DOUBLE,
+                     [('units', 'degree')], box[3:])]
+   gatts = [('title', title), ('application', 'AMBER'),
+            ('program', program), ('programVersion', '1.0'),
+            ('Conventions', 'AMBERRESTART'), ('ConventionVersion', '1.0')]
+   f = open(fname, 'wb')
+   f.write(_pack_file(dims, gatts, variables))
+   f.close()
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
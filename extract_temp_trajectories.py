@@ -1,9 +1,15 @@
 #!/usr/bin/env python
 
-""" 
+"""
 This program will take a list of REMD trajectory files and temperatures and it
 will extract temperature-specific trajectories from those trajectory files for
 each temperature provided.
+
+By default every replica trajectory is read only once: frames are read a block
+at a time from all replicas in lockstep (in parallel worker processes if
+requested), optionally RMS-fit to a reference, and routed to whichever
+temperature trajectory they belong to. The --cpptraj option instead runs one
+cpptraj per temperature, which re-reads every trajectory each time.
 """
 from optparse import OptionParser, OptionGroup
 from subprocess import Popen, PIPE
@@ -27,12 +33,307 @@ def which(program):
             return exe_file
    return None
 
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+class DemuxError(Exception):
+   """ Error extracting the temperature trajectories """
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+def read_prmtop_flag(prmtop, flag):
+   """ Returns the list of fields in a %FLAG section of a prmtop """
+   import re
+   f = open(prmtop, 'r')
+   for line in f:
+      if line.startswith('%%FLAG %s' % flag) and line.split()[1] == flag: break
+   else:
+      f.close()
+      raise DemuxError('Could not find %%FLAG %s in %s' % (flag, prmtop))
+   width = int(re.search(r'[aIE](\d+)', f.next()).groups()[0])
+   fields = []
+   for line in f:
+      if line.startswith('%'): break
+      line = line.rstrip('\n')
+      fields.extend([line[i:i+width] for i in range(0, len(line), width)])
+   f.close()
+   return fields
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+def select_atoms(prmtop, mask):
+   """
+   Returns the indices of atoms selected by a simple Amber mask. Residue
+   numbers/ranges/names (:1-10,LYS), atom names (@CA,C), both (:1-10@CA), and
+   * are supported. Anything fancier needs --cpptraj
+   """
+   import numpy as np
+   mask = mask.replace(' ', '')
+   for c in '&|!<>=%~()':
+      if c in mask:
+         raise DemuxError('Mask %s is too complex for the inline RMS fit. '
+                          'Use --cpptraj instead.' % mask)
+   names = [n.strip() for n in read_prmtop_flag(prmtop, 'ATOM_NAME')]
+   resnames = [n.strip() for n in read_prmtop_flag(prmtop, 'RESIDUE_LABEL')]
+   respointers = [int(i) - 1 for i in read_prmtop_flag(prmtop,
+                                                       'RESIDUE_POINTER')]
+   natom = len(names)
+   atomres = np.zeros(natom, int)
+   for i, start in enumerate(respointers): atomres[start:] = i
+   if mask in ('*', ':*', '@*'): return np.arange(natom)
+   if '@' in mask:
+      resmask, namemask = mask.split('@', 1)
+   else:
+      resmask, namemask = mask, '*'
+   sel = np.ones(natom, bool)
+   if resmask.strip(':') not in ('', '*'):
+      ressel = np.zeros(len(respointers), bool)
+      for item in resmask.strip(':').split(','):
+         if item.replace('-', '').isdigit():
+            first, last = (item.split('-') + [item])[:2]
+            ressel[int(first)-1:int(last)] = True
+         else:
+            ressel |= np.array([r == item for r in resnames])
+      sel &= ressel[atomres]
+   if namemask != '*':
+      wanted = namemask.split(',')
+      sel &= np.array([n in wanted for n in names])
+   if not sel.any():
+      raise DemuxError('Mask %s selects no atoms' % mask)
+   return np.nonzero(sel)[0]
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+def read_reference(fname, natom):
+   """ Reads reference coordinates from a restart (ASCII or NetCDF) or PDB """
+   import numpy as np
+   from amber_netcdf import open_netcdf
+   if open(fname, 'rb').read(3) == 'CDF':
+      ncfile = open_netcdf(fname)
+      crd = np.array(ncfile.variables['coordinates'][:], float)
+      ncfile.close()
+   else:
+      lines = open(fname, 'r').readlines()
+      pdb = [l for l in lines if l[:6] in ('ATOM  ', 'HETATM')]
+      if pdb:
+         crd = np.array([[float(l[30:38]), float(l[38:46]), float(l[46:54])]
+                         for l in pdb])
+      else:
+         vals = ''.join([l.rstrip('\n') for l in lines[2:]])
+         crd = np.array([float(vals[i:i+12]) for i in range(0, 36*natom, 12)])
+   crd = crd.reshape((-1, 3))
+   if crd.shape[0] != natom:
+      raise DemuxError('Reference %s has %d atoms; expected %d' %
+                       (fname, crd.shape[0], natom))
+   return crd
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+def fit_frames(coords, ref, idx):
+   """
+   RMS fits each frame of coords (nframe x natom x 3) onto ref using the atoms
+   in idx, and returns the fitted coordinates and the fit RMSDs
+   """
+   import numpy as np
+   mob = coords[:,idx,:]
+   mobcen = mob.mean(axis=1)
+   refsel = ref[idx]
+   refcen = refsel.mean(axis=0)
+   # Optimal rotations of every frame at once (Kabsch)
+   cov = np.einsum('fai,aj->fij', mob - mobcen[:,np.newaxis,:],
+                   refsel - refcen)
+   u, s, vt = np.linalg.svd(cov)
+   u[:,:,2] *= np.sign(np.linalg.det(u) * np.linalg.det(vt))[:,np.newaxis]
+   rot = np.einsum('fij,fjk->fik', u, vt)
+   fitted = np.einsum('fai,fij->faj', coords - mobcen[:,np.newaxis,:], rot)
+   fitted += refcen
+   rmsd = np.sqrt(((fitted[:,idx,:] - refsel)**2).sum(axis=2).mean(axis=1))
+   return fitted, rmsd
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+# Per-process state for reading replica blocks
+_worker = {}
+
+def init_worker(trajs, remlog_temps, ref, idx):
+   """ Sets up the replica reader in this process """
+   _worker.clear()
+   _worker.update(trajs=trajs, remlog_temps=remlog_temps, ref=ref, idx=idx,
+                  files={})
+
+def read_block(task):
+   """
+   Reads frames start:stop of replica rep and returns (coords, time, box,
+   temps, rmsd), where box and rmsd may be None. Coordinates are fit to the
+   reference if there is one
+   """
+   import numpy as np
+   from amber_netcdf import open_netcdf
+   rep, start, stop = task
+   if not rep in _worker['files']:
+      _worker['files'][rep] = open_netcdf(_worker['trajs'][rep])
+   var = _worker['files'][rep].variables
+   coords = np.array(var['coordinates'][start:stop], float)
+   if 'time' in var:
+      frametime = np.array(var['time'][start:stop], float)
+   else:
+      frametime = np.zeros(stop - start)
+   box = None
+   if 'cell_lengths' in var:
+      box = np.hstack((np.array(var['cell_lengths'][start:stop], float),
+                       np.array(var['cell_angles'][start:stop], float)))
+   if _worker['remlog_temps'] is not None:
+      temps = _worker['remlog_temps'][rep][start:stop]
+   elif 'temp0' in var:
+      temps = np.array(var['temp0'][start:stop], float)
+   else:
+      raise DemuxError('%s has no temp0 record; give a --remlog' %
+                       _worker['trajs'][rep])
+   del var
+   rmsd = None
+   if _worker['ref'] is not None:
+      coords, rmsd = fit_frames(coords, _worker['ref'], _worker['idx'])
+   return coords.astype(np.float32), frametime, box, temps, rmsd
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+def demux(trajs, temps, prefix, prmtop, refstruct=None, rmsmask='@CA,C,O,N,H',
+          rmsout='rms', remlog=None, nproc=1, block=100):
+   """
+   Extracts a trajectory for each temperature in temps from the replica
+   trajectories in trajs (NetCDF), reading each replica only once. The
+   temperature of each frame is taken from its temp0 record, or from the
+   old_temp of the matching replica in the remd.TempRemLog remlog (in which
+   case trajs must be in replica order with one frame per exchange).
+   Frames are processed block frames at a time over nproc processes, and
+   every replica is read to its own end
+   """
+   import numpy as np
+   from multiprocessing import Pool
+   from amber_netcdf import open_netcdf, NetCDFTrajWriter
+
+   # Only NetCDF3 trajectories can be read here
+   for traj in trajs:
+      if open(traj, 'rb').read(3) != 'CDF':
+         raise DemuxError('%s is not an Amber NetCDF trajectory. Use --cpptraj '
+                          'for ASCII (mdcrd) or NetCDF4 trajectories' % traj)
+
+   # Find out how much we have to read
+   ncfile = open_netcdf(trajs[0])
+   natom = ncfile.variables['coordinates'].shape[1]
+   hasbox = 'cell_lengths' in ncfile.variables
+   ncfile.close()
+   nframes = []
+   for traj in trajs:
+      ncfile = open_netcdf(traj)
+      nframes.append(ncfile.variables['coordinates'].shape[0])
+      ncfile.close()
+
+   remlog_temps = None
+   if remlog:
+      from remd import TempRemLog
+      log = TempRemLog(remlog)
+      if len(log.reps) != len(trajs):
+         raise DemuxError('%s has %d replicas, but %d trajectories were given'
+                          % (remlog, len(log.reps), len(trajs)))
+      remlog_temps = [rep.old_temp for rep in log.reps]
+      nframes = [min(n, log.numexchg) for n in nframes]
+   if min(nframes) < max(nframes):
+      print >> sys.stderr, ('Warning: replica trajectories have between %d '
+            'and %d frames; each is read to its end' % (min(nframes),
+            max(nframes)))
+
+   ref, idx = None, None
+   if refstruct:
+      ref = read_reference(refstruct, natom)
+      idx = select_atoms(prmtop, rmsmask)
+
+   # Keep all of the output files open the whole time
+   writers, rmsfiles = [], []
+   for temp in temps:
+      writers.append(NetCDFTrajWriter('%s.%f.nc' % (prefix, temp), natom,
+                     box=hasbox, temp0=True,
+                     title='Temperature %s trajectory' % temp))
+      if refstruct:
+         rmsfile = open('%s_%s.dat' % (rmsout, temp), 'w', 1 << 20)
+         rmsfile.write('%-8s %12s\n' % ('#Frame', 'data'))
+         rmsfiles.append(rmsfile)
+   nwritten = [0 for temp in temps]
+
+   init_args = (trajs, remlog_temps, ref, idx)
+   pool = None
+   if nproc > 1:
+      pool = Pool(nproc, initializer=init_worker, initargs=init_args)
+      read_blocks = lambda tasks: pool.map_async(read_block, tasks)
+   else:
+      init_worker(*init_args)
+      class Done(object):
+         def __init__(self, tasks): self.result = map(read_block, tasks)
+         def get(self): return self.result
+      read_blocks = Done
+
+   starts = range(0, max(nframes), block)
+   # Replicas that have ended are left out of later blocks
+   tasks = lambda start: [(rep, start, min(start + block, nframes[rep]))
+                          for rep in range(len(trajs)) if start < nframes[rep]]
+   try:
+      # Read the next block while this one is routed and written
+      pending = read_blocks(tasks(0))
+      for i, start in enumerate(starts):
+         results = dict([(task[0], result) for task, result in
+                         zip(tasks(start), pending.get())])
+         if i + 1 < len(starts): pending = read_blocks(tasks(starts[i+1]))
+         # Frames past the end of a replica match no temperature
+         frametemps = np.empty((len(trajs), min(block, max(nframes) - start)))
+         frametemps.fill(np.inf)
+         for rep, result in results.items():
+            frametemps[rep,:len(result[3])] = result[3]
+         frames = np.arange(frametemps.shape[1])
+         for j, temp in enumerate(temps):
+            match = np.abs(frametemps - temp) < 0.01
+            has = match.any(axis=0)
+            if not has.any(): continue
+            reps = match.argmax(axis=0)[has]
+            sel = frames[has]
+            coords = np.array([results[r][0][f] for r, f in zip(reps, sel)])
+            frametime = [results[r][1][f] for r, f in zip(reps, sel)]
+            box = None
+            if hasbox: box = [results[r][2][f] for r, f in zip(reps, sel)]
+            writers[j].write(coords, frametime, box, [temp] * len(sel))
+            if refstruct:
+               rmsfiles[j].write(''.join(['%8d %12.4f\n' %
+                     (nwritten[j] + k + 1, results[r][4][f])
+                     for k, (r, f) in enumerate(zip(reps, sel))]))
+            nwritten[j] += len(sel)
+   finally:
+      if pool is not None:
+         pool.terminate()
+         pool.join()
+      for writer in writers: writer.close()
+      for rmsfile in rmsfiles: rmsfile.close()
+
+   for temp, n in zip(temps, nwritten):
+      print 'Wrote %d frames at temperature %s' % (n, temp)
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
 parser = OptionParser('usage: %prog [Options] mdcrd1 [mdcrd2 [mdcrd3 ...] ]')
 parser.add_option('--temperatures', dest='temp_list', help='Comma-separated ' +
                   'list of temperatures to extract trajectories for')
 parser.add_option('--prefix', dest='prefix', help='Prefix for trajectory ' +
                   'file names. They will be named PREFIX.temp.nc')
 parser.add_option('--prmtop', dest='prmtop', help='Prmtop for your system')
+parser.add_option('--remlog', dest='remlog', help='Temperature REMD log ' +
+                  'file to take frame temperatures from instead of the ' +
+                  'temp0 records. Trajectories must be given in replica ' +
+                  'order with one frame per exchange')
+parser.add_option('-n', '--nproc', dest='nproc', type='int', default=1,
+                  help='Number of processes reading replicas. Default 1')
+parser.add_option('--block', dest='block', type='int', default=100,
+                  help='Number of frames read from each replica at a time. ' +
+                  'Default 100')
+parser.add_option('--cpptraj', dest='cpptraj', action='store_true',
+                  default=False, help='Run cpptraj once for each ' +
+                  'temperature instead of reading each trajectory once')
 group = OptionGroup(parser, 'RMSd Options', 'If a REFSTRUCT is specified, ' +
                     'these options will be used to RMS fit a structure')
 group.add_option('--rmsd', dest='refstruct', help='Reference structure for ' +
@@ -49,21 +350,31 @@ if not opt.temp_list or not opt.prefix or not opt.prmtop or not trajs:
    parser.print_help()
    sys.exit(1)
 
+temps = []
+for temp in opt.temp_list.split(','):
+   try: temps.append(float(temp))
+   except ValueError: continue
+
+if not opt.cpptraj:
+   try:
+      demux(trajs, temps, opt.prefix, opt.prmtop, opt.refstruct, opt.rmsmask,
+            opt.rmsout, opt.remlog, opt.nproc, opt.block)
+   except DemuxError, err:
+      print >> sys.stderr, 'Error: %s' % err
+      sys.exit(1)
+   print '\n\nThis took %f min.' % ((time.time() - start_time) / 60)
+   sys.exit(0)
+
 cpptraj = which('cpptraj')
 
 assert(cpptraj)
 
-temps = opt.temp_list.split(',')
-
 for temp in temps:
-   try: temp=float(temp)
-   except ValueError: continue
-
    cpptraj_str = ''
    for traj in trajs:
       cpptraj_str += 'trajin %s remdtraj remdtrajtemp %s\n' % (traj, temp)
 
-   if opt.refstruct: 
+   if opt.refstruct:
       cpptraj_str += 'reference %s\n' % opt.refstruct
       cpptraj_str += 'rmsd data %s reference out %s_%s.dat\n' % (opt.rmsmask,
                       opt.rmsout, temp)
@@ -24,6 +24,10 @@ Boston, MA 02111-1307, USA.
 
 import sys, os
 
+# Number of frames read from the trajectory at a time when writing multiple
+# restart files
+CHUNK_SIZE = 100
+
 #~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+#
 
 class RestartError(Exception):
@@ -35,6 +39,20 @@ class RestartWarning(Warning):
 
 #~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+#
 
+def _format_block(vals):
+   """
+   Formats an array of values 6 to a line in the restart format (12.7F) with
+   a single format string, ending with a newline
+   """
+   vals = tuple(vals.ravel().tolist()) if hasattr(vals, 'ravel') else \
+          tuple([x for v in vals for x in v])
+   nline, nleft = divmod(len(vals), 6)
+   fmt = ('%12.7F' * 6 + os.linesep) * nline
+   if nleft: fmt += '%12.7F' * nleft + os.linesep
+   return fmt % vals
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+#
+
 class AmberRestart(file):
    """ Amber Restart file has a fixed format """
 
@@ -78,6 +96,32 @@ class AmberRestart(file):
       # Add a new line after every even velocity
       if not self.vel_num % 2: self.write(os.linesep)
 
+   def write_coordinates(self, crds):
+      """ Writes out all of the coordinates at once from a natom x 3 array """
+      if not hasattr(self, 'title_written'):
+         raise RestartError('Write the title before writing coordinates!')
+      if not hasattr(self, 'header_written'):
+         raise RestartError('Write the header before writing coordinates!')
+      if len(crds) != self.natom:
+         raise RestartError('Expected %d coordinates, got %d!' %
+                            (self.natom, len(crds)))
+      self.write(_format_block(crds))
+      self.crd_num = self.natom
+
+   def write_velocities(self, vels):
+      """ Writes out all of the velocities at once from a natom x 3 array """
+      if not hasattr(self, 'title_written'):
+         raise RestartError('Write the title before writing velocities!')
+      if not hasattr(self, 'header_written'):
+         raise RestartError('Write the header before writing velocities!')
+      if not hasattr(self, 'crd_num') or self.crd_num != self.natom:
+         raise RestartError('Write all coordinates before writing velocities!')
+      if len(vels) != self.natom:
+         raise RestartError('Expected %d velocities, got %d!' %
+                            (self.natom, len(vels)))
+      self.write(_format_block(vels))
+      self.vel_num = self.natom
+
    def write_box_info(self, a, b, c, alpha=None, beta=None, gamma=None):
       """ Writes out the box information """
       if not hasattr(self, 'title_written'):
@@ -97,10 +141,62 @@ class AmberRestart(file):
 
 #~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+#
 
-def main():
+def write_restart(task):
+   """
+   Writes one restart file. task is (fname, title, time, crds, vels, box,
+   netcdf) where box is (a, b, c, alpha, beta, gamma) with None for missing
+   angles, or None if there's no box. netcdf chooses a NetCDF restart
+   """
+   fname, title, time, crds, vels, box, netcdf = task
+   if netcdf:
+      from amber_netcdf import write_netcdf_restart
+      if box is not None and None in box: box = box[:3]
+      write_netcdf_restart(fname, crds, vels, box, time, title)
+      return fname
+   rst_file = AmberRestart(fname, 'w')
+   rst_file.write_title(title)
+   rst_file.write_header(natom=len(crds), time=time)
+   rst_file.write_coordinates(crds)
+   rst_file.write_velocities(vels)
+   if box is not None:
+      rst_file.write_box_info(*box)
+   rst_file.close()
+   return fname
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+#
+
+def _get_tasks(traj, frames, restrt, title, netcdf):
+   """
+   Reads the given frames (a range with a constant step) from the trajectory
+   in one slice and returns the restart writing tasks for them
+   """
    import numpy
+   natom = traj.variables['coordinates'].shape[1]
+   sl = slice(frames[0], frames[-1] + 1, frames[1] - frames[0]
+              if len(frames) > 1 else 1)
+   crds = numpy.array(traj.variables['coordinates'][sl], float)
+   times = numpy.array(traj.variables['time'][sl], float)
+   if 'velocities' in traj.variables.keys():
+      vels = numpy.array(traj.variables['velocities'][sl], float)
+   else:
+      vels = numpy.zeros((len(frames), natom, 3))
+   boxes = [None for idx in frames]
+   if 'cell_lengths' in traj.variables.keys():
+      lengths = numpy.array(traj.variables['cell_lengths'][sl], float)
+      if 'cell_angles' in traj.variables.keys():
+         angles = numpy.array(traj.variables['cell_angles'][sl], float)
+      else:
+         angles = [(None, None, None) for idx in frames]
+      boxes = [tuple(lengths[i]) + tuple(angles[i])
+               for i in range(len(frames))]
+   return [(restrt(idx), title, times[i], crds[i], vels[i], boxes[i], netcdf)
+           for i, idx in enumerate(frames)]
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+#
+
+def main():
    from optparse import OptionParser, OptionGroup
-   from Scientific.IO.NetCDF import NetCDFFile
+   from amber_netcdf import open_netcdf
    """ The main function """
    epilog = """This script will extract restart files from NetCDF trajectory
 files and preserve any velocity information that may be present."""
@@ -113,6 +209,12 @@ files and preserve any velocity information that may be present."""
                      help='Name for output restart file. If multiple files ' +
                      'are created, a .# suffix will be added to this file ' +
                      'name where # is the frame number being dumped.')
+   parser.add_option('--netcdf-restart', dest='ncrst', action='store_true',
+                     default=False, help='Write NetCDF restart files ' +
+                     'instead of ASCII restart files')
+   parser.add_option('-n', '--nproc', dest='nproc', metavar='INT',
+                     type='int', default=1,
+                     help='Number of processes writing restart files')
 
    group = OptionGroup(parser, 'Single Restart File',
                        'This option will print a single restart file from the' +
@@ -155,8 +257,8 @@ files and preserve any velocity information that may be present."""
 
    # Make sure it's a NetCDF file
    try:
-      traj = NetCDFFile(opt.inptraj)
-   except IOError:
+      traj = open_netcdf(opt.inptraj)
+   except (IOError, TypeError, ValueError):
       print 'Cannot recognize %s! Is it a NetCDF File?' % opt.inptraj
       sys.exit(1)
 
@@ -172,63 +274,35 @@ files and preserve any velocity information that may be present."""
       print 'mutually exclusive!'
       sys.exit(1)
 
+   title = 'File created by %s from %s trajectory.' % (
+           os.path.split(sys.argv[0])[1], opt.inptraj)
+   nframes = traj.variables['coordinates'].shape[0]
+
    # Now do the single frame case
    if opt.frame:
       # Make sure we have enough frames...
-      if opt.frame > len(traj.variables['coordinates']):
+      if opt.frame > nframes:
          print 'You asked for frame %d, but I can only find %d frames!' % (
-               opt.frame, len(traj.variables['coordinates']))
+               opt.frame, nframes)
          sys.exit(1)
-      # Python indexes from 0 -- just subtract 1 now and save the headache
-      # of doing it every time below...
-      idx = opt.frame - 1
-      # Now all is OK, so let's make the restart file
-      rst_file = AmberRestart(opt.restrt, 'w')
-      rst_file.write_title('File created by %s from %s trajectory.' % (
-                           os.path.split(sys.argv[0])[1], opt.inptraj))
-      rst_file.write_header(natom=traj.dimensions['atom'],
-                            time=traj.variables['time'][idx])
-      # Now write the coordinates
-      for it in range(traj.dimensions['atom']):
-         rst_file.write_coordinate(traj.variables['coordinates'][idx][it][0],
-                                   traj.variables['coordinates'][idx][it][1],
-                                   traj.variables['coordinates'][idx][it][2])
-      # Now write the velocities
-      if 'velocities' in traj.variables.keys():
-         vels = traj.variables['velocities'][idx]
-      else:
+      if not 'velocities' in traj.variables.keys():
          print ('Warning: %s does not contain velocities. Setting all ' +
                 'velocities to 0!') % opt.inptraj
-         vels = numpy.zeros((traj.dimensions['atom'],3))
-
-      # Now write the velocities
-      for it in range(traj.dimensions['atom']):
-         rst_file.write_velocity(vels[it][0], vels[it][1], vels[it][2])
-
-      # Now write the box information if it's present
-      if 'cell_lengths' in traj.variables.keys():
-         a = traj.variables['cell_lengths'][idx][0]
-         b = traj.variables['cell_lengths'][idx][1]
-         c = traj.variables['cell_lengths'][idx][2]
-         alpha, beta, gamma = None, None, None
-         if 'cell_angles' in traj.variables.keys():
-            alpha = traj.variables['cell_angles'][idx][0]
-            beta = traj.variables['cell_angles'][idx][1]
-            alpha = traj.variables['cell_angles'][idx][2]
-         rst_file.write_box_info(a, b, c, alpha, beta, gamma)
-      
-      # Now we're done with our restart file -- close it
-      rst_file.close()
+      # Python indexes from 0
+      idx = opt.frame - 1
+      write_restart(_get_tasks(traj, [idx], lambda i: opt.restrt, title,
+                               opt.ncrst)[0])
       print 'Done creating restart file %s' % opt.restrt
       sys.exit(0)
 
    # Now, if we want to do multiple frames, check that our options are legal
+   if opt.end == 0: opt.end = nframes
    if opt.start > opt.end: 
       print 'Illegal start and end. Start must be less than End!'
       sys.exit(1)
-   if opt.start > len(traj.variables['coordinates']):
+   if opt.start > nframes:
       print 'Start frame is %d but there are only %d frames in %s!' % (
-         opt.start, len(traj.variables['coordinates']), opt.traj)
+         opt.start, nframes, opt.inptraj)
       sys.exit(1)
 
    # Print out our warnings about missing velocities only once
@@ -236,47 +310,29 @@ files and preserve any velocity information that may be present."""
       print ('Warning: %s does not contain velocities. Setting all ' +
              'velocities to 0!') % opt.inptraj
 
-   # Print out all of the restart files
-   for idx in range(opt.start-1, opt.end, opt.interval):
-      rst_file = AmberRestart(opt.restrt + '.%d' % (idx+1), 'w')
-
-      rst_file.write_title('File created by %s from %s trajectory.' % (
-                           (os.path.split(sys.argv[0]))[1], opt.inptraj))
-      rst_file.write_header(natom=traj.dimensions['atom'],
-                            time=traj.variables['time'][idx])
-      # Now write the coordinates
-      for it in range(traj.dimensions['atom']):
-         rst_file.write_coordinate(traj.variables['coordinates'][idx][it][0],
-                                   traj.variables['coordinates'][idx][it][1],
-                                   traj.variables['coordinates'][idx][it][2])
-      if traj.dimensions['atom'] % 2 != 0: rst_file.write('\n')
-      # Now write the velocities
-      if 'velocities' in traj.variables.keys():
-         vels = traj.variables['velocities'][idx]
-      else:
-         vels = numpy.zeros((traj.dimensions['atom'],3))
-
-      # Now write the velocities
-      for it in range(traj.dimensions['atom']):
-         rst_file.write_velocity(vels[it][0], vels[it][1], vels[it][2])
-      if traj.dimensions['atom'] % 2 != 0: rst_file.write('\n')
-
-      # Now write the box information if it's present
-      if 'cell_lengths' in traj.variables.keys():
-         a = traj.variables['cell_lengths'][idx][0]
-         b = traj.variables['cell_lengths'][idx][1]
-         c = traj.variables['cell_lengths'][idx][2]
-         alpha, beta, gamma = None, None, None
-         if 'cell_angles' in traj.variables.keys():
-            alpha = traj.variables['cell_angles'][idx][0]
-            beta = traj.variables['cell_angles'][idx][1]
-            gamma = traj.variables['cell_angles'][idx][2]
-         rst_file.write_box_info(a, b, c, alpha, beta, gamma)
-      
-      # Now we're done with our restart file -- close it
-      rst_file.close()
-
-      print 'Done writing restart file %s.%d' % (opt.restrt, idx+1)
+   # Print out all of the restart files, reading the frames a chunk at a time
+   # and handing the restarts in each chunk out to the worker processes
+   frames = range(max(opt.start, 1) - 1, min(opt.end, nframes),
+                  max(opt.interval, 1))
+   restrt = lambda idx: opt.restrt + '.%d' % (idx+1)
+   pool = None
+   if opt.nproc > 1:
+      from multiprocessing import Pool
+      pool = Pool(opt.nproc)
+   try:
+      for i in range(0, len(frames), CHUNK_SIZE):
+         tasks = _get_tasks(traj, frames[i:i+CHUNK_SIZE], restrt, title,
+                            opt.ncrst)
+         if pool is None:
+            done = map(write_restart, tasks)
+         else:
+            done = pool.map(write_restart, tasks)
+         for fname in done:
+            print 'Done writing restart file %s' % fname
+   finally:
+      if pool is not None:
+         pool.close()
+         pool.join()
       
 
 #~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+#
@@ -6,7 +6,12 @@ generating useful data sets for analyzing them.
 import numpy as np
 from subprocess import Popen, PIPE
 from utilities import which
-import re, sys, os
+import re, sys, os, struct, tempfile
+import cPickle as pickle
+
+# On-disk cache of trajectory metadata, keyed by absolute path and validated
+# by file size and modification time. Set to None to disable it
+FRAME_CACHE = os.path.join(os.path.expanduser('~'), '.mdcrd_frames.pkl')
 
 #~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
 
@@ -22,6 +27,179 @@ class RMSError(Exception): pass
 
 #~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
 
+def _prmtop_natom(parm):
+   """ Returns the number of atoms from the POINTERS section of a prmtop """
+   f = open(parm, 'r')
+   try:
+      for line in f:
+         if line.startswith('%FLAG POINTERS'): break
+      else:
+         return None
+      for line in f:
+         if line.startswith('%FORMAT'): continue
+         return int(line[:8])
+   finally:
+      f.close()
+   return None
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+def _netcdf_info(fname):
+   """
+   Reads the header of a classic (or 64-bit offset) NetCDF trajectory and
+   returns (nframes, natom, has_box), or None if it can't be read that way
+   (e.g., NetCDF4/HDF5 files or files still being written in streaming mode)
+   """
+   f = open(fname, 'rb')
+   try:
+      head = f.read(4)
+      if len(head) < 4 or head[:3] != 'CDF' or head[3] not in '\x01\x02':
+         return None
+      offsize = 4 * ord(head[3])
+      pos = [0]
+      buf = [head]
+      def read(n):
+         # Read n bytes from the header, pulling more from the file as needed
+         while len(buf[0]) < pos[0] + n:
+            more = f.read(max(n, 65536))
+            if not more: raise EOFError
+            buf[0] += more
+         ret = buf[0][pos[0]:pos[0]+n]
+         pos[0] += n
+         return ret
+      def read_int():
+         return struct.unpack('>i', read(4))[0]
+      def read_name():
+         n = read_int()
+         name = read(n)
+         read((4 - n % 4) % 4)
+         return name
+      type_sizes = {1 : 1, 2 : 1, 3 : 2, 4 : 4, 5 : 4, 6 : 8}
+      def skip_atts():
+         read_int() # NC_ATTRIBUTE tag or ABSENT
+         for i in range(read_int()):
+            read_name()
+            nbytes = type_sizes[read_int()] * read_int()
+            read(nbytes + (4 - nbytes % 4) % 4)
+      try:
+         read(4)
+         numrecs = struct.unpack('>I', read(4))[0]
+         # STREAMING
+         if numrecs == 0xFFFFFFFF: return None
+         # Dimensions
+         read_int()
+         dims = []
+         for i in range(read_int()):
+            dims.append((read_name(), read_int()))
+         skip_atts()
+         # Variables
+         read_int()
+         varnames = []
+         for i in range(read_int()):
+            varnames.append(read_name())
+            read(4 * read_int())
+            skip_atts()
+            read(8 + offsize)
+      except (EOFError, KeyError, struct.error):
+         return None
+   finally:
+      f.close()
+   dims = dict(dims)
+   if not 'atom' in dims: return None
+   return numrecs, dims['atom'], 'cell_lengths' in varnames
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+def _ascii_info(fname, natom):
+   """
+   Counts the frames of an uncompressed ASCII trajectory from its size and
+   returns (nframes, natom, has_box), or None if the file isn't laid out in
+   fixed-size frames
+   """
+   if not natom or fname.endswith('.gz') or fname.endswith('.bz2'):
+      return None
+   nvals = 3 * natom
+   # 10F8.3 lines, each with a newline
+   frame_bytes = 8 * nvals + (nvals + 9) // 10
+   box_bytes = 3 * 8 + 1
+   size = os.path.getsize(fname)
+   f = open(fname, 'r')
+   try:
+      head_bytes = len(f.readline())
+      if size == head_bytes: return 0, natom, False
+      # See if a box line follows the first frame
+      f.seek(head_bytes + frame_bytes)
+      line = f.readline()
+   finally:
+      f.close()
+   has_box = nvals > 3 and len(line) == box_bytes
+   if has_box: frame_bytes += box_bytes
+   nframes, extra = divmod(size - head_bytes, frame_bytes)
+   if extra: return None
+   return nframes, natom, has_box
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+def _load_cache():
+   """ Loads the trajectory metadata cache """
+   if not FRAME_CACHE or not os.path.exists(FRAME_CACHE): return {}
+   try:
+      f = open(FRAME_CACHE, 'rb')
+      try:
+         return pickle.load(f)
+      finally:
+         f.close()
+   except Exception:
+      return {}
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+def _save_cache(entries):
+   """ Merges new entries into the trajectory metadata cache on disk """
+   if not FRAME_CACHE or not entries: return
+   cache = _load_cache()
+   cache.update(entries)
+   tmpname = '%s.%d' % (FRAME_CACHE, os.getpid())
+   try:
+      f = open(tmpname, 'wb')
+      try:
+         pickle.dump(cache, f, 2)
+      finally:
+         f.close()
+      os.rename(tmpname, FRAME_CACHE)
+   except (IOError, OSError):
+      # The cache is only an optimization
+      if os.path.exists(tmpname): os.remove(tmpname)
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+def _merge_data_files(outfile, pieces):
+   """
+   Concatenates cpptraj data files written by separate processes into
+   outfile, renumbering the frames so they continue from one piece to the
+   next, and deletes the pieces
+   """
+   data_re = re.compile(r'(\s*)(\d+)(.*)', re.S)
+   out = open(outfile, 'w')
+   offset = 0
+   for k, piece in enumerate(pieces):
+      last = 0
+      for line in open(piece, 'r'):
+         rematch = data_re.match(line)
+         if not rematch:
+            # Only keep the header from the first piece
+            if k == 0: out.write(line)
+            continue
+         last = int(rematch.group(2))
+         num = str(last + offset)
+         width = len(rematch.group(1)) + len(rematch.group(2))
+         out.write(num.rjust(width) + rematch.group(3))
+      offset += last
+      os.remove(piece)
+   out.close()
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
 class AmberTraj(object):
    " This is a class to analyze trajectory files (a series of them, or just 1) "
    
@@ -44,6 +222,10 @@ class AmberTraj(object):
       # traj_list is a dictionary that matches the trajectory name to the
       # number of frames in that trajectory
       self.traj_list = {}
+      # (nframes, natom, has_box) for each trajectory; natom and has_box are
+      # None if we had to ask cpptraj for the number of frames
+      self.traj_info = {}
+      self._natom = None
       if type(traj_list).__name__ in ['list', 'tuple']:
          for item in traj_list:
             self.traj_list[item] = -1
@@ -76,6 +258,10 @@ class AmberTraj(object):
 
       # Start keeping track of the commands we want to run
       self._cpptraj_commands = ''
+      # Data files written by those commands, and whether any of them depend
+      # on the first frame (which can't be split across parallel workers)
+      self._outfiles = []
+      self._uses_first = False
 
    #===================================================
 
@@ -100,27 +286,56 @@ class AmberTraj(object):
 
    def _query(self):
       " Determine how many frames are in each trajectory "
-      get_num_frames = re.compile(r' *\[.+\] contains (\d+) frames.')
+      cache = _load_cache()
+      new_entries = {}
       for traj in self.traj_list:
          # Skip over any frames we've already determined
          if self.traj_list[traj] != -1: continue
-         # Now launch a subprocess where we just trajin the file and parse
-         # the output to find out how many frames are present
-         process = Popen([self.cpptraj, self.parm], stdin=PIPE, stdout=PIPE,
-                         stderr=PIPE)
-         out, err = process.communicate('trajin %s' % traj)
-         # This shouldn't be reached, since cpptraj doesn't bail out with a
-         # non-zero exit code, it just prints errors.
-         if process.wait():
-            raise TrajError('Bad trajectory file %s:\nOutput: %s\nError: %s' % 
-                            (traj, out, err))
-         nframes = get_num_frames.search(out)
-         # This really means we put in a bad trajectory file
-         if len(nframes.groups()) != 1:
-            raise TrajError('Bad trajectory file (%s):\nOutput: %s\nError: %s' %
-                            (traj, out, err))
-         # Otherwise, we got our number of frames
-         self.traj_list[traj] = int(nframes.groups()[0])
+         # See if we have this file cached
+         key = os.path.abspath(traj)
+         try:
+            st = os.stat(traj)
+         except OSError:
+            raise TrajError('Bad trajectory file %s: could not be found' % traj)
+         stamp = (st.st_size, st.st_mtime)
+         if key in cache and cache[key][0] == stamp:
+            info = cache[key][1]
+         else:
+            # Count the frames ourselves if we can, and fall back to cpptraj
+            info = _netcdf_info(traj)
+            if info is None:
+               if self._natom is None: self._natom = _prmtop_natom(self.parm)
+               info = _ascii_info(traj, self._natom)
+            if info is None:
+               info = (self._cpptraj_frames(traj), None, None)
+            else:
+               new_entries[key] = (stamp, info)
+         self.traj_list[traj] = info[0]
+         self.traj_info[traj] = info
+      _save_cache(new_entries)
+
+   #===================================================
+
+   def _cpptraj_frames(self, traj):
+      " Determine how many frames are in a trajectory by running cpptraj "
+      get_num_frames = re.compile(r' *\[.+\] contains (\d+) frames.')
+      # Now launch a subprocess where we just trajin the file and parse
+      # the output to find out how many frames are present
+      process = Popen([self.cpptraj, self.parm], stdin=PIPE, stdout=PIPE,
+                      stderr=PIPE)
+      out, err = process.communicate('trajin %s' % traj)
+      # This shouldn't be reached, since cpptraj doesn't bail out with a
+      # non-zero exit code, it just prints errors.
+      if process.wait():
+         raise TrajError('Bad trajectory file %s:\nOutput: %s\nError: %s' % 
+                         (traj, out, err))
+      nframes = get_num_frames.search(out)
+      # This really means we put in a bad trajectory file
+      if nframes is None or len(nframes.groups()) != 1:
+         raise TrajError('Bad trajectory file (%s):\nOutput: %s\nError: %s' %
+                         (traj, out, err))
+      # Otherwise, we got our number of frames
+      return int(nframes.groups()[0])
 
    #===================================================
 
@@ -141,21 +356,31 @@ class AmberTraj(object):
          self._cpptraj_commands += 'reference ref %s ' % ref
       else:
          self._cpptraj_commands += 'first '
+         self._uses_first = True
 
       # Dump to a file?
       if outfile:
          self._cpptraj_commands += 'out %s ' % outfile
+         self._outfiles.append(outfile)
 
       # Terminate the command
       self._cpptraj_commands += '\n'
 
    #===================================================
 
-   def run(self):
-      """ This runs cpptraj with the given commands """
+   def run(self, nproc=1):
+      """
+      This runs cpptraj with the given commands. If nproc > 1, the
+      trajectories are split into contiguous groups run by separate cpptraj
+      processes, and each data file is merged back together afterwards with
+      continuous frame numbers
+      """
       # adjust the ends to be either the highest frame # or the value of end
       self.end = [min(self.end[i], self.traj_list[j]) 
                   for i,j in enumerate(self.traj_name_list)]
+      nproc = min(nproc, len(self.traj_name_list))
+      if nproc > 1:
+         return self._run_parallel(nproc)
       cmd_str = ''
       for i, traj in enumerate(self.traj_name_list):
          cmd_str += 'trajin %s %d %d %d \n' % (traj, self.start[i], self.end[i],
@@ -172,6 +397,92 @@ class AmberTraj(object):
       else:
          print >> self.logfile, 'cpptraj ran successfully!'
 
+   #===================================================
+
+   def _partition(self, nproc):
+      """
+      Splits the trajectory indices into nproc contiguous groups with about
+      the same number of frames in each
+      """
+      nframes = [len(xrange(self.start[i], self.end[i] + 1, self.stride[i]))
+                 for i in range(len(self.traj_name_list))]
+      total = float(sum(nframes))
+      groups, cum = [[]], 0
+      for i, n in enumerate(nframes):
+         # Start a new group once this one has its share of the frames, while
+         # making sure there are enough trajectories left for the rest
+         left = len(nframes) - i
+         if groups[-1] and len(groups) < nproc and \
+               (cum >= total * len(groups) / nproc or
+                left <= nproc - len(groups)):
+            groups.append([])
+         groups[-1].append(i)
+         cum += n
+      return groups
+
+   #===================================================
+
+   def _run_parallel(self, nproc):
+      """ Runs the cpptraj commands split over nproc cpptraj processes """
+      if self._uses_first:
+         raise TrajError('Cannot split an RMSD to the first frame over '
+                         'multiple processes. Give a reference structure.')
+      groups = self._partition(nproc)
+      # A data file named by several commands is still only split once
+      outfiles = []
+      for outfile in self._outfiles:
+         if outfile not in outfiles: outfiles.append(outfile)
+      pieces = [['%s.%d' % (outfile, k) for k in range(len(groups))]
+                for outfile in outfiles]
+      try:
+         self._run_pieces(groups, outfiles, pieces)
+      finally:
+         # Merging removes the pieces, so these are only left on failure
+         for piece in sum(pieces, []):
+            if os.path.exists(piece): os.remove(piece)
+
+   #===================================================
+
+   def _run_pieces(self, groups, outfiles, pieces):
+      """
+      Runs one cpptraj process for each group of trajectories, each writing
+      its own piece of every data file, then merges the pieces
+      """
+      processes = []
+      print >> self.logfile, 'Running cpptraj on %d processes:' % len(groups)
+      for k, group in enumerate(groups):
+         cmd_str = ''
+         for i in group:
+            cmd_str += 'trajin %s %d %d %d \n' % (self.traj_name_list[i],
+                        self.start[i], self.end[i], self.stride[i])
+         # Each process writes its own copy of each data file
+         commands = self._cpptraj_commands
+         for outfile, outpieces in zip(outfiles, pieces):
+            commands = commands.replace('out %s ' % outfile,
+                                        'out %s ' % outpieces[k])
+         log = tempfile.TemporaryFile()
+         process = Popen([self.cpptraj, self.parm], stdin=PIPE,
+                         stdout=log, stderr=log)
+         process.stdin.write(cmd_str + commands)
+         process.stdin.close()
+         processes.append((process, log))
+
+      # Wait for all of them, and dump their output to the log in order
+      failed = False
+      for k, (process, log) in enumerate(processes):
+         if process.wait(): failed = True
+         log.seek(0)
+         print >> self.logfile, 'cpptraj process %d:' % k
+         self.logfile.write(log.read())
+         log.close()
+
+      if failed:
+         print >> self.logfile, 'Running cpptraj failed.'
+         raise TrajError('cpptraj failed in one of %d processes' % len(groups))
+      for outfile, outpieces in zip(outfiles, pieces):
+         _merge_data_files(outfile, outpieces)
+      print >> self.logfile, 'cpptraj ran successfully!'
+
 #~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
 
 class RmsdData(object):
@@ -25,6 +25,9 @@
 #        a given number
 # resnum: returns the number of residues in a given amber topology file
 # getallresinfo: prints all values for a given prmtop FLAG in a given topology
+# getresinfo_many: returns the values of a prmtop FLAG for a list of residues
+# parm_cache_info: returns hit/miss statistics of the parsed topology cache
+# clear_parm_cache: empties the parsed topology cache
 # fileexists: alias for os.path.exists (didn't know about that at first)
 # getresindex: returns the rank in alphabetical order of a given amino acid
 # getresdecmp: returns the amino acid decomposition of a given prmtop in an
@@ -36,8 +39,16 @@
 from __future__ import print_function
 
 from parmed.amber.readparm import AmberParm
+from collections import OrderedDict
 import os, math
 
+# Parsed topologies used by resnum, natom, getresinfo, etc. are kept in a
+# bounded LRU cache, keyed by absolute path and checked against the file's
+# size and modification time
+PARM_CACHE_SIZE = 8
+_parm_cache = OrderedDict()
+_parm_cache_stats = {'hits' : 0, 'misses' : 0}
+
 def which(program):
    def is_exe(fpath):
       return os.path.exists(fpath) and os.access(fpath, os.X_OK)
@@ -116,24 +127,60 @@ def round(number, decimals):
       return toreturn
 
 
+def _load_parm(topfile):
+   """ Returns the parsed AmberParm for topfile, from the cache if current """
+   key = os.path.abspath(topfile)
+   st = os.stat(topfile)
+   stamp = (st.st_size, st.st_mtime)
+   if key in _parm_cache:
+      cached_stamp, parm = _parm_cache.pop(key)
+      if cached_stamp == stamp:
+         _parm_cache[key] = (stamp, parm) # now most recently used
+         _parm_cache_stats['hits'] += 1
+         return parm
+   _parm_cache_stats['misses'] += 1
+   parm = AmberParm(topfile)
+   _parm_cache[key] = (stamp, parm)
+   while len(_parm_cache) > max(PARM_CACHE_SIZE, 1):
+      _parm_cache.popitem(last=False)
+   return parm
+
+def parm_cache_info():
+   """ Returns a dict of hits, misses, hit_rate, size, and maxsize """
+   hits, misses = _parm_cache_stats['hits'], _parm_cache_stats['misses']
+   return {'hits' : hits, 'misses' : misses,
+           'hit_rate' : hits / float(max(hits + misses, 1)),
+           'size' : len(_parm_cache), 'maxsize' : PARM_CACHE_SIZE}
+
+def clear_parm_cache():
+   """ Empties the topology cache and resets its statistics """
+   _parm_cache.clear()
+   _parm_cache_stats['hits'] = _parm_cache_stats['misses'] = 0
+
 def resnum(topfile):
 
-   parm = AmberParm(topfile)
+   parm = _load_parm(topfile)
    return parm.ptr("NRES")
 
 def natom(topfile):
    
-   parm = AmberParm(topfile)
+   parm = _load_parm(topfile)
    return parm.ptr("NATOM")
 
 def getresinfo(res, topname, flag):
 
-   parm = AmberParm(topname)
+   parm = _load_parm(topname)
    return parm.parm_data[flag][res-1] # and simply return the residue of interest
 
+def getresinfo_many(residues, topname, flag):
+   """ Returns the FLAG values for each residue (numbered from 1) in residues """
+   data = _load_parm(topname).parm_data[flag]
+   return [data[res-1] for res in residues]
+
 def getallresinfo(topname, flag):
-   parm = AmberParm(topname)
-   return parm.parm_data[flag]
+   parm = _load_parm(topname)
+   # Hand back a copy so callers can't change the cached topology
+   return list(parm.parm_data[flag])
 
 def fileexists(file):
    if os.path.exists(file): return 0